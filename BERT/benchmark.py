@@ -0,0 +1,222 @@
+"""Micro-benchmarks of the data and decoding hot paths on synthetic data (processors/synthetic.py), no downloads.
+
+    python benchmark.py --out-file bench-base.json
+    python benchmark.py --compare bench-base.json --only extract_feature get_predictions
+
+Every benchmark times one function over the same seeded data, once to warm up and then --repeat times; the minimum
+and median seconds are reported, the minimum being the least noisy to compare. The tokenizer is built from the
+vocabulary of the synthetic data; preprocessing needs the spaCy model as in training and eval. The results file
+records the commit, the library versions and the data sizes; --compare prints the ratio of each benchmark to an
+earlier results file, which only means something for the same sizes on the same machine.
+"""
+import argparse
+import collections
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+import transformers
+from transformers import BertTokenizer
+
+from processors import synthetic
+from processors.coqa import Extract_Feature, Processor, Result, _check_is_max_context
+from processors.metrics import get_predictions
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BENCHMARKS = collections.OrderedDict()
+
+
+def add_arguments(parser):
+    parser.add_argument("--stories", help="synthetic CoQA stories", default=20, type=int)
+    parser.add_argument("--sentences", help="sentences per story", default=40, type=int)
+    parser.add_argument("--turns", help="questions per story", default=10, type=int)
+    parser.add_argument("--questions", help="synthetic HotpotQA questions", default=500, type=int)
+    parser.add_argument("--repeat", help="timed runs of every benchmark", default=3, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--only", nargs="+", help="benchmarks to run (default all)")
+    parser.add_argument("--out-file", dest="out_file", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="results file of an earlier run to compare with")
+
+
+def benchmark(function):
+    """Registers function(data), which sets up and returns (callable to time, number of items it processes)."""
+    BENCHMARKS[function.__name__[len("bench_"):]] = function
+    return function
+
+
+def load_script(file_name, module_name):
+    """The evaluation scripts are not importable by name (evaluate-v1.0.py, eval-hotpotqa.py)."""
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(HERE, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class SyntheticData(object):
+    """The seeded datasets, their files under directory and what the benchmarks derive from them, built on first use."""
+    def __init__(self, directory, stories, sentences, turns, questions, seed):
+        self.directory = directory
+        self.seed = seed
+        self.coqa = synthetic.coqa_dataset(stories, sentences=sentences, turns=turns, seed=seed)
+        self.hotpotqa = synthetic.hotpotqa_dataset(questions, seed=seed)
+        self.coqa_file = synthetic.write_json(os.path.join(directory, "coqa.json"), self.coqa)
+        self.hotpotqa_file = synthetic.write_json(os.path.join(directory, "hotpotqa.json"), self.hotpotqa)
+        self.tokenizer = BertTokenizer(os.path.join(synthetic.write_wordpiece_vocab(os.path.join(directory, "tokenizer")), "vocab.txt"))
+        self.processor = Processor()
+        self._examples = None
+        self._features = None
+
+    def examples(self):
+        if self._examples is None:
+            self._examples = [example for datum in self.coqa["data"] for example in self.processor._create_examples(datum, 2)]
+        return self._examples
+
+    def features(self):
+        """Features of every example, numbered as iter_features numbers them."""
+        if self._features is None:
+            self._features = []
+            for (example_index, example) in enumerate(self.examples()):
+                for feature in Extract_Feature(example, self.tokenizer, 512, 128, 64):
+                    feature.example_index = example_index
+                    feature.unique_id = 1000000000 + len(self._features)
+                    self._features.append(feature)
+        return self._features
+
+
+@benchmark
+def bench_create_examples(data):
+    stories = data.coqa["data"]
+    return (lambda: [data.processor._create_examples(datum, 2) for datum in stories]), len(stories)
+
+
+@benchmark
+def bench_find_span_with_gt(data):
+    #   every answer searched for in the whole story, as for answers that are not within their rationale
+    cases = []
+    for datum in data.coqa["data"]:
+        offsets = [(m.start(), m.end()) for m in re.finditer(r"\S+", datum["story"])]
+        cases.extend((datum["story"], offsets, answer["input_text"].lower()) for answer in datum["answers"])
+    return (lambda: [data.processor.find_span_with_gt(*case) for case in cases]), len(cases)
+
+
+@benchmark
+def bench_extract_feature(data):
+    examples = data.examples()
+    return (lambda: [Extract_Feature(example, data.tokenizer, 512, 128, 64) for example in examples]), len(examples)
+
+
+@benchmark
+def bench_check_is_max_context(data):
+    #   the calls Extract_Feature makes for a 4096-token document in windows of 445 tokens with a stride of 128
+    _DocSpan = collections.namedtuple("DocSpan", ["start", "length"])
+    doc_spans = [_DocSpan(start=start, length=min(445, 4096 - start)) for start in range(0, 4096 - 445 + 128, 128)]
+    positions = [(span_index, span.start + i) for (span_index, span) in enumerate(doc_spans) for i in range(span.length)]
+    return (lambda: [_check_is_max_context(doc_spans, span_index, position) for (span_index, position) in positions]), len(positions)
+
+
+@benchmark
+def bench_get_predictions(data):
+    examples, features = data.examples(), data.features()
+    rng = np.random.RandomState(data.seed)
+    results = [Result(unique_id=feature.unique_id, start_logits=rng.randn(512).tolist(), end_logits=rng.randn(512).tolist(),
+                      yes_logits=rng.randn(1).tolist(), no_logits=rng.randn(1).tolist(), unk_logits=rng.randn(1).tolist())
+               for feature in features]
+    output_prediction_file = os.path.join(data.directory, "predictions.json")
+    return (lambda: get_predictions(examples, features, results, 20, 30, True, output_prediction_file, False, data.tokenizer)), len(examples)
+
+
+@benchmark
+def bench_model_performance(data):
+    evaluate = load_script("evaluate-v1.0.py", "evaluate_coqa")
+    evaluator = evaluate.CoQAEvaluator(data.coqa_file)
+    #   the answers of the first additional answer set as predictions: right for some turns, partly or not for others
+    pred_data = {(datum["id"], answer["turn_id"]): answer["input_text"] for datum in data.coqa["data"]
+                 for answer in datum["additional_answers"]["0"]}
+    return (lambda: evaluator.model_performance(pred_data)), len(pred_data)
+
+
+@benchmark
+def bench_eval_hotpotqa(data):
+    evaluate = load_script("eval-hotpotqa.py", "eval_hotpotqa")
+    rng = np.random.RandomState(data.seed)
+    predictions = [{"id": [record["_id"]], "answer": record["answer"] if rng.rand() < 0.5 else "unknown"} for record in data.hotpotqa]
+    prediction_file = synthetic.write_json(os.path.join(data.directory, "hotpotqa_predictions.json"), predictions)
+    return (lambda: evaluate.eval(prediction_file, data.hotpotqa_file)), len(predictions)
+
+
+@contextlib.contextmanager
+def quiet():
+    """Discards the progress bars and printed scores of the code under test."""
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        yield
+
+
+def run(function, repeat):
+    """Warm-up run, then the seconds of each of repeat runs."""
+    times = []
+    with quiet():
+        function()
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def commit():
+    try:
+        revision = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, universal_newlines=True).strip()
+        dirty = subprocess.call(["git", "diff", "--quiet", "HEAD", "--", "."], cwd=HERE) != 0
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision + ("-dirty" if dirty else "")
+
+
+def compare(results, earlier):
+    if earlier["sizes"] != results["sizes"]:
+        print(f"warning: {earlier['sizes']} in the earlier results, {results['sizes']} now")
+    print(f"{'benchmark':24} {earlier['commit'] or 'earlier':>12} {results['commit'] or 'now':>12}  ratio")
+    for (name, entry) in results["benchmarks"].items():
+        if name in earlier["benchmarks"]:
+            before = earlier["benchmarks"][name]["min"]
+            print(f"{name:24} {before:11.4f}s {entry['min']:11.4f}s  {entry['min'] / before:5.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    args = parser.parse_args()
+    names = args.only or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        sys.exit(f"unknown benchmarks {unknown}, choose from {list(BENCHMARKS)}")
+    results = {"commit": commit(), "python": platform.python_version(), "torch": torch.__version__,
+               "transformers": transformers.__version__, "numpy": np.__version__, "machine": platform.platform(),
+               "sizes": {"stories": args.stories, "sentences": args.sentences, "turns": args.turns, "questions": args.questions},
+               "seed": args.seed, "repeat": args.repeat, "benchmarks": {}}
+    with tempfile.TemporaryDirectory() as directory:
+        data = SyntheticData(directory, args.stories, args.sentences, args.turns, args.questions, args.seed)
+        for name in names:
+            with quiet():
+                function, items = BENCHMARKS[name](data)
+            times = run(function, args.repeat)
+            results["benchmarks"][name] = {"min": min(times), "median": statistics.median(times), "items": items, "times": times}
+            print(f"{name:24} min {min(times):9.4f}s  median {statistics.median(times):9.4f}s  "
+                  f"{items / min(times):12.1f} items/s")
+    if args.out_file:
+        with open(args.out_file, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
@@ -0,0 +1,115 @@
+"""Measures the imports of the real entry points with python -X importtime, against a budget and the modules they
+must not load.
+
+    python import_time.py
+    python import_time.py --main main_hotpotqa.py --budget decode=10
+
+Each stage runs in a fresh interpreter: help is the main script with -h, decode is the main script re-decoding the
+stored outputs of an eval (--eval O --decode max_answer_length=16) and eval is the evaluation script scoring the
+predictions of that eval (evaluate-v1.0.py, eval-hotpotqa.py for the HotpotQA mains). The eval they read is run
+beforehand, untimed, by scale_test.py --eval-dir on a small synthetic dataset. A stage fails when its imports take
+longer than its budget (in seconds) or when it loads a module it has no use for: help loads neither torch,
+transformers, spaCy nor the model classes (models.py), decode not the model classes and eval neither torch,
+transformers nor spaCy. With transformers 3.x importing a tokenizer loads torch, so the decode budget has room for
+it. Reported per stage: the wall time, the total import time and the slowest top-level imports. The exit status is 1
+when a stage fails.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BUDGETS = {"help": 1.0, "decode": 5.0, "eval": 1.0}
+FORBIDDEN_MODULES = {"help": ["torch", "transformers", "spacy", "models"], "decode": ["models"],
+                     "eval": ["torch", "transformers", "spacy"]}
+#   the predictions of the eval, in its output directory
+PREDICTION_FILE = "predictions.json"
+
+
+def add_arguments(parser):
+    parser.add_argument("--main", help="main script whose entry points are timed", default="main.py")
+    parser.add_argument("--stages", nargs="+", choices=sorted(DEFAULT_BUDGETS), default=["help", "decode", "eval"])
+    parser.add_argument("--budget", nargs="+", default=[], metavar="STAGE=SECONDS", help="override the budget of a stage")
+    parser.add_argument("--top", help="number of slowest top-level imports to list", default=8, type=int)
+
+
+def prepare_eval(main, eval_dir):
+    """Runs an eval of main on a small synthetic dataset into eval_dir/output, with its gold file in eval_dir/data."""
+    command = [sys.executable, "scale_test.py", "--main", os.path.splitext(main)[0], "--stories", "2", "--eval-dir", eval_dir]
+    if "hotpotqa" in main:
+        command.append("--hotpotqa")
+    process = subprocess.run(command, cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    if process.returncode != 0:
+        raise RuntimeError(f"{' '.join(command)} failed:\n" + process.stderr)
+
+
+def stage_command(stage, main, eval_dir):
+    if stage == "help":
+        return [os.path.join(HERE, main), "-h"]
+    if stage == "decode":
+        return [os.path.join(HERE, main), "--eval", "O", "--decode", "max_answer_length=16", "--output", "output"]
+    (gold_file,) = os.listdir(os.path.join(eval_dir, "data"))
+    gold_file, prediction_file = os.path.join("data", gold_file), os.path.join("output", PREDICTION_FILE)
+    if "hotpotqa" in main:
+        return [os.path.join(HERE, "eval-hotpotqa.py"), prediction_file, gold_file]
+    return [os.path.join(HERE, "evaluate-v1.0.py"), "--data-file", gold_file, "--pred-file", prediction_file]
+
+
+def parse_importtime(stderr):
+    """[(module, cumulative seconds, top-level)] of every import in the -X importtime output."""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        imports.append((name.strip(), int(cumulative) / 1e6, name[1:2] != " "))
+    return imports
+
+
+def forbidden_imports(stage, imports):
+    forbidden = FORBIDDEN_MODULES[stage]
+    return sorted({module.split(".")[0] for (module, _, _) in imports if module.split(".")[0] in forbidden})
+
+
+def measure(stage, main, eval_dir):
+    command = [sys.executable, "-X", "importtime"] + stage_command(stage, main, eval_dir)
+    start = time.perf_counter()
+    process = subprocess.run(command, cwd=eval_dir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    wall = time.perf_counter() - start
+    if process.returncode != 0:
+        errors = [line for line in process.stderr.splitlines() if not line.startswith("import time:")]
+        raise RuntimeError(f"{' '.join(command)} failed:\n" + "\n".join(errors))
+    return wall, parse_importtime(process.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    args = parser.parse_args()
+    budgets = dict(DEFAULT_BUDGETS)
+    for item in args.budget:
+        stage, seconds = item.split("=")
+        budgets[stage] = float(seconds)
+    failures = []
+    with tempfile.TemporaryDirectory() as eval_dir:
+        if set(args.stages) - {"help"}:
+            prepare_eval(args.main, eval_dir)
+        for stage in args.stages:
+            wall, imports = measure(stage, args.main, eval_dir)
+            top_level = [(module, seconds) for (module, seconds, top) in imports if top]
+            total = sum(seconds for (_, seconds) in top_level)
+            print(f"{stage}: {wall:.2f}s wall, {total:.2f}s importing (budget {budgets[stage]:.2f}s)")
+            for (module, seconds) in sorted(top_level, key=lambda item: -item[1])[:args.top]:
+                print(f"  {seconds:8.3f}s  {module}")
+            if total > budgets[stage]:
+                failures.append(f"{stage} over budget")
+            forbidden = forbidden_imports(stage, imports)
+            if forbidden:
+                failures.append(f"{stage} imports {', '.join(forbidden)}")
+    if failures:
+        sys.exit("; ".join(failures))
@@ -1,17 +1,21 @@
 import collections
-import json
+import contextlib
+import itertools
 import logging
-import math
 import re
 import string
+import numpy as np
 from tqdm import tqdm
-from transformers.tokenization_bert import BasicTokenizer
+from processors.prediction_writer import PredictionWriter
 
 
 #   This code has been very heavily adapted/used for our CoQA model from the hugging face's Bert implmentation on SQuaD dataset. 
 #   https://github.com/huggingface/transformers/blob/master/src/transformers/data/metrics/squad_metrics.py
 
-def get_predictions(all_examples, all_features, all_results, n_best_size, max_answer_length, do_lower_case, output_prediction_file, verbose_logging, tokenizer):
+def get_predictions(all_examples, all_features, all_results, n_best_size, max_answer_length, do_lower_case, output_prediction_file, verbose_logging, tokenizer, class_score_scale = 2, confirm = True, output_nbest_file = None):
+    #   class_score_scale weighs the yes/no/unknown logits against span scores; confirm=False keeps the top answer
+    #   as is instead of letting confirm_preds replace short answers. Predictions are written as they are decoded
+    #   (one per line for a *.jsonl file); n-best lists with probabilities only when output_nbest_file is given.
     
     example_index_to_features = collections.defaultdict(list)
     for feature in all_features:
@@ -21,123 +25,170 @@ def get_predictions(all_examples, all_features, all_results, n_best_size, max_an
     for result in all_results:
         unique_id_to_result[result.unique_id] = result
 
-    _PrelimPrediction = collections.namedtuple("PrelimPrediction", ["feature_index", "start_index", "end_index", "score", "cls_idx",])
-
-    all_predictions = []
-    all_nbest_json = collections.OrderedDict()
-    for (example_index, example) in enumerate(tqdm(all_examples, desc="Writing preditions")):
-        features = example_index_to_features[example_index]
-
-        prelim_predictions = []
-        
-
-        score_yes, score_no, score_span, score_unk = -float('INF'), -float('INF'), -float('INF'), float('INF')
-        min_unk_feature_index, max_yes_feature_index, max_no_feature_index, max_span_feature_index = -1, -1, -1, -1
-        
-
-        for (feature_index, feature) in enumerate(features):
-            result = unique_id_to_result[feature.unique_id]
-            
-            feature_yes_score, feature_no_score, feature_unk_score = \
-                result.yes_logits[0] * 2, result.no_logits[0] * 2, result.unk_logits[0] * 2
-            start_indexes, end_indexes = _get_best_indexes(result.start_logits, n_best_size), \
-                                         _get_best_indexes(result.end_logits, n_best_size)
-
-            for start_index in start_indexes:
-                for end_index in end_indexes:
-                    if start_index >= len(feature.tokens):
-                        continue
-                    if end_index >= len(feature.tokens):
-                        continue
-                    if start_index not in feature.token_to_orig_map:
-                        continue
-                    if end_index not in feature.token_to_orig_map:
-                        continue
-                    if not feature.token_is_max_context.get(start_index, False):
-                        continue
-                    if end_index < start_index:
-                        continue
-                    length = end_index - start_index + 1
-                    if length > max_answer_length:
-                        continue
-                    feature_span_score = result.start_logits[start_index] + result.end_logits[end_index]
-                    prelim_predictions.append(_PrelimPrediction(feature_index=feature_index,start_index=start_index,end_index=end_index,score=feature_span_score,cls_idx=3))
-
-            if feature_unk_score < score_unk:  
-                score_unk = feature_unk_score
-                min_unk_feature_index = feature_index
-            if feature_yes_score > score_yes: 
-                score_yes = feature_yes_score
-                max_yes_feature_index = feature_index
-            if feature_no_score > score_no: 
-                score_no = feature_no_score
-                max_no_feature_index = feature_index
-                
-        #including yes/no/unknown answers in preliminary predictions.
-        prelim_predictions.append(_PrelimPrediction(feature_index=min_unk_feature_index,start_index=0,end_index=0,score=score_unk,cls_idx=2))
-        prelim_predictions.append(_PrelimPrediction(feature_index=max_yes_feature_index,start_index=0,end_index=0,score=score_yes,cls_idx=0))
-        prelim_predictions.append(_PrelimPrediction(feature_index=max_no_feature_index,start_index=0,end_index=0,score=score_no,cls_idx=1))
-        prelim_predictions = sorted(prelim_predictions,key=lambda p: p.score,reverse=True)
-
-        _NbestPrediction = collections.namedtuple("NbestPrediction", ["text", "score", "cls_idx"])
-
-        seen_predictions = {}
-        nbest = []
-        for pred in prelim_predictions:
-            
+    decoded = ((example, decode_example(example, example_index_to_features[example_index], unique_id_to_result, n_best_size, max_answer_length, do_lower_case, verbose_logging, tokenizer, class_score_scale))
+               for (example_index, example) in enumerate(all_examples))
+    write_predictions(tqdm(decoded, total=len(all_examples), desc="Writing preditions"), output_prediction_file, confirm, output_nbest_file)
+
+def decode_results(all_examples, feature_results, n_best_size, max_answer_length, do_lower_case, verbose_logging, tokenizer, class_score_scale = 2):
+    """Streaming counterpart of the decoding in get_predictions, for a pipelined eval.
+
+    feature_results yields (feature, result) pairs in feature order, as the evaluation batches produce them. Each
+    example is decoded as soon as the results of all its features are in; yields (example, nbest) in example order,
+    with the same values get_predictions computes."""
+    all_examples = iter(all_examples)
+    for (_, group) in itertools.groupby(feature_results, key=lambda feature_result: feature_result[0].example_index):
+        group = list(group)
+        example = next(all_examples)
+        features = [feature for (feature, result) in group]
+        unique_id_to_result = {feature.unique_id: result for (feature, result) in group}
+        yield example, decode_example(example, features, unique_id_to_result, n_best_size, max_answer_length, do_lower_case, verbose_logging, tokenizer, class_score_scale)
+    for example in all_examples:
+        yield example, decode_example(example, [], {}, n_best_size, max_answer_length, do_lower_case, verbose_logging, tokenizer, class_score_scale)
+
+def write_predictions(decoded, output_prediction_file, confirm = True, output_nbest_file = None):
+    #   writes the answer of every (example, nbest) in decoded, and its n-best list when output_nbest_file is given
+    with PredictionWriter(output_prediction_file) as writer, \
+            (PredictionWriter(output_nbest_file) if output_nbest_file else contextlib.nullcontext()) as nbest_writer:
+        for (example, nbest) in decoded:
+            nbest_texts = [text for (text, score) in nbest]
+
+            _id = example.qas_id.split()
+            prediction = {
+                'id': _id,
+                'answer': confirm_preds(nbest_texts) if confirm else nbest_texts[0]}
+            writer.write(prediction)
+            if nbest_writer is not None:
+                nbest_writer.write({"qas_id": example.qas_id, "nbest": nbest_to_json(nbest)})
+
+def _feature_spans(feature, result, n_best_size, max_answer_length):
+    """Start/end indexes and scores of the valid n-best spans of one feature, in start-major order."""
+    if result.span_candidates is not None:
+        #   n-best spans already selected and filtered on the device
+        if not result.span_candidates:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+        start_indexes, end_indexes, scores = (np.asarray(column) for column in zip(*result.span_candidates))
+        #   selected with a max_answer_length at least this one (see check_decode_configs)
+        keep = end_indexes - start_indexes + 1 <= max_answer_length
+        return start_indexes[keep].astype(np.int64), end_indexes[keep].astype(np.int64), scores[keep].astype(np.float64)
+
+    start_logits, end_logits = np.asarray(result.start_logits, dtype=np.float64), np.asarray(result.end_logits, dtype=np.float64)
+    is_context = np.zeros(len(start_logits), dtype=bool)
+    is_context[[index for index in feature.token_to_orig_map if index < len(feature.tokens)]] = True
+    is_max_context = np.zeros(len(start_logits), dtype=bool)
+    is_max_context[[index for (index, is_max) in feature.token_is_max_context.items() if is_max]] = True
+
+    start_indexes, end_indexes = _get_best_indexes(start_logits, n_best_size), _get_best_indexes(end_logits, n_best_size)
+    length = end_indexes[None, :] - start_indexes[:, None] + 1
+    valid = (is_context & is_max_context)[start_indexes][:, None] & is_context[end_indexes][None, :] & (length >= 1) & (length <= max_answer_length)
+    start_rows, end_columns = np.nonzero(valid)
+    start_indexes, end_indexes = start_indexes[start_rows], end_indexes[end_columns]
+    return start_indexes, end_indexes, start_logits[start_indexes] + end_logits[end_indexes]
+
+def decode_example(example, features, unique_id_to_result, n_best_size, max_answer_length, do_lower_case, verbose_logging, tokenizer, class_score_scale = 2):
+    """n-best answers of one example as a list of (text, score), best first."""
+    feature_indexes, start_indexes, end_indexes, scores = [], [], [], []
+
+    score_yes, score_no, score_span, score_unk = -float('INF'), -float('INF'), -float('INF'), float('INF')
+    min_unk_feature_index, max_yes_feature_index, max_no_feature_index, max_span_feature_index = -1, -1, -1, -1
+
+    for (feature_index, feature) in enumerate(features):
+        result = unique_id_to_result[feature.unique_id]
+
+        feature_yes_score, feature_no_score, feature_unk_score = \
+            result.yes_logits[0] * class_score_scale, result.no_logits[0] * class_score_scale, result.unk_logits[0] * class_score_scale
+        feature_start_indexes, feature_end_indexes, feature_scores = _feature_spans(feature, result, n_best_size, max_answer_length)
+        feature_indexes.append(np.full(len(feature_scores), feature_index, dtype=np.int64))
+        start_indexes.append(feature_start_indexes)
+        end_indexes.append(feature_end_indexes)
+        scores.append(feature_scores)
+
+        if feature_unk_score < score_unk:
+            score_unk = feature_unk_score
+            min_unk_feature_index = feature_index
+        if feature_yes_score > score_yes:
+            score_yes = feature_yes_score
+            max_yes_feature_index = feature_index
+        if feature_no_score > score_no:
+            score_no = feature_no_score
+            max_no_feature_index = feature_index
+
+    #including yes/no/unknown answers in preliminary predictions, after the spans as before.
+    feature_indexes.append(np.asarray([min_unk_feature_index, max_yes_feature_index, max_no_feature_index], dtype=np.int64))
+    start_indexes.append(np.zeros(3, dtype=np.int64))
+    end_indexes.append(np.zeros(3, dtype=np.int64))
+    scores.append(np.asarray([score_unk, score_yes, score_no], dtype=np.float64))
+    num_spans = sum(len(feature_scores) for feature_scores in scores[:-1])
+    cls_idxs = np.concatenate([np.full(num_spans, 3, dtype=np.int64), np.asarray([2, 0, 1], dtype=np.int64)])
+    feature_indexes, start_indexes, end_indexes, scores = [np.concatenate(column) for column in (feature_indexes, start_indexes, end_indexes, scores)]
+
+    #   Only the best n_best_size preliminary predictions are ordered at first; if duplicate texts use them up
+    #   before n_best_size distinct answers are found, the walk is repeated over all of them.
+    texts = {}
+    window = n_best_size
+    while True:
+        nbest, seen_predictions = [], {}
+        for prelim_index in _get_best_indexes(scores, window):
             if len(nbest) >= n_best_size:
                 break
-            feature = features[pred.feature_index]
+            cls_idx = cls_idxs[prelim_index]
             #   free-form answers (ie span answers)
-            if pred.cls_idx == 3:
-                tok_tokens = feature.tokens[pred.start_index:(pred.end_index + 1)]
-                orig_doc_start = feature.token_to_orig_map[pred.start_index]
-                orig_doc_end = feature.token_to_orig_map[pred.end_index]
-                orig_tokens = example.doc_tokens[orig_doc_start:(orig_doc_end + 1)]
-                tok_text = tokenizer.convert_tokens_to_string(tok_tokens)
-                # removing whitespaces
-                tok_text = tok_text.strip()
-                tok_text = " ".join(tok_text.split())
-                orig_text = " ".join(orig_tokens)
-
-                final_text = get_final_text(tok_text, orig_text, do_lower_case, verbose_logging)
+            if cls_idx == 3:
+                if prelim_index not in texts:
+                    texts[prelim_index] = _span_text(example, features[feature_indexes[prelim_index]], start_indexes[prelim_index], end_indexes[prelim_index], do_lower_case, verbose_logging, tokenizer)
+                final_text = texts[prelim_index]
                 if final_text in seen_predictions:
                     continue
-
                 seen_predictions[final_text] = True
-                nbest.append(_NbestPrediction(text=final_text,score=pred.score,cls_idx=pred.cls_idx))
-                
+                nbest.append((final_text, float(scores[prelim_index])))
             #   'yes'/'no'/'unknown' answers
             else:
                 text = ['yes', 'no', 'unknown']
-                nbest.append(_NbestPrediction(text=text[pred.cls_idx], score=pred.score, cls_idx=pred.cls_idx))
-
-        if len(nbest) < 1:
-            nbest.append(_NbestPrediction(text='unknown', score=-float('inf'), cls_idx=2))
-
-        assert len(nbest) >= 1
-
-        probs = _compute_softmax([p.score for p in nbest])
-
-        nbest_json = []
-
-        for i, entry in enumerate(nbest):
-            output = collections.OrderedDict()
-            output["text"] = entry.text
-            output["probability"] = probs[i]
-            output["score"] = entry.score
-            nbest_json.append(output)
-
-        assert len(nbest_json) >= 1
-
-        _id = example.qas_id.split()
-        all_predictions.append({
-            'id': _id,
-            'answer': confirm_preds(nbest_json)})
-        all_nbest_json[example.qas_id] = nbest_json
-    #   Writing all the predictions in the predictions.json file in the BERT directory
-    with open(output_prediction_file, "w") as writer:
-        writer.write(json.dumps(all_predictions, indent=4) + "\n")
+                nbest.append((text[cls_idx], float(scores[prelim_index])))
+        if len(nbest) >= n_best_size or window >= len(scores):
+            break
+        window = len(scores)
+
+    if len(nbest) < 1:
+        nbest.append(('unknown', -float('inf')))
+
+    assert len(nbest) >= 1
+    return nbest
+
+def nbest_to_json(nbest):
+    """n-best (text, score) list as {"text", "probability", "score"} dicts."""
+    probs = _compute_softmax(np.asarray([score for (text, score) in nbest]))
+
+    nbest_json = []
+
+    for i, (text, score) in enumerate(nbest):
+        output = collections.OrderedDict()
+        output["text"] = text
+        output["probability"] = float(probs[i])
+        output["score"] = score
+        nbest_json.append(output)
+    return nbest_json
+
+def _span_text(example, feature, start_index, end_index, do_lower_case, verbose_logging, tokenizer):
+    orig_doc_start = feature.token_to_orig_map[start_index]
+    orig_doc_end = feature.token_to_orig_map[end_index]
+    orig_tokens = example.doc_tokens[orig_doc_start:(orig_doc_end + 1)]
+    #   When the span starts an original word and its tokens read exactly like the basic-tokenized original text,
+    #   get_final_text would find it at the start and map it back by position: slice the original text directly.
+    if do_lower_case and start_index in feature.token_to_orig_char and end_index in feature.token_to_orig_char:
+        start_char, _, _ = feature.token_to_orig_char[start_index]
+        _, end_char, run_start = feature.token_to_orig_char[end_index]
+        if start_char == 0 and run_start <= start_index:
+            orig_text = " ".join(orig_tokens)
+            return orig_text[:len(orig_text) - len(orig_tokens[-1]) + end_char]
+
+    tok_tokens = feature.tokens[start_index:(end_index + 1)]
+    tok_text = tokenizer.convert_tokens_to_string(tok_tokens)
+    # removing whitespaces
+    tok_text = tok_text.strip()
+    tok_text = " ".join(tok_text.split())
+    orig_text = " ".join(orig_tokens)
+
+    return get_final_text(tok_text, orig_text, do_lower_case, verbose_logging)
 
 def get_final_text(pred_text, orig_text, do_lower_case, verbose_logging=False):
     def _strip_spaces(text):
@@ -151,6 +202,7 @@ def get_final_text(pred_text, orig_text, do_lower_case, verbose_logging=False):
         ns_text = "".join(ns_chars)
         return (ns_text, ns_to_s_map)
 
+    from transformers.tokenization_bert import BasicTokenizer
     tokenizer = BasicTokenizer(do_lower_case=do_lower_case)
 
     tok_text = " ".join(tokenizer.tokenize(orig_text))
@@ -191,50 +243,33 @@ def get_final_text(pred_text, orig_text, do_lower_case, verbose_logging=False):
     output_text = orig_text[orig_start_position:(orig_end_position + 1)]
     return output_text
 
-def confirm_preds(nbest_json):
+def confirm_preds(nbest_texts):
     #unsuccessful attempt at trying to predict for how many and True or false type of questions
     subs = [ 'one', 'two', 'three', 'four', 'five', 'six', 'seven', 'eight', 'nine','ten', 'eleven', 'twelve', 'true', 'false']
-    ori = nbest_json[0]['text']
+    ori = nbest_texts[0]
     if len(ori) < 2:  
-        for e in nbest_json[1:]:
-            if _normalize_answer(e['text']) in subs:
-                return e['text']
+        for text in nbest_texts[1:]:
+            if _normalize_answer(text) in subs:
+                return text
         return 'unknown'
     return ori
 
 def _get_best_indexes(logits, n_best_size):
-    """Get the n-best logits from a list."""
-    index_and_score = sorted(enumerate(logits), key=lambda x: x[1], reverse=True)
-
-    best_indexes = []
-    for i in range(len(index_and_score)):
-        if i >= n_best_size:
-            break
-        best_indexes.append(index_and_score[i][0])
-    return best_indexes
+    """Get the n-best logits from an array, best first and ties in index order (like a stable reverse sort)."""
+    if n_best_size >= len(logits):
+        return np.argsort(-logits, kind="stable")
+    threshold = logits[np.argpartition(-logits, n_best_size - 1)[n_best_size - 1]]
+    #   every index tied with the n-th best is kept so the stable sort below picks the same ones
+    candidates = np.flatnonzero(logits >= threshold)
+    return candidates[np.argsort(-logits[candidates], kind="stable")][:n_best_size]
 
 
 def _compute_softmax(scores):
     """Compute softmax probability over raw logits."""
-    if not scores:
-        return []
-
-    max_score = None
-    for score in scores:
-        if max_score is None or score > max_score:
-            max_score = score
-
-    exp_scores = []
-    total_sum = 0.0
-    for score in scores:
-        x = math.exp(score - max_score)
-        exp_scores.append(x)
-        total_sum += x
-
-    probs = []
-    for score in exp_scores:
-        probs.append(score / total_sum)
-    return probs
+    if len(scores) == 0:
+        return np.zeros(0)
+    exp_scores = np.exp(scores - np.max(scores))
+    return exp_scores / np.sum(exp_scores)
 
 def _normalize_answer(s):
     def remove_articles(text):
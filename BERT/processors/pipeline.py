@@ -0,0 +1,93 @@
+import queue
+import threading
+import time
+
+
+#   Runs the stages of an evaluation (featurize -> infer -> decode) concurrently, so the CPU stages overlap
+#   with the model instead of waiting for each other (see --pipeline in the main scripts).
+
+class _Failure(object):
+    def __init__(self, error):
+        self.error = error
+
+_DONE = object()
+
+
+class StageTiming(object):
+    """Wall time of one stage, split into time spent working, waiting for its input and waiting for room downstream."""
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.elapsed = 0.0
+        self.waiting = 0.0
+        self.blocked = 0.0
+
+    @property
+    def busy(self):
+        return max(self.elapsed - self.waiting - self.blocked, 0.0)
+
+    def __str__(self):
+        return (f"{self.name}: {self.items} items, busy {self.busy:.1f}s, waiting for input {self.waiting:.1f}s, "
+                f"blocked on output {self.blocked:.1f}s")
+
+
+class Pipeline(object):
+    """Chains stages through bounded queues, each stage in its own thread.
+
+    A stage is a (name, function) pair; the function takes an iterator over the items of the previous stage (or of
+    the source) and returns an iterator over its own, in order. Iterating over run(source) yields the items of the
+    last stage; the time the caller spends between items is accounted to a final stage called consumer."""
+    def __init__(self, stages, queue_size=4, consumer="write"):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.timings = [StageTiming(name) for (name, _) in stages] + [StageTiming(consumer)]
+
+    def _inputs(self, items, timing):
+        if not isinstance(items, queue.Queue):
+            items = iter(items)
+        while True:
+            start = time.perf_counter()
+            if isinstance(items, queue.Queue):
+                item = items.get()
+            else:
+                item = next(items, _DONE)
+            timing.waiting += time.perf_counter() - start
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+
+    def _run_stage(self, function, items, output, timing):
+        start = time.perf_counter()
+        try:
+            for item in function(self._inputs(items, timing)):
+                put_start = time.perf_counter()
+                output.put(item)
+                timing.blocked += time.perf_counter() - put_start
+                timing.items += 1
+            output.put(_DONE)
+        except BaseException as error:
+            output.put(_Failure(error))
+        timing.elapsed = time.perf_counter() - start
+
+    def run(self, source):
+        start = time.perf_counter()
+        items = source
+        for ((name, function), timing) in zip(self.stages, self.timings):
+            output = queue.Queue(maxsize=self.queue_size)
+            #   daemon threads, so a stage blocked on a full queue does not keep the process alive after a failure
+            threading.Thread(target=self._run_stage, args=(function, items, output, timing), name=f"pipeline-{name}", daemon=True).start()
+            items = output
+        consumer = self.timings[-1]
+        for item in self._inputs(items, consumer):
+            consumer.items += 1
+            yield item
+        consumer.elapsed = time.perf_counter() - start
+
+    def report(self):
+        for timing in self.timings:
+            print(f"Stage {timing}")
+        bottleneck = max(self.timings, key=lambda timing: timing.busy)
+        print(f"Bottleneck: {bottleneck.name} ({bottleneck.busy:.1f}s busy)")
+        return self.timings
@@ -0,0 +1,36 @@
+import torch
+
+
+#   Device and threading helpers shared by the main scripts, so the same entry points
+#   can run on a GPU box or on a CPU-only inference host.
+
+def set_threads(threads=None, interop_threads=None):
+    """Configures the intra-op and inter-op thread pools. Must run once, before any model work."""
+    if interop_threads:
+        torch.set_num_interop_threads(interop_threads)
+    if threads:
+        torch.set_num_threads(threads)
+
+
+def setup_device(device_name=None):
+    """Returns the torch device to run on, defaulting to cuda when available and cpu otherwise."""
+    if device_name is None:
+        device_name = "cuda" if torch.cuda.is_available() else "cpu"
+    device = torch.device(device_name)
+    if device.type == "cuda" and not torch.cuda.is_available():
+        raise ValueError(f"Device {device_name} requested but CUDA is not available")
+    return device
+
+
+def inference_mode():
+    """torch.inference_mode where the installed torch provides it, torch.no_grad otherwise."""
+    if hasattr(torch, "inference_mode"):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
+def report_throughput(num_features, elapsed, device):
+    features_per_second = num_features / elapsed if elapsed > 0 else 0.0
+    print(f"Evaluated {num_features} features in {elapsed:.1f}s on {device} "
+          f"({features_per_second:.2f} features/s, {torch.get_num_threads()} threads)")
+    return features_per_second
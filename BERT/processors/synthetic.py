@@ -0,0 +1,188 @@
+import collections
+import json
+import os
+import random
+
+
+#   Seeded synthetic CoQA and HotpotQA datasets, in the format the processors and evaluation scripts read, and the
+#   files of small tokenizers covering their vocabulary, so benchmarks and scale tests need no downloads. The same
+#   arguments always give the same data.
+
+WORDS = ["time", "year", "people", "way", "day", "man", "thing", "woman", "life", "child", "world", "school", "state",
+         "family", "student", "group", "country", "problem", "hand", "part", "place", "case", "week", "company", "system",
+         "program", "question", "work", "government", "number", "night", "point", "home", "water", "room", "mother",
+         "area", "money", "story", "fact", "month", "lot", "right", "study", "book", "eye", "job", "word", "business",
+         "issue", "side", "kind", "head", "house", "service", "friend", "father", "power", "hour", "game", "line", "end",
+         "member", "law", "car", "city", "community", "name", "president", "team", "minute", "idea", "kid", "body",
+         "information", "back", "parent", "face", "others", "level", "office", "door", "health", "person", "art", "war",
+         "history", "party", "result", "change", "morning", "reason", "research", "girl", "guy", "moment", "air",
+         "teacher", "force", "education", "went", "saw", "found", "gave", "told", "made", "took", "wanted", "looked",
+         "big", "small", "old", "new", "good", "little", "long", "great", "young", "red", "blue", "green", "happy", "the",
+         "a", "an", "of", "to", "in", "on", "with", "at", "by", "from", "and", "but", "he", "she", "they", "it", "his",
+         "her", "their", "was", "were", "is", "had", "has", "not", "very", "then", "there", "after", "before", "two",
+         "three", "four", "five", "ten", "mary", "john", "paris", "london", "river", "forest", "garden", "dog", "cat"]
+QUESTION_WORDS = ["what", "who", "where", "when", "how", "why", "which", "did", "does", "was"]
+COQA_SOURCES = ["mctest", "gutenberg", "race", "cnn", "wikipedia", "reddit", "science"]
+SPECIAL_ANSWERS = ["yes", "no", "unknown"]
+
+
+def _sentence(rng, words_per_sentence):
+    length = max(3, int(rng.gauss(words_per_sentence, words_per_sentence / 4)))
+    return " ".join(rng.choice(WORDS) for _ in range(length)) + " ."
+
+
+def _question(rng):
+    return rng.choice(QUESTION_WORDS) + " " + " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 6))) + " ?"
+
+
+def _span_answer(rng, sentence):
+    words = sentence[:-2].split(" ")
+    start = rng.randrange(len(words))
+    return " ".join(words[start:start + rng.randint(1, 4)])
+
+
+def _turn_answer(rng, sentence, special_rate):
+    if rng.random() < special_rate:
+        return rng.choice(SPECIAL_ANSWERS)
+    return _span_answer(rng, sentence)
+
+
+def coqa_story(rng, story_id, sentences=20, words_per_sentence=12, turns=10, additional_answers=3, special_rate=0.2):
+    """One CoQA story of about sentences sentences and its turns; the rationale of each turn is a whole sentence."""
+    story_sentences = [_sentence(rng, words_per_sentence) for _ in range(sentences)]
+    starts = [0]
+    for sentence in story_sentences[:-1]:
+        starts.append(starts[-1] + len(sentence) + 1)
+    story = " ".join(story_sentences)
+    questions, answer_sets = [], [[] for _ in range(1 + additional_answers)]
+    for turn_id in range(1, turns + 1):
+        questions.append({"input_text": _question(rng), "turn_id": turn_id})
+        k = rng.randrange(sentences)
+        first = _turn_answer(rng, story_sentences[k], special_rate)
+        for (a, answers) in enumerate(answer_sets):
+            input_text = first if a == 0 or rng.random() < 0.5 else _turn_answer(rng, story_sentences[k], special_rate)
+            if input_text == "unknown":
+                answers.append({"span_start": -1, "span_end": -1, "span_text": "unknown", "input_text": "unknown", "turn_id": turn_id})
+            else:
+                answers.append({"span_start": starts[k], "span_end": starts[k] + len(story_sentences[k]),
+                                "span_text": story_sentences[k], "input_text": input_text, "turn_id": turn_id})
+    datum = {"source": COQA_SOURCES[rng.randrange(len(COQA_SOURCES))], "id": story_id, "filename": story_id + ".txt",
+             "story": story, "questions": questions, "answers": answer_sets[0]}
+    if additional_answers:
+        datum["additional_answers"] = {str(a): answers for (a, answers) in enumerate(answer_sets[1:])}
+    return datum
+
+
+def coqa_dataset(stories, sentences=20, words_per_sentence=12, turns=10, additional_answers=3, seed=0):
+    """A CoQA-format dataset ({"version", "data"}) of stories stories."""
+    rng = random.Random(seed)
+    return {"version": "1.0", "data": [coqa_story(rng, "s{:07d}".format(i), sentences, words_per_sentence, turns, additional_answers)
+                                       for i in range(stories)]}
+
+
+def hotpotqa_record(rng, record_id, paragraphs=4, sentences=4, words_per_sentence=12, special_rate=0.1):
+    """One HotpotQA question over paragraphs paragraphs, with two supporting facts and the story the processors read."""
+    context = [["title {} {}".format(record_id, p), [_sentence(rng, words_per_sentence) for _ in range(sentences)]]
+               for p in range(paragraphs)]
+    facts = [[title, rng.randrange(len(paragraph))] for (title, paragraph) in rng.sample(context, min(2, paragraphs))]
+    supporting_sentence = dict(context)[facts[0][0]][facts[0][1]]
+    answer = rng.choice(SPECIAL_ANSWERS[:2]) if rng.random() < special_rate else _span_answer(rng, supporting_sentence)
+    return {"_id": record_id, "question": _question(rng), "answer": answer, "type": "bridge", "level": "medium",
+            "supporting_facts": facts, "context": context,
+            "story": " ".join(sentence for (_, paragraph) in context for sentence in paragraph)}
+
+
+def hotpotqa_dataset(questions, paragraphs=4, sentences=4, words_per_sentence=12, seed=0):
+    """A HotpotQA-format dataset (a list of records) of questions questions."""
+    rng = random.Random(seed)
+    return [hotpotqa_record(rng, "h{:07d}".format(i), paragraphs, sentences, words_per_sentence) for i in range(questions)]
+
+
+def write_json(path, data):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    return path
+
+
+def vocabulary():
+    return sorted(set(WORDS + QUESTION_WORDS + SPECIAL_ANSWERS + ["title"]))
+
+
+def _characters():
+    return sorted(set("".join(vocabulary())) | set("0123456789.?"))
+
+
+def write_wordpiece_vocab(directory):
+    """vocab.txt of a BERT (uncased) tokenizer: the synthetic words whole, and any other word in characters."""
+    os.makedirs(directory, exist_ok=True)
+    tokens = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + _characters() + ["##" + c for c in _characters()] + vocabulary()
+    with open(os.path.join(directory, "vocab.txt"), "w", encoding="utf-8") as f:
+        f.write("\n".join(dict.fromkeys(tokens)) + "\n")
+    return directory
+
+
+def _byte_unicode():
+    """The byte to unicode character table of GPT-2/RoBERTa byte-level BPE."""
+    bs = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    cs = bs[:]
+    n = 0
+    for b in range(2 ** 8):
+        if b not in bs:
+            bs.append(b)
+            cs.append(2 ** 8 + n)
+            n += 1
+    return [chr(c) for (_, c) in sorted(zip(bs, cs))]
+
+
+def _merge_pair(word, first, second):
+    merged, i = [], 0
+    while i < len(word):
+        if i + 1 < len(word) and word[i] == first and word[i + 1] == second:
+            merged.append(first + second)
+            i += 2
+        else:
+            merged.append(word[i])
+            i += 1
+    return tuple(merged)
+
+
+def write_bpe_vocab(directory):
+    """vocab.json and merges.txt of a RoBERTa tokenizer: every byte, and merges learned on the synthetic words with
+    and without a leading space until each of them is a single token."""
+    os.makedirs(directory, exist_ok=True)
+    vocab = {"<s>": 0, "<pad>": 1, "</s>": 2, "<unk>": 3}
+    for c in _byte_unicode():
+        vocab.setdefault(c, len(vocab))
+    words = [tuple(form) for word in vocabulary() + [".", "?"] for form in (word, "Ġ" + word)]
+    merges = []
+    while True:
+        pairs = collections.Counter(pair for word in words for pair in zip(word, word[1:]))
+        if not pairs:
+            break
+        #   the most frequent pair, the first in sorted order on ties
+        (first, second) = min(pairs, key=lambda pair: (-pairs[pair], pair))
+        merges.append((first, second))
+        vocab.setdefault(first + second, len(vocab))
+        words = [_merge_pair(word, first, second) for word in words]
+    vocab["<mask>"] = len(vocab)
+    with open(os.path.join(directory, "vocab.json"), "w", encoding="utf-8") as f:
+        json.dump(vocab, f)
+    with open(os.path.join(directory, "merges.txt"), "w", encoding="utf-8") as f:
+        f.write("#version: 0.2\n" + "".join("{} {}\n".format(*merge) for merge in merges))
+    return directory
+
+
+def write_sentencepiece_model(directory, seed=0):
+    """spiece.model of an XLNet tokenizer trained on synthetic stories, with the special pieces at the ids of the
+    pretrained one (<unk> 0, <s> 1, </s> 2, <cls> 3, <sep> 4, <pad> 5, ...)."""
+    import sentencepiece
+    os.makedirs(directory, exist_ok=True)
+    text_file = os.path.join(directory, "spiece.txt")
+    with open(text_file, "w", encoding="utf-8") as f:
+        for story in coqa_dataset(200, seed=seed)["data"]:
+            f.write(story["story"] + "\n" + "\n".join(question["input_text"] for question in story["questions"]) + "\n")
+    sentencepiece.SentencePieceTrainer.Train(
+        "--input={} --model_prefix={} --vocab_size=400 --hard_vocab_limit=false --character_coverage=1.0 "
+        "--unk_id=0 --bos_id=1 --eos_id=2 --user_defined_symbols=<cls>,<sep>,<pad>,<mask>,<eod>,<eop> "
+        "--minloglevel=2".format(text_file, os.path.join(directory, "spiece")))
+    return directory
@@ -0,0 +1,182 @@
+import os
+import random
+import re
+import shutil
+import threading
+import torch
+from torch.utils.data import Sampler
+from processors.options import DEFAULT_KEEP_CHECKPOINTS, DEFAULT_SAVE_STEPS
+
+
+#   Checkpoints of train() that a preempted job resumes from with --resume: every save_steps steps the model,
+#   optimizer and scheduler state is copied to the host and written by a background thread while training goes on,
+#   into a temporary directory renamed to checkpoints/step-N once complete, so a job killed mid-write leaves the
+#   previous checkpoints intact; the last keep of them are kept. With the state go the position of the sampler in
+#   the epoch and the random number generator states, so a resumed run draws the same batches and dropout masks
+#   as an uninterrupted one.
+
+CHECKPOINT_DIRECTORY = "checkpoints"
+#   the file name from_pretrained loads the weights from
+MODEL_FILE = "pytorch_model.bin"
+TRAINER_STATE_FILE = "trainer_state.pt"
+
+
+def latest_checkpoint(output_directory):
+    """The checkpoint of the most steps in output_directory, or None."""
+    directory = os.path.join(output_directory, CHECKPOINT_DIRECTORY)
+    steps = _checkpoint_steps(directory)
+    return os.path.join(directory, f"step-{steps[-1]}") if steps else None
+
+
+class ResumableRandomSampler(Sampler):
+    """RandomSampler whose order is drawn from seed and the epoch, so that an epoch can be resumed from start."""
+    def __init__(self, data_source, seed=None):
+        self.data_source = data_source
+        self.seed = random.randrange(2 ** 31) if seed is None else seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        """Samples epoch from its first sample, unless it is the epoch a checkpoint resumed part way through."""
+        if epoch != self.epoch:
+            self.epoch, self.start = epoch, 0
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        return iter(torch.randperm(len(self.data_source), generator=generator).tolist()[self.start:])
+
+    def __len__(self):
+        return len(self.data_source) - self.start
+
+
+class Checkpoints(object):
+    """Saves and resumes the training state of a loop that iterates over batches(dataloader) of a dataloader of
+    sampler and calls step() after each optimizer step; a context that waits for the last write on exit."""
+    def __init__(self, output_directory, sampler, save_steps=DEFAULT_SAVE_STEPS, keep=DEFAULT_KEEP_CHECKPOINTS):
+        self.output_directory = output_directory
+        self.directory = os.path.join(output_directory, CHECKPOINT_DIRECTORY)
+        self.sampler = sampler
+        self.save_steps = save_steps
+        self.keep = keep
+        self.position = sampler.start
+        self.rng_state = None
+        self.thread = None
+        self.error = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._wait(raise_error=exc_info[0] is None)
+        return False
+
+    def resume(self, model, optimizer, scheduler):
+        """Loads the latest checkpoint, if any, into model, optimizer, scheduler and the sampler; returns the steps
+        and the epochs done, (0, 0) without a checkpoint."""
+        path = latest_checkpoint(self.output_directory)
+        if path is None:
+            print(f"No checkpoint in {self.directory}, training from the start")
+            return 0, 0
+        model = model.module if hasattr(model, "module") else model
+        model.load_state_dict(torch.load(os.path.join(path, MODEL_FILE), map_location="cpu"))
+        optimizer.load_state_dict(torch.load(os.path.join(path, "optimizer.pt"), map_location="cpu"))
+        scheduler.load_state_dict(torch.load(os.path.join(path, "scheduler.pt")))
+        state = torch.load(os.path.join(path, TRAINER_STATE_FILE))
+        epoch, position = state["epoch"], state["position"]
+        if position >= len(self.sampler.data_source):
+            epoch, position = epoch + 1, 0
+        self.sampler.seed, self.sampler.epoch, self.sampler.start = state["sampler_seed"], epoch, position
+        self.rng_state = state["rng_state"]
+        print(f"Resuming from {path}: step {state['global_step']}, epoch {epoch}, sample {position}")
+        return state["global_step"], epoch
+
+    def batches(self, batches):
+        """Iterates over the batches of an epoch, keeping the position of the sampler; after resume, restores the
+        random number generators where they were, around the seed the dataloader iterator draws from them."""
+        rng_state, self.rng_state = self.rng_state, None
+        if rng_state is not None and self.sampler.start == 0:
+            #   a new epoch: the uninterrupted run drew the seed after the checkpoint
+            _set_rng_state(rng_state)
+            rng_state = None
+        self.position = self.sampler.start
+        for batch in batches:
+            if rng_state is not None:
+                #   part way through an epoch: the uninterrupted run drew the seed at the start of it
+                _set_rng_state(rng_state)
+                rng_state = None
+            self.position += batch[0].size(0)
+            yield batch
+
+    def step(self, global_step, model, tokenizer, optimizer, scheduler):
+        """Saves a checkpoint every save_steps steps: a copy on the host, written by a background thread."""
+        if global_step % self.save_steps:
+            return
+        #   one write at a time, so at most one copy of the state is held on the host
+        self._wait()
+        model = model.module if hasattr(model, "module") else model
+        state = {MODEL_FILE: _host_copy(model.state_dict()), "optimizer.pt": _host_copy(optimizer.state_dict()),
+                 "scheduler.pt": _host_copy(scheduler.state_dict()),
+                 TRAINER_STATE_FILE: {"global_step": global_step, "epoch": self.sampler.epoch, "position": self.position,
+                                      "sampler_seed": self.sampler.seed, "rng_state": _rng_state()}}
+        self.thread = threading.Thread(target=self._write, args=(global_step, state, model.config, tokenizer))
+        self.thread.start()
+
+    def _wait(self, raise_error=True):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        error, self.error = self.error, None
+        if error is not None and raise_error:
+            raise error
+
+    def _write(self, global_step, state, config, tokenizer):
+        try:
+            path = os.path.join(self.directory, f"step-{global_step}")
+            temporary = path + ".tmp"
+            shutil.rmtree(temporary, ignore_errors=True)
+            os.makedirs(temporary)
+            for file_name, value in state.items():
+                torch.save(value, os.path.join(temporary, file_name))
+            config.save_pretrained(temporary)
+            tokenizer.save_pretrained(temporary)
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.replace(temporary, path)
+            for steps in _checkpoint_steps(self.directory)[:-self.keep]:
+                shutil.rmtree(os.path.join(self.directory, f"step-{steps}"), ignore_errors=True)
+        except Exception as error:
+            self.error = error
+
+
+def _checkpoint_steps(directory):
+    if not os.path.isdir(directory):
+        return []
+    matches = (re.fullmatch(r"step-(\d+)", name) for name in os.listdir(directory))
+    return sorted(int(match.group(1)) for match in matches if match)
+
+
+def _host_copy(value):
+    """A copy on the host of the tensors in a state_dict, which training goes on updating while it is written."""
+    if torch.is_tensor(value):
+        return value.detach().to("cpu", copy=True)
+    if isinstance(value, dict):
+        copy = type(value)((key, _host_copy(item)) for key, item in value.items())
+        if hasattr(value, "_metadata"):
+            copy._metadata = value._metadata
+        return copy
+    if isinstance(value, (list, tuple)):
+        return type(value)(_host_copy(item) for item in value)
+    return value
+
+
+def _rng_state():
+    return {"python": random.getstate(), "torch": torch.get_rng_state(),
+            "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None}
+
+
+def _set_rng_state(state):
+    random.setstate(state["python"])
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
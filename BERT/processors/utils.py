@@ -5,7 +5,6 @@ import json
 import logging
 from dataclasses import dataclass
 from typing import Optional
-from transformers.file_utils import is_tf_available, is_torch_available
 
 
 #   This code has been completely adapted/used from the hugging face's Bert implmentation on SQuaD dataset. 
@@ -302,6 +301,7 @@ class SingleSentenceClassificationProcessor(DataProcessor):
         if return_tensors is None:
             return features
         elif return_tensors == "tf":
+            from transformers.file_utils import is_tf_available
             if not is_tf_available():
                 raise RuntimeError("return_tensors set to 'tf' but TensorFlow 2.0 can't be imported")
             import tensorflow as tf
@@ -317,6 +317,7 @@ class SingleSentenceClassificationProcessor(DataProcessor):
             )
             return dataset
         elif return_tensors == "pt":
+            from transformers.file_utils import is_torch_available
             if not is_torch_available():
                 raise RuntimeError("return_tensors set to 'pt' but PyTorch can't be imported")
             import torch
@@ -1,10 +1,14 @@
 # Modified from https://raw.githubusercontent.com/hotpotqa/hotpot/master/hotpot_evaluate_v1.py
 
+import argparse
+import csv
+import glob
 import sys
 import ujson as json
 import re
 import string
 from collections import Counter
+from multiprocessing import Pool
 import pickle
 
 def normalize_answer(s):
@@ -51,10 +55,14 @@ def f1_score(prediction, ground_truth):
 def exact_match_score(prediction, ground_truth):
     return (normalize_answer(prediction) == normalize_answer(ground_truth))
 
-def update_answer(metrics, prediction, gold):
+def score_answer(prediction, gold):
     em = exact_match_score(prediction, gold)
     f1, prec, recall = f1_score(prediction, gold)
     unk = (normalize_answer(prediction) == "unknown")
+    return em, f1, prec, recall, unk
+
+def update_answer(metrics, prediction, gold, scores=None):
+    em, f1, prec, recall, unk = scores if scores is not None else score_answer(prediction, gold)
     metrics['unk'] += float(unk)
     metrics['em'] += float(em)
     metrics['f1'] += f1
@@ -84,29 +92,117 @@ def update_sp(metrics, prediction, gold):
     metrics['sp_recall'] += recall
     return em, prec, recall
 
-def eval(prediction_file, gold_file):
+def score_prediction(pair):
+    """score_answer of a prediction against each gold answer with its id (usually one)."""
+    prediction, gold_answers = pair
+    return [score_answer(prediction, gold) for gold in gold_answers]
+
+def index_gold(gold):
+    """_id -> answers of the gold records with that _id, in file order."""
+    gold_answers = {}
+    for record in gold:
+        gold_answers.setdefault(record["_id"], []).append(record["answer"])
+    return gold_answers
+
+def report_ids(prediction, gold_answers, prefix=''):
+    """Writes prediction ids missing from gold, gold ids without a prediction and repeated ids to stderr."""
+    prediction_ids = Counter(p["id"][0] for p in prediction)
+    unknown = [i for i in prediction_ids if i not in gold_answers]
+    missing = [i for i in gold_answers if i not in prediction_ids]
+    duplicates = [i for (i, count) in prediction_ids.items() if count > 1]
+    gold_duplicates = [i for (i, answers) in gold_answers.items() if len(answers) > 1]
+    for (ids, message) in [(unknown, "predictions with an id not in the gold file (scored 0)"),
+                           (missing, "gold questions without a prediction (not counted)"),
+                           (duplicates, "ids predicted more than once (each prediction is scored)"),
+                           (gold_duplicates, "ids repeated in the gold file (scored against each)")]:
+        if ids:
+            sys.stderr.write('{}{} {}: {}\n'.format(prefix, len(ids), message, ', '.join(ids[:10]) + (', ...' if len(ids) > 10 else '')))
+
+def load_predictions(prediction_file):
     with open(prediction_file) as f:
-        prediction = json.load(f)
+        #   .jsonl prediction files hold one prediction per line
+        return [json.loads(line) for line in f if line.strip()] if prediction_file.endswith('.jsonl') else json.load(f)
+
+def load_gold(gold_file):
     with open(gold_file) as f:
-        gold = json.load(f)
+        return index_gold(json.load(f))
+
+def eval(prediction_file, gold_file, processes=1):
+    prediction = load_predictions(prediction_file)
+    gold_answers = load_gold(gold_file)
     
     #assert len(prediction)==len(gold)
-    
+    report_ids(prediction, gold_answers)
+    print(score(prediction, gold_answers, processes))
+
+def score(prediction, gold_answers, processes=1):
     metrics = {'em': 0, 'f1': 0, 'prec': 0, 'recall': 0, 'unk': 0,
         'sp_em': 0, 'sp_f1': 0, 'sp_prec': 0, 'sp_recall': 0,
         'joint_em': 0, 'joint_f1': 0, 'joint_prec': 0, 'joint_recall': 0}
-    for i in range(len(prediction)):
-        for j in range(len(gold)):
-            if prediction[i]["id"][0]==gold[j]["_id"]:
-                em, prec, recall, unk = update_answer(
-                    metrics, prediction[i]['answer'], gold[j]['answer'])
+    pairs = [(p['answer'], gold_answers.get(p["id"][0], [])) for p in prediction]
+    if processes > 1:
+        with Pool(processes) as pool:
+            all_scores = pool.map(score_prediction, pairs, chunksize=256)
+    else:
+        all_scores = map(score_prediction, pairs)
+    #   summed in prediction order, as the matching loop over (prediction, gold) did
+    for ((answer, golds), scores) in zip(pairs, all_scores):
+        for (gold_answer, gold_scores) in zip(golds, scores):
+            update_answer(metrics, answer, gold_answer, gold_scores)
 
     N = len(prediction)
     for k in metrics.keys():
         metrics[k] /= N
 
-    print(metrics)
+    return metrics
+
+_GOLD_ANSWERS = None
+
+def _set_gold(gold_answers):
+    global _GOLD_ANSWERS
+    _GOLD_ANSWERS = gold_answers
+
+def _score_file(prediction_file):
+    prediction = load_predictions(prediction_file)
+    report_ids(prediction, _GOLD_ANSWERS, '{}: '.format(prediction_file))
+    return prediction_file, score(prediction, _GOLD_ANSWERS)
+
+def eval_files(prediction_files, gold_file, processes=1):
+    """Metrics of each prediction file against the gold file, loaded once, keyed by file."""
+    gold_answers = load_gold(gold_file)
+    if processes > 1 and len(prediction_files) > 1:
+        with Pool(min(processes, len(prediction_files)), initializer=_set_gold, initargs=(gold_answers,)) as pool:
+            return dict(pool.map(_score_file, prediction_files, chunksize=1))
+    _set_gold(gold_answers)
+    return dict(_score_file(prediction_file) for prediction_file in prediction_files)
+
+def write_table(table, out_file):
+    """Writes the metrics of eval_files as CSV (one row per file) if out_file ends with .csv, as JSON otherwise."""
+    with open(out_file, 'w', newline='') as f:
+        if not out_file.endswith('.csv'):
+            json.dump(table, f, indent=2)
+            return
+        writer = csv.writer(f)
+        keys = list(next(iter(table.values())).keys()) if table else []
+        writer.writerow(['file'] + keys)
+        for (prediction_file, metrics) in table.items():
+            writer.writerow([prediction_file] + [metrics[k] for k in keys])
 
 if __name__ == '__main__':
-    eval(sys.argv[1], sys.argv[2])
+    parser = argparse.ArgumentParser()
+    parser.add_argument('prediction_file', nargs='+', help='prediction files or globs; several are scored against the gold file loaded once')
+    parser.add_argument('gold_file')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='score the predictions across this many processes (the files, when there are several)')
+    parser.add_argument('--out-file', help='write a table of the metrics keyed by prediction file (CSV if it ends with .csv, JSON otherwise)')
+    args = parser.parse_args()
+    prediction_files = [f for pattern in args.prediction_file for f in (sorted(glob.glob(pattern)) or [pattern])]
+    if len(prediction_files) == 1 and not args.out_file:
+        eval(prediction_files[0], args.gold_file, args.processes)
+    else:
+        table = eval_files(prediction_files, args.gold_file, args.processes)
+        if args.out_file:
+            write_table(table, args.out_file)
+        else:
+            print(table)
 
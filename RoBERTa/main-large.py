@@ -1,16 +1,15 @@
 import os
-import torch
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
 from tqdm import tqdm, trange
-from transformers import (AdamW, AutoConfig, AutoTokenizer, get_linear_schedule_with_warmup)
-from processors.coqa import Extract_Features, Processor, Result
-from processors.metrics import get_predictions
-from transformers import RobertaModel, RobertaTokenizer, RobertaConfig
-import torch
-import torch.nn as nn
-import torch.nn.functional as F
-from torch.nn import CrossEntropyLoss
-import getopt,sys
+from processors.coqa import Extract_Features, Processor, Result, eval_batches, feature_span_masks, get_span_candidates, iter_features, span_candidates
+from processors.metrics import decode_results, get_predictions, write_predictions
+from processors.checkpoint import strip_shadow_backbone
+import functools,getopt,sys,time
+from processors.options import DEFAULT_KEEP_CHECKPOINTS, DEFAULT_LOG_STEPS, DEFAULT_SAVE_STEPS, check_eval_options, parse_log_steps, parse_positive, parse_profile_window
+from processors.run_report import RUN_REPORT_FILE, run_report
+from processors.logit_store import check_decode_configs, load_results, logits_file, parse_decode_configs, save_results
+from processors.prediction_writer import prediction_path
+from processors.pipeline import Pipeline
+from processors.paired import PairedDeltas
 
 train_file="coqa-train-v1.0.json"
 predict_file="coqa-dev-v1.0.json"
@@ -19,216 +18,394 @@ pretrained_model="roberta-large"
 epochs = 1.0
 evaluation_batch_size = 16
 train_batch_size = 4
-MIN_FLOAT = -1e30
-
-class RobertaLargeModel(RobertaModel):
-    def __init__(self,config, load_pre = False):
-        super(RobertaLargeModel,self).__init__(config)
-        self.roberta = RobertaModel.from_pretrained(pretrained_model, config=config,) if load_pre else RobertaModel(config)
-        hidden_size = config.hidden_size
-        self.fc = nn.Linear(hidden_size,hidden_size, bias = False)
-        self.fc2 = nn.Linear(hidden_size,hidden_size, bias = False)
-        self.rationale_modelling = nn.Linear(hidden_size,1, bias = False)
-        self.attention_modelling = nn.Linear(hidden_size,1, bias = False)
-        self.span_modelling = nn.Linear(hidden_size,2,bias = False)
-        self.unk_modelling = nn.Linear(2*hidden_size,1, bias = False)
-        self.yes_no_modelling = nn.Linear(2*hidden_size,2, bias = False)
-        self.relu = nn.ReLU()
-        self.beta = 5.0
-
-    def forward(self,input_ids,segment_ids=None,input_masks=None,start_positions=None,end_positions=None,rationale_mask=None,cls_idx=None):
-        #RoBERTa outputs
-        outputs = self.roberta(input_ids,attention_mask=input_masks)
-        output_vector, roberta_pooled_output = outputs
-
-        start_end_logits = self.span_modelling(output_vector)
-        start_logits, end_logits = start_end_logits.split(1, dim=-1)
-        start_logits, end_logits = start_logits.squeeze(-1), end_logits.squeeze(-1)
-        #Rationale modelling 
-        rationale_logits = self.relu(self.fc(output_vector))
-        rationale_logits = self.rationale_modelling(rationale_logits)
-        rationale_logits = torch.sigmoid(rationale_logits)
-
-        output_vector = output_vector * rationale_logits
-
-        attention  = self.relu(self.fc2(output_vector))
-        attention  = (self.attention_modelling(attention)).squeeze(-1)
-        input_masks = input_masks.type(attention.dtype)
-        attention = attention*input_masks + (1-input_masks)*MIN_FLOAT
-        attention = F.softmax(attention, dim=-1)
-        attention_pooled_output = (attention.unsqueeze(-1) * output_vector).sum(dim=-2)
-        cls_output = torch.cat((attention_pooled_output,roberta_pooled_output),dim = -1)
-
-        rationale_logits = rationale_logits.squeeze(-1)
-
-        unk_logits = self.unk_modelling(cls_output)
-        yes_no_logits = self.yes_no_modelling(cls_output)
-        yes_logits, no_logits = yes_no_logits.split(1, dim=-1)
-
-
-        if self.training:
-            start_positions, end_positions = start_positions + cls_idx, end_positions + cls_idx
-            start = torch.cat((yes_logits, no_logits, unk_logits, start_logits), dim=-1)
-            end = torch.cat((yes_logits, no_logits, unk_logits, end_logits), dim=-1)
-
-            Entropy_loss = CrossEntropyLoss()
-            start_loss = Entropy_loss(start, start_positions)
-            end_loss = Entropy_loss(end, end_positions)
-
-            rationale_positions = rationale_mask.type(attention.dtype)
-            rationale_loss = -rationale_positions*torch.log(rationale_logits + 1e-8) - (1-rationale_positions)*torch.log(1-rationale_logits + 1e-8)
-
-            rationale_loss = torch.mean(rationale_loss)
-            total_loss = (start_loss + end_loss) / 2.0 + rationale_loss * self.beta
-
-            return total_loss
-        return start_logits, end_logits, yes_logits, no_logits, unk_logits
+n_best_size = 20
+max_answer_length = 30
+#   dataset types evaluated together by --paired, the original first
+PAIRED_DATASET_TYPES = [None, 'RG']
+
+
+def load_model_class():
+    #   imported to train or evaluate only: --help loads neither torch nor transformers and --decode not the model
+    from models import RobertaLargeModel
+    return RobertaLargeModel
+
 
 def convert_to_list(tensor):
     return tensor.detach().cpu().tolist()
 
-def train(train_dataset, model, tokenizer, device, output_directory):
+def train(train_dataset, model, tokenizer, device, output_directory, profile = None, log_steps = DEFAULT_LOG_STEPS, resume = False, save_steps = DEFAULT_SAVE_STEPS, keep_checkpoints = DEFAULT_KEEP_CHECKPOINTS):
+    from torch.utils.data import DataLoader
+    from transformers import AdamW, get_linear_schedule_with_warmup
+    from processors.profiling import StepProfiler, labelled, record_function
+    from processors.telemetry import TrainTelemetry
+    from processors.train_checkpoint import Checkpoints, ResumableRandomSampler
 
-    train_sampler = RandomSampler(train_dataset) 
+    train_sampler = ResumableRandomSampler(train_dataset)
     train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=train_batch_size)
     t_total = len(train_dataloader) // 1 * epochs
     optimizer_parameters = [{"params": [p for n, p in model.named_parameters() if not any(nd in n for nd in ["bias", "LayerNorm.weight"])],"weight_decay": 0.01,},
                             {"params": [p for n, p in model.named_parameters() if any(nd in n for nd in ["bias", "LayerNorm.weight"])], "weight_decay": 0.0}]
     optimizer = AdamW(optimizer_parameters,lr=1e-5, eps=1e-8)
     scheduler = get_linear_schedule_with_warmup(optimizer, num_warmup_steps=2000, num_training_steps=t_total)
-    if os.path.isfile(os.path.join(pretrained_model, "optimizer.pt")) and os.path.isfile(os.path.join(pretrained_model, "scheduler.pt")):
-        optimizer.load_state_dict(torch.load(
-            os.path.join(pretrained_model, "optimizer.pt")))
-        scheduler.load_state_dict(torch.load(
-            os.path.join(pretrained_model, "scheduler.pt")))
-
-    counter = 1
-    epochs_trained = 0
-    train_loss, loss = 0.0, 0.0
+    checkpoints = Checkpoints(output_directory, train_sampler, save_steps, keep_checkpoints)
+    global_step, epochs_trained = checkpoints.resume(model, optimizer, scheduler) if resume else (0, 0)
+
     model.zero_grad()
+    model.train()
     iterator = trange(epochs_trained, int(epochs), desc="Epoch", disable=False)
-    for _ in iterator:
-        epoch_iterator = tqdm(train_dataloader, desc="Iteration", disable=False)
-        for i,batch in enumerate(epoch_iterator):
-            model.train()
-            batch = tuple(t.to(device) for t in batch)
-            inputs = { "input_ids": batch[0],"segment_ids": None,
-                  "input_masks": batch[2],"start_positions": batch[3],
-                  "end_positions": batch[4],"rationale_mask": batch[5],"cls_idx": batch[6]}
-            loss = model(**inputs)
-            loss.backward()
-            train_loss += loss.item()
-            optimizer.step()
-            scheduler.step()  
-            model.zero_grad()
-            counter += 1
-            epoch_iterator.set_description("Loss :%f" % (train_loss/(4*counter)))
-            epoch_iterator.refresh()
-
-            if counter % 1000 == 0:
-                output_dir = os.path.join(output_directory, "model_weights")
-                if not os.path.exists(output_dir):
-                    os.makedirs(output_dir)
-                model_to_save = model.module if hasattr(model, "module") else model
-                model_to_save.save_pretrained(output_dir)
-                tokenizer.save_pretrained(output_dir)
-                torch.save(optimizer.state_dict(), os.path.join(output_dir, "optimizer.pt"))
-                torch.save(scheduler.state_dict(), os.path.join(output_dir, "scheduler.pt"))
-    return train_loss/counter
-
-def Write_predictions(model, tokenizer, device, dataset_type = None, output_directory = None, use_gpt = None):
-    dataset, examples, features = load_dataset(tokenizer, evaluate=True,dataset_type = dataset_type, use_gpt = use_gpt)
+    with StepProfiler(profile, output_directory, "train") as profiler, TrainTelemetry(model, optimizer, output_directory, log_steps, global_step) as telemetry, checkpoints:
+        for epoch in iterator:
+            train_sampler.set_epoch(epoch)
+            epoch_iterator = tqdm(train_dataloader, desc="Iteration", disable=False)
+            for i,batch in enumerate(labelled(telemetry.batches(checkpoints.batches(epoch_iterator)))):
+                #   counted on the host before the copy; input_masks is 1 on tokens
+                samples, tokens = batch[0].size(0), int(batch[2].sum())
+                with record_function("to_device"):
+                    batch = tuple(t.to(device) for t in batch)
+                inputs = { "input_ids": batch[0],"segment_ids": None,
+                      "input_masks": batch[2],"start_positions": batch[3],
+                      "end_positions": batch[4],"rationale_mask": batch[5],"cls_idx": batch[6]}
+                with record_function("forward"):
+                    loss = model(**inputs)
+                with record_function("backward"):
+                    loss.backward()
+                with record_function("telemetry"):
+                    record = telemetry.step(loss, samples, tokens)
+                with record_function("optimizer"):
+                    optimizer.step()
+                    scheduler.step()  
+                    model.zero_grad()
+                global_step += 1
+                if record is not None:
+                    epoch_iterator.set_description("Loss :%f" % record["loss"])
+                    epoch_iterator.refresh()
+                profiler.step()
+                checkpoints.step(global_step, model, tokenizer, optimizer, scheduler)
+    return telemetry.mean_loss()
+
+def Infer_batch(model, batch, batch_features, device, device_decode = False):
+    #   runs one evaluation batch (input_ids, segment_ids, input_masks) through the model, one Result per feature
+    from processors.runtime import inference_mode
+    from processors.profiling import record_function
+    model.eval()
+    with record_function("to_device"):
+        batch = tuple(t.to(device) for t in batch)
+    results = []
+    with inference_mode():
+        inputs = {"input_ids": batch[0],"segment_ids": batch[1],"input_masks": batch[2]}
+        with record_function("forward"):
+            outputs = model(**inputs)
+        if device_decode:
+            with record_function("span_candidates"):
+                context_mask, max_context_mask = feature_span_masks(batch_features, batch[0].size(1))
+                candidates = span_candidates(outputs[0], outputs[1], context_mask.to(device), max_context_mask.to(device), n_best_size, max_answer_length)
+    with record_function("to_host"):
+        if device_decode:
+            #   only the n-best start/end candidates and the yes/no/unk logits are moved to the host
+            candidates = [convert_to_list(candidate) for candidate in candidates]
+            yes_logits, no_logits, unk_logits = [convert_to_list(output) for output in outputs[2:]]
+            for (i, eval_feature) in enumerate(batch_features):
+                unique_id = int(eval_feature.unique_id)
+                feature_candidates = get_span_candidates(*[candidate[i] for candidate in candidates])
+                results.append(Result(unique_id=unique_id, start_logits=None, end_logits=None, yes_logits=yes_logits[i], no_logits=no_logits[i], unk_logits=unk_logits[i], span_candidates=feature_candidates))
+        else:
+            for (i, eval_feature) in enumerate(batch_features):
+                unique_id = int(eval_feature.unique_id)
+                output = [convert_to_list(output[i]) for output in outputs]
+                start_logits, end_logits, yes_logits, no_logits, unk_logits = output
+                results.append(Result(unique_id=unique_id, start_logits=start_logits, end_logits=end_logits, yes_logits=yes_logits, no_logits=no_logits, unk_logits=unk_logits))
+    return results
+
+
+def Write_predictions(model, tokenizer, device, dataset_type = None, output_directory = None, use_gpt = None, device_decode = False, jsonl = False, nbest = False, examples = None, tag = None, profile = None):
+    #   examples already loaded and a tag naming the output files come from Multi_predictions
+    from torch.utils.data import DataLoader, SequentialSampler
+    from processors.runtime import report_throughput
+    from processors.profiling import StepProfiler, labelled
+    dataset, examples, features = load_dataset(tokenizer, evaluate=True,dataset_type = dataset_type, use_gpt = use_gpt, examples = examples)
 
     if not os.path.exists(output_directory):
         os.makedirs(output_directory)
     evalutation_sampler = SequentialSampler(dataset)
     evaluation_dataloader = DataLoader(dataset, sampler=evalutation_sampler, batch_size=evaluation_batch_size)
     mod_results = []
-    for batch in tqdm(evaluation_dataloader, desc="Evaluating"):
-        model.eval()
-        batch = tuple(t.to(device) for t in batch)
-        with torch.no_grad():
-            inputs = {"input_ids": batch[0],"segment_ids": batch[1],"input_masks": batch[2]}
-            example_indices = batch[3]
-            outputs = model(**inputs)
-        for i, example_index in enumerate(example_indices):
-            eval_feature = features[example_index.item()]
-            unique_id = int(eval_feature.unique_id)
-            output = [convert_to_list(output[i]) for output in outputs]
-            start_logits, end_logits, yes_logits, no_logits, unk_logits = output
-            result = Result(unique_id=unique_id, start_logits=start_logits, end_logits=end_logits, yes_logits=yes_logits, no_logits=no_logits, unk_logits=unk_logits)
-            mod_results.append(result)
-
-    output_prediction_file = os.path.join(output_directory, "predictions-gpt.json")
+    start_time = time.time()
+    with run_report.stage("infer", "results", tag = tag) as stage:
+        with StepProfiler(profile, output_directory, "eval" if tag is None else f"eval_{tag}") as profiler:
+            for batch in labelled(tqdm(evaluation_dataloader, desc="Evaluating")):
+                batch_features = [features[example_index] for example_index in convert_to_list(batch[3])]
+                mod_results.extend(Infer_batch(model, batch[:3], batch_features, device, device_decode))
+                profiler.step()
+        stage["items"] = len(mod_results)
+    report_throughput(len(features), time.time() - start_time, device)
+    save_results(os.path.join(output_directory, logits_file(tag)), mod_results, settings = {"n_best_size": n_best_size, "max_answer_length": max_answer_length})
+
+    output_prediction_file = prediction_path(os.path.join(output_directory, "predictions-gpt.json" if tag is None else f"predictions_{tag}.json"), jsonl)
+    output_nbest_file = os.path.join(output_directory, "nbest_predictions.jsonl" if tag is None else f"nbest_predictions_{tag}.jsonl") if nbest else None
     #output_prediction_file = os.path.join(output_directory, "predictions-wc-var3.json")
-    get_predictions(examples, features, mod_results, 20, 30, True, output_prediction_file, False, tokenizer)
+    with run_report.stage("decode", "predictions", tag = tag) as stage:
+        get_predictions(examples, features, mod_results, n_best_size, max_answer_length, True, output_prediction_file, False, tokenizer, output_nbest_file = output_nbest_file)
+        stage["items"] = len(examples)
+
+
+def Decode_predictions(tokenizer, decode_configs, dataset_type = None, output_directory = None, use_gpt = None, jsonl = False, nbest = False, examples = None, tag = None):
+    #   re-decodes the outputs stored by Write_predictions with each of decode_configs, without the model; examples
+    #   already loaded and the tag of the outputs of one of several evaluations come from Multi_decode_predictions
+    if examples is None:
+        examples = load_examples(evaluate=True, dataset_type = dataset_type, use_gpt = use_gpt)
+    with run_report.stage("features", "features") as stage:
+        #   the features of load_dataset, without the tensors only the model reads
+        feature_groups = iter_features(examples, tokenizer, max_seq_length=512, doc_stride=128, max_query_length=64, threads=12)
+        features = [feature for example_features in feature_groups for feature in example_features]
+        stage["items"] = len(features)
+    results_file = os.path.join(output_directory, logits_file(tag))
+    mod_results = load_results(results_file, Result)
+    check_decode_configs(results_file, mod_results, decode_configs)
+    name = "predictions" if tag is None else f"predictions_{tag}"
+    for (i, decode_config) in enumerate(decode_configs):
+        output_prediction_file = prediction_path(os.path.join(output_directory, f"{name}-decode{i}.json"), jsonl)
+        output_nbest_file = os.path.join(output_directory, f"nbest_{name}-decode{i}.jsonl") if nbest else None
+        print(f"Decoding with {decode_config} into {output_prediction_file}")
+        with run_report.stage("decode", "predictions", tag = tag, config = i) as stage:
+            get_predictions(examples, features, mod_results, decode_config["n_best_size"], decode_config["max_answer_length"], True, output_prediction_file, False, tokenizer,
+                            class_score_scale = decode_config["class_score_scale"], confirm = decode_config["confirm"], output_nbest_file = output_nbest_file)
+            stage["items"] = len(examples)
+
+def Multi_decode_predictions(tokenizer, decode_configs, dataset_types, output_directory = None, jsonl = False, nbest = False):
+    #   --decode with several --eval types: the outputs Multi_predictions stored for each of them (eval_logits_O.npz
+    #   etc.) are re-decoded into predictions_O-decode0.json etc., with the stories parsed once for all of them
+    for (dataset_type, examples) in zip(dataset_types, load_examples_by_type(dataset_types)):
+        Decode_predictions(tokenizer, decode_configs, dataset_type = dataset_type, output_directory = output_directory, jsonl = jsonl, nbest = nbest, examples = examples, tag = dataset_type or "O")
+
+
+def Pipeline_predictions(model, tokenizer, device, dataset_type = None, output_directory = None, use_gpt = None, device_decode = False, jsonl = False, nbest = False, examples = None, tag = None):
+    #   Write_predictions with its stages running concurrently: features of the next examples are extracted while a
+    #   batch is in the model and the examples before it are decoded and written. Same batches, same predictions.
+    from processors.runtime import report_throughput
+    if examples is None:
+        examples = load_examples(evaluate=True, dataset_type = dataset_type, use_gpt = use_gpt)
 
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+    mod_results = []
+
+    def featurize(examples):
+        feature_groups = iter_features(examples, tokenizer, max_seq_length=512, doc_stride=128, max_query_length=64, threads=12)
+        return eval_batches(feature_groups, evaluation_batch_size)
+
+    def infer(batches):
+        for (batch_features, batch) in batches:
+            batch_results = Infer_batch(model, batch, batch_features, device, device_decode)
+            mod_results.extend(batch_results)
+            yield list(zip(batch_features, batch_results))
+
+    def decode(batches):
+        feature_results = (feature_result for batch_feature_results in batches for feature_result in batch_feature_results)
+        return decode_results(examples, feature_results, n_best_size, max_answer_length, True, False, tokenizer)
+
+    eval_pipeline = Pipeline([("featurize", featurize), ("infer", infer), ("decode", decode)])
+    output_prediction_file = prediction_path(os.path.join(output_directory, "predictions-gpt.json" if tag is None else f"predictions_{tag}.json"), jsonl)
+    output_nbest_file = os.path.join(output_directory, "nbest_predictions.jsonl" if tag is None else f"nbest_predictions_{tag}.jsonl") if nbest else None
+    start_time = time.time()
+    with run_report.stage("pipeline", "predictions", tag = tag) as stage:
+        write_predictions(tqdm(eval_pipeline.run(examples), total=len(examples), desc="Evaluating"), output_prediction_file, True, output_nbest_file)
+        stage["items"] = len(examples)
+    report_throughput(len(mod_results), time.time() - start_time, device)
+    eval_pipeline.report()
+    save_results(os.path.join(output_directory, logits_file(tag)), mod_results, settings = {"n_best_size": n_best_size, "max_answer_length": max_answer_length})
+
+
+def Multi_predictions(predict, model, tokenizer, device, dataset_types, output_directory = None, device_decode = False, jsonl = False, nbest = False):
+    #   --eval with several dataset types, e.g. O,TS,RG: the model is loaded once by manager and the stories are parsed
+    #   once for all of them; predict (Write_predictions or Pipeline_predictions) then writes predictions_O.json etc.
+    start_time = time.time()
+    all_examples = load_examples_by_type(dataset_types)
+    print(f"Parsed the stories once for {len(dataset_types)} evaluations in {time.time() - start_time:.1f}s")
+    for (dataset_type, examples) in zip(dataset_types, all_examples):
+        name = dataset_type or "O"
+        start_time = time.time()
+        predict(model, tokenizer, device, dataset_type = dataset_type, output_directory = output_directory, device_decode = device_decode, jsonl = jsonl, nbest = nbest, examples = examples, tag = name)
+        print(f"Evaluation {name}: {len(examples)} examples in {time.time() - start_time:.1f}s")
+
+
+def Paired_predictions(model, tokenizer, device, output_directory = None, device_decode = False, jsonl = False, nbest = False):
+    #   --eval O and --eval RG in one run: the stories are parsed once for both, the features of both go through the
+    #   model in the same batches, and the differences between the two answers to each question are streamed to
+    #   paired_deltas.jsonl as the RG predictions are decoded. Each dataset gets the predictions file of its own eval.
+    from torch.utils.data import DataLoader, SequentialSampler
+    from processors.runtime import report_throughput
+    paired_examples = load_examples_by_type(PAIRED_DATASET_TYPES)
+    examples = [example for dataset_examples in paired_examples for example in dataset_examples]
+    with run_report.stage("features", "features") as stage:
+        features, dataset = Extract_Features(examples=examples,
+                tokenizer=tokenizer,max_seq_length=512, doc_stride=128, max_query_length=64, is_training=False, threads=12)
+        stage["items"] = len(features)
 
-def load_dataset(tokenizer, evaluate=False, dataset_type = None, use_gpt = None):
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+    evaluation_dataloader = DataLoader(dataset, sampler=SequentialSampler(dataset), batch_size=evaluation_batch_size)
+    mod_results = []
+    start_time = time.time()
+    with run_report.stage("infer", "results") as stage:
+        for batch in tqdm(evaluation_dataloader, desc="Evaluating"):
+            batch_features = [features[example_index] for example_index in convert_to_list(batch[3])]
+            mod_results.extend(Infer_batch(model, batch[:3], batch_features, device, device_decode))
+        stage["items"] = len(mod_results)
+    report_throughput(len(features), time.time() - start_time, device)
+
+    feature_results = list(zip(features, mod_results))
+    first_example = 0
+    with PairedDeltas(os.path.join(output_directory, "paired_deltas.jsonl")) as deltas:
+        for (dataset_type, dataset_examples) in zip(PAIRED_DATASET_TYPES, paired_examples):
+            name = dataset_type or "O"
+            last_example = first_example + len(dataset_examples)
+            dataset_results = [(feature, result) for (feature, result) in feature_results if first_example <= feature.example_index < last_example]
+            decoded = decode_results(dataset_examples, dataset_results, n_best_size, max_answer_length, True, False, tokenizer)
+            output_prediction_file = prediction_path(os.path.join(output_directory, f"predictions_{name}.json"), jsonl)
+            output_nbest_file = os.path.join(output_directory, f"nbest_predictions_{name}.jsonl") if nbest else None
+            with run_report.stage("decode", "predictions", tag = name) as stage:
+                write_predictions(tqdm(deltas.track(decoded, name), total=len(dataset_examples), desc=f"Writing {name} predictions"), output_prediction_file, True, output_nbest_file)
+                stage["items"] = len(dataset_examples)
+            first_example = last_example
+    deltas.report()
+    deltas.save_summary(os.path.join(output_directory, "paired_summary.json"))
+
+
+def load_examples(evaluate=False, dataset_type = None, use_gpt = None):
     input_dir = "data"
     print("Creating features from dataset file at", input_dir)
 
     if ((evaluate and not predict_file) or (not evaluate and not train_file)):
         raise ValueError("predict_file or train_file name not found")
     else:
-        processor = Processor()
-        if evaluate:
-            examples = processor.get_examples("data", 2,filename=predict_file, threads=12, dataset_type = dataset_type, use_gpt = use_gpt)
-            #examples = processor.get_examples("data", 0,filename=predict_file, threads=12, dataset_type = dataset_type)
-        else:
-            examples = []
-            for datas in dataset_type:
-                examples.extend(processor.get_examples("data", 2,filename=train_file, threads=12,dataset_type = datas))
-
-    features, dataset = Extract_Features(examples=examples,
-            tokenizer=tokenizer,max_seq_length=512, doc_stride=128, max_query_length=64, is_training=not evaluate, threads=12)
+        with run_report.stage("preprocess", "examples") as stage:
+            processor = Processor()
+            if evaluate:
+                examples = processor.get_examples("data", 2,filename=predict_file, threads=12, dataset_type = dataset_type, use_gpt = use_gpt)
+                #examples = processor.get_examples("data", 0,filename=predict_file, threads=12, dataset_type = dataset_type)
+            else:
+                examples = []
+                for datas in dataset_type:
+                    examples.extend(processor.get_examples("data", 2,filename=train_file, threads=12,dataset_type = datas))
+            stage["items"] = len(examples)
+    return examples
+
+
+def load_examples_by_type(dataset_types):
+    print(f"Creating features of {dataset_types} from dataset file at data")
+    processor = Processor()
+    with run_report.stage("preprocess", "examples") as stage:
+        all_examples = processor.get_paired_examples("data", 2, filename=predict_file, threads=12, dataset_types = dataset_types)
+        stage["items"] = sum(len(examples) for examples in all_examples)
+    return all_examples
+
+
+def load_dataset(tokenizer, evaluate=False, dataset_type = None, use_gpt = None, examples = None):
+    if examples is None:
+        examples = load_examples(evaluate, dataset_type = dataset_type, use_gpt = use_gpt)
+    with run_report.stage("features", "features") as stage:
+        features, dataset = Extract_Features(examples=examples,
+                tokenizer=tokenizer,max_seq_length=512, doc_stride=128, max_query_length=64, is_training=not evaluate, threads=12)
+        stage["items"] = len(features)
     if evaluate:
         return dataset, examples, features
     return dataset
 
 
-def manager(isTraining, dataset_type, output_directory, use_gpt = None):
-    assert torch.cuda.is_available()
-    device = torch.device('cuda')
-    config = RobertaConfig.from_pretrained(pretrained_model)
-
+def manager(isTraining, dataset_type, output_directory, use_gpt = None, device = None, device_decode = False, decode_configs = None, jsonl = False, nbest = False, pipeline = False, paired = False, profile = None, log_steps = DEFAULT_LOG_STEPS, resume = False, save_steps = DEFAULT_SAVE_STEPS, keep_checkpoints = DEFAULT_KEEP_CHECKPOINTS):
     if isTraining:
+        import torch
+        from transformers import RobertaConfig, RobertaTokenizer
+        from processors.runtime import setup_device
+        device = setup_device(device)
+        config = RobertaConfig.from_pretrained(pretrained_model)
         tokenizer = RobertaTokenizer.from_pretrained(pretrained_model)
-        model = RobertaLargeModel(config, load_pre = True)
+        model = load_model_class()(config, pretrained_model = pretrained_model)
         model.to(device)
-        if os.path.exists(output_directory):
-            raise ValueError(f"Output directory {output_directory}  already exists, Change output_directory name")
+        if os.path.exists(output_directory) and os.listdir(output_directory) and not resume:
+            raise ValueError(f"Output directory {output_directory}  already exists, Change output_directory name, or pass --resume to resume training in it")
         else:
-            os.makedirs(output_directory)
+            os.makedirs(output_directory, exist_ok = True)
         
         train_dataset = load_dataset(tokenizer, evaluate=False, dataset_type = dataset_type)
-        train_loss = train(train_dataset, model, tokenizer, device, output_directory)
+        train_loss = train(train_dataset, model, tokenizer, device, output_directory, profile = profile, log_steps = log_steps, resume = resume, save_steps = save_steps, keep_checkpoints = keep_checkpoints)
         tokenizer.save_pretrained(output_directory)
         torch.save(model.state_dict(), os.path.join(output_directory,'tweights.pt'))
 
+    elif decode_configs:
+        #   no model and no device: the outputs stored by the eval are decoded on the host
+        from transformers import RobertaTokenizer
+        tokenizer = RobertaTokenizer.from_pretrained(output_directory, do_lower_case=True)
+        if len(dataset_type) > 1:
+            Multi_decode_predictions(tokenizer, decode_configs, dataset_type, output_directory = output_directory, jsonl = jsonl, nbest = nbest)
+            return
+        Decode_predictions(tokenizer, decode_configs, dataset_type = dataset_type[0], output_directory = output_directory, use_gpt = use_gpt, jsonl = jsonl, nbest = nbest)
     else:
-        model = RobertaLargeModel(config)
-        model.load_state_dict(torch.load(os.path.join(output_directory,'tweights.pt')))
+        import torch
+        from transformers import RobertaConfig, RobertaTokenizer
+        from processors.runtime import setup_device
+        device = setup_device(device)
+        config = RobertaConfig.from_pretrained(pretrained_model)
+        model = load_model_class()(config)
+        state_dict, _ = strip_shadow_backbone(torch.load(os.path.join(output_directory,'tweights.pt'), map_location=device), "roberta")
+        model.load_state_dict(state_dict)
         model.to(device)
         tokenizer = RobertaTokenizer.from_pretrained(output_directory, do_lower_case=True)
-        Write_predictions(model, tokenizer, device, dataset_type = dataset_type[0], output_directory = output_directory, use_gpt = use_gpt)
+        if paired:
+            Paired_predictions(model, tokenizer, device, output_directory = output_directory, device_decode = device_decode, jsonl = jsonl, nbest = nbest)
+            return
+        predict = Pipeline_predictions if pipeline else functools.partial(Write_predictions, profile = profile)
+        if len(dataset_type) > 1:
+            Multi_predictions(predict, model, tokenizer, device, dataset_type, output_directory = output_directory, device_decode = device_decode, jsonl = jsonl, nbest = nbest)
+            return
+        predict(model, tokenizer, device, dataset_type = dataset_type[0], output_directory = output_directory, use_gpt = use_gpt, device_decode = device_decode, jsonl = jsonl, nbest = nbest)
 
 def main():
     isTraining,isEval = False, False
     train_dataset_type, eval_dataset_type = [],[]
     output_directory = "Roberta"
+    use_gpt, device, threads, interop_threads = None, None, None, None
+    profile = None
+    log_steps = DEFAULT_LOG_STEPS
+    resume, save_steps, keep_checkpoints = False, DEFAULT_SAVE_STEPS, DEFAULT_KEEP_CHECKPOINTS
+    device_decode, decode_configs = False, None
+    jsonl, nbest, pipeline, paired = False, False, False, False
     argumentList = sys.argv[1:]
     options = "ht:e:o:"
-    long_options = ["help", "train=","eval=", "output=", "gpt="]
+    long_options = ["help", "train=","eval=", "output=", "gpt=", "device=", "threads=", "interop_threads=", "device_decode", "decode=", "jsonl", "nbest", "pipeline", "paired", "profile=", "log_steps=", "resume", "save_steps=", "keep_checkpoints="]
     try:
         arguments, values = getopt.getopt(argumentList, options, long_options)
         for currentArgument, currentValue in arguments:
-            if currentArgument in ("-h", "--Help"):
+            if currentArgument in ("-h", "--help"):
                 print ("""python main.py --train [O|C] --eval [O|TS|RG] --output [directory name]\n
                         --train O for original training C for combined training \n
                         --eval for eval on (O) original (TS) truncated and (RG) for TS-R dataset as defined in paper\n
+                        --eval O,TS,RG evaluates each of them with the model loaded and the stories parsed once,
+                        writing predictions_O.json, predictions_TS.json and predictions_RG.json\n
                         --output [dir_name] is the output directory to write weights and predictions in, 
                         and in case of eval to load weights from.
+                        --device [cuda|cpu] to run on (default cuda when available, cpu otherwise)
+                        --threads [n] --interop_threads [n] to size the intra-op/inter-op CPU thread pools
+                        --device_decode to select the n-best spans on the device and only move those to the host
+                        --decode "key=value,...;..." with --eval to re-decode the stored outputs of a previous eval once per
+                        ';'-separated config (n_best_size, max_answer_length, class_score_scale, confirm) without the model
+                        with --eval O,TS,RG, each type from the outputs its evaluation stored
+                        --jsonl to write predictions one compact JSON object per line (.jsonl) as they are decoded
+                        --nbest to also write the n-best answers of every question
+                        --pipeline to extract features, run the model and decode concurrently, with bounded queues
+                        between the stages and the time each stage was busy printed at the end; same predictions
+                        --paired to evaluate O and RG in one run (without --eval), writing predictions_O.json,
+                        predictions_RG.json and the per-question differences to paired_deltas.jsonl
+                        --profile [SKIP,]STEPS to record STEPS train or eval steps after the first SKIP (default 5)
+                        with the torch profiler: a Chrome trace (profile_train.json, profile_eval.json) and a
+                        per-operator table (.txt) in the output directory; not with --pipeline or --paired
+                        --log_steps K to log the mean loss, samples and tokens per second, data wait and compute
+                        time, learning rate and gradient norm of every K training steps (default 50) to
+                        train_telemetry.jsonl in the output directory
+                        --resume to resume training from the latest checkpoint in the output directory
+                        --save_steps N to write a checkpoint every N training steps (default 1000), in the
+                        background, to checkpoints/step-N in the output directory
+                        --keep_checkpoints N to keep the last N checkpoints (default 3)
                         e.g. python main.py --train C --eval RG --output Roberta_comb
                         for combined training followed by eval on RG and writing to ./Roberta_comb""")
                 return
@@ -243,8 +420,8 @@ def main():
                     return
             elif currentArgument in ("-e", "--eval"):
                 opts = {'O':[None],'TS':['TS'], 'RG':['RG']}
-                if currentValue in opts:
-                    eval_dataset_type = opts[currentValue]
+                if all(value in opts for value in currentValue.split(',')):
+                    eval_dataset_type = [opts[value][0] for value in currentValue.split(',')]
                     isEval = True
                 else:
                     print('See "python main.py --help" for usage')
@@ -253,13 +430,47 @@ def main():
                 output_directory = currentValue
             elif currentArgument in ("-gpt", "--gpt"):
                 use_gpt = currentValue
+            elif currentArgument == "--device":
+                device = currentValue
+            elif currentArgument == "--threads":
+                threads = int(currentValue)
+            elif currentArgument == "--interop_threads":
+                interop_threads = int(currentValue)
+            elif currentArgument == "--device_decode":
+                device_decode = True
+            elif currentArgument == "--decode":
+                decode_configs = parse_decode_configs(currentValue, {"n_best_size": n_best_size, "max_answer_length": max_answer_length, "class_score_scale": 2.0, "confirm": True})
+            elif currentArgument == "--jsonl":
+                jsonl = True
+            elif currentArgument == "--nbest":
+                nbest = True
+            elif currentArgument == "--profile":
+                profile = parse_profile_window(currentValue)
+            elif currentArgument == "--log_steps":
+                log_steps = parse_log_steps(currentValue)
+            elif currentArgument == "--resume":
+                resume = True
+            elif currentArgument == "--save_steps":
+                save_steps = parse_positive(currentArgument, currentValue)
+            elif currentArgument == "--keep_checkpoints":
+                keep_checkpoints = parse_positive(currentArgument, currentValue)
+            elif currentArgument == "--pipeline":
+                pipeline = True
+            elif currentArgument == "--paired":
+                paired, isEval = True, True
 
     except getopt.error as err:
         print (str(err))
 
+    check_eval_options(eval_dataset_type, paired = paired, pipeline = pipeline, profile = profile, decode_configs = decode_configs)
+    if threads or interop_threads:
+        from processors.runtime import set_threads
+        set_threads(threads, interop_threads)
     if isTraining:
-        manager(isTraining = True, dataset_type = train_dataset_type, output_directory = output_directory)
+        manager(isTraining = True, dataset_type = train_dataset_type, output_directory = output_directory, device = device, profile = profile, log_steps = log_steps, resume = resume, save_steps = save_steps, keep_checkpoints = keep_checkpoints)
     if isEval:
-        manager(isTraining = False, dataset_type = eval_dataset_type, output_directory = output_directory, use_gpt = use_gpt)
+        manager(isTraining = False, dataset_type = eval_dataset_type, output_directory = output_directory, use_gpt = use_gpt, device = device, device_decode = device_decode, decode_configs = decode_configs, jsonl = jsonl, nbest = nbest, pipeline = pipeline, paired = paired, profile = profile)
+    if isTraining or isEval:
+        run_report.save(os.path.join(output_directory, RUN_REPORT_FILE))
 if __name__ == "__main__":
     main()
@@ -0,0 +1,90 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn import CrossEntropyLoss
+from transformers import RobertaModel
+from transformers.modeling_roberta import RobertaPreTrainedModel
+from processors.profiling import record_function
+
+
+#   RobertaBaseModel, the model of main.py and main_hotpotqa.py, and RobertaLargeModel, of main-large.py and
+#   main_large_hotpotqa.py. The main scripts import them only to train or evaluate, so --help and --decode,
+#   which do without the model, do not load torch and transformers for them.
+
+MIN_FLOAT = -1e30
+
+
+class RobertaBaseModel(RobertaPreTrainedModel):
+    def __init__(self,config, pretrained_model = None):
+        #   pretrained_model: the name or directory of the RoBERTa weights to start from, random ones if None
+        super(RobertaBaseModel,self).__init__(config)
+        self.roberta = RobertaModel.from_pretrained(pretrained_model, config=config,) if pretrained_model else RobertaModel(config)
+        hidden_size = config.hidden_size
+        self.fc = nn.Linear(hidden_size,hidden_size, bias = False)
+        self.fc2 = nn.Linear(hidden_size,hidden_size, bias = False)
+        self.rationale_modelling = nn.Linear(hidden_size,1, bias = False)
+        self.attention_modelling = nn.Linear(hidden_size,1, bias = False)
+        self.span_modelling = nn.Linear(hidden_size,2,bias = False)
+        self.unk_modelling = nn.Linear(2*hidden_size,1, bias = False)
+        self.yes_no_modelling = nn.Linear(2*hidden_size,2, bias = False)
+        self.relu = nn.ReLU()
+        self.beta = 5.0
+
+    def forward(self,input_ids,segment_ids=None,input_masks=None,start_positions=None,end_positions=None,rationale_mask=None,cls_idx=None):
+        #RoBERTa outputs
+        with record_function("encoder"):
+            outputs = self.roberta(input_ids,attention_mask=input_masks)
+            output_vector, roberta_pooled_output = outputs
+
+        with record_function("span_head"):
+            start_end_logits = self.span_modelling(output_vector)
+            start_logits, end_logits = start_end_logits.split(1, dim=-1)
+            start_logits, end_logits = start_logits.squeeze(-1), end_logits.squeeze(-1)
+        #Rationale modelling 
+        with record_function("rationale_head"):
+            rationale_logits = self.relu(self.fc(output_vector))
+            rationale_logits = self.rationale_modelling(rationale_logits)
+            rationale_logits = torch.sigmoid(rationale_logits)
+
+            output_vector = output_vector * rationale_logits
+
+        with record_function("attention_pooling"):
+            attention  = self.relu(self.fc2(output_vector))
+            attention  = (self.attention_modelling(attention)).squeeze(-1)
+            input_masks = input_masks.type(attention.dtype)
+            attention = attention*input_masks + (1-input_masks)*MIN_FLOAT
+            attention = F.softmax(attention, dim=-1)
+            attention_pooled_output = (attention.unsqueeze(-1) * output_vector).sum(dim=-2)
+            cls_output = torch.cat((attention_pooled_output,roberta_pooled_output),dim = -1)
+
+        rationale_logits = rationale_logits.squeeze(-1)
+
+        with record_function("class_heads"):
+            unk_logits = self.unk_modelling(cls_output)
+            yes_no_logits = self.yes_no_modelling(cls_output)
+            yes_logits, no_logits = yes_no_logits.split(1, dim=-1)
+
+
+        if self.training:
+            with record_function("loss"):
+                start_positions, end_positions = start_positions + cls_idx, end_positions + cls_idx
+                start = torch.cat((yes_logits, no_logits, unk_logits, start_logits), dim=-1)
+                end = torch.cat((yes_logits, no_logits, unk_logits, end_logits), dim=-1)
+
+                Entropy_loss = CrossEntropyLoss()
+                start_loss = Entropy_loss(start, start_positions)
+                end_loss = Entropy_loss(end, end_positions)
+
+                rationale_positions = rationale_mask.type(attention.dtype)
+                rationale_loss = -rationale_positions*torch.log(rationale_logits + 1e-8) - (1-rationale_positions)*torch.log(1-rationale_logits + 1e-8)
+
+                rationale_loss = torch.mean(rationale_loss)
+                total_loss = (start_loss + end_loss) / 2.0 + rationale_loss * self.beta
+
+            return total_loss
+        return start_logits, end_logits, yes_logits, no_logits, unk_logits
+
+
+class RobertaLargeModel(RobertaBaseModel):
+    #   the architecture of RobertaBaseModel, at the size of the roberta-large config
+    pass
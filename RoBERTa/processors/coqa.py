@@ -7,9 +7,6 @@ import string
 from collections import Counter
 from functools import partial
 from multiprocessing import Pool, cpu_count
-import spacy
-import torch
-from torch.utils.data import TensorDataset
 from tqdm import tqdm
 from processors.utils import DataProcessor
 
@@ -46,6 +43,7 @@ class CoqaFeatures(object):
                  tokens,
                  token_to_orig_map,
                  token_is_max_context,
+                 token_to_orig_char,
                  input_ids,
                  input_mask,
                  segment_ids,
@@ -59,6 +57,9 @@ class CoqaFeatures(object):
         self.tokens = tokens
         self.token_to_orig_map = token_to_orig_map
         self.token_is_max_context = token_is_max_context
+        #   token index -> (start, end) characters inside its original word and the first token index of the run of
+        #   tokens that can be turned into answer text by position (see metrics._span_text); only for mappable tokens
+        self.token_to_orig_char = token_to_orig_char
         self.input_ids = input_ids
         self.input_mask = input_mask
         self.segment_ids = segment_ids
@@ -68,13 +69,76 @@ class CoqaFeatures(object):
         self.rational_mask = rational_mask
 
 class Result(object):
-    def __init__(self, unique_id, start_logits, end_logits, yes_logits, no_logits, unk_logits):
+    def __init__(self, unique_id, start_logits, end_logits, yes_logits, no_logits, unk_logits, span_candidates=None):
         self.unique_id = unique_id
         self.start_logits = start_logits
         self.end_logits = end_logits
         self.yes_logits = yes_logits
         self.no_logits = no_logits
         self.unk_logits = unk_logits
+        #   (start_index, end_index, score) of the valid n-best spans when decoding on device,
+        #   in which case start_logits/end_logits are not transferred and stay None.
+        self.span_candidates = span_candidates
+
+def feature_span_masks(features, max_seq_length):
+    """Boolean (num_features, max_seq_length) masks of context tokens and of max-context tokens."""
+    import torch
+    context_mask = torch.zeros((len(features), max_seq_length), dtype=torch.bool)
+    max_context_mask = torch.zeros((len(features), max_seq_length), dtype=torch.bool)
+    for (i, feature) in enumerate(features):
+        context_mask[i, list(feature.token_to_orig_map)] = True
+        max_context_mask[i, [index for index, is_max in feature.token_is_max_context.items() if is_max]] = True
+    return context_mask, max_context_mask
+
+def span_candidates(start_logits, end_logits, context_mask, max_context_mask, n_best_size, max_answer_length):
+    """n-best start/end candidates of a batch and the mask of valid (start, end) pairs, on the logits' device."""
+    import torch
+    start_top_logits, start_top_index = torch.topk(start_logits, n_best_size, dim=-1)
+    end_top_logits, end_top_index = torch.topk(end_logits, n_best_size, dim=-1)
+    start_is_valid = torch.gather(context_mask & max_context_mask, 1, start_top_index)
+    end_is_valid = torch.gather(context_mask, 1, end_top_index)
+    length = torch.unsqueeze(end_top_index, 1) - torch.unsqueeze(start_top_index, 2) + 1
+    valid = torch.unsqueeze(start_is_valid, 2) & torch.unsqueeze(end_is_valid, 1) & (length >= 1) & (length <= max_answer_length)
+    return start_top_logits, start_top_index, end_top_logits, end_top_index, valid
+
+def get_span_candidates(start_top_logits, start_top_index, end_top_logits, end_top_index, valid):
+    """Host-side list of (start_index, end_index, score) for one feature, in the order get_predictions scans them."""
+    candidates = []
+    for (i, start_index) in enumerate(start_top_index):
+        for (j, end_index) in enumerate(end_top_index):
+            if valid[i][j]:
+                candidates.append((start_index, end_index, start_top_logits[i] + end_top_logits[j]))
+    return candidates
+
+basic_tokenizer = None
+
+def _piece_char_offsets(word, sub_tokens, tokenizer):
+    """(start, end, joins_previous) of each BPE piece of word in characters of word, or None when the pieces cannot
+    be mapped back by position the way get_final_text maps them (cased pieces, partial characters, ...)."""
+    global basic_tokenizer
+    if basic_tokenizer is None:
+        from transformers.tokenization_bert import BasicTokenizer
+        basic_tokenizer = BasicTokenizer(do_lower_case=True)
+    basic_tokens = basic_tokenizer.tokenize(word)
+    basic_text = "".join(basic_tokens)
+    if not sub_tokens or len(basic_text) != len(word):
+        return None
+    boundaries, position = set(), 0
+    for basic_token in basic_tokens:
+        boundaries.add(position)
+        position += len(basic_token)
+
+    offsets, position = [], 0
+    for sub_token in sub_tokens:
+        surface = tokenizer.convert_tokens_to_string([sub_token])
+        if not surface or basic_text[position:position + len(surface)] != surface:
+            return None
+        #   pieces are joined without spaces, so only a piece inside a basic token reads the same as the basic text
+        offsets.append((position, position + len(surface), position not in boundaries))
+        position += len(surface)
+    if position != len(basic_text):
+        return None
+    return offsets
 
 def _improve_answer_span(doc_tokens, input_start, input_end, tokenizer, orig_answer_text):
     tok_answer_text = " ".join(tokenizer.tokenize(orig_answer_text))
@@ -229,7 +293,9 @@ class Processor(DataProcessor):
         else:
             return doc_tok
 
-    def get_examples(self, data_dir, history_len, filename=None, threads=1,dataset_type = None, attention = False):
+    def get_examples(self, data_dir, history_len, filename=None, threads=1,dataset_type = None, use_gpt = None, attention = False):
+        #   the --gpt rewrites are of HotpotQA only
+        assert not use_gpt
         if data_dir is None:
             data_dir = ""
 
@@ -249,10 +315,39 @@ class Processor(DataProcessor):
         examples = [item for sublist in examples for item in sublist]
         return examples
 
+    def get_paired_examples(self, data_dir, history_len, filename=None, threads=1, dataset_types = (None, 'RG'), attention = False):
+        """ Returns the examples of each of dataset_types, as get_examples would, parsing every story only once. """
+        if data_dir is None:
+            data_dir = ""
+
+        with open(
+                os.path.join(data_dir, self.train_file if filename is None else filename), "r", encoding="utf-8"
+        ) as reader:
+            input_data = json.load(reader)["data"]
+
+        threads = min(threads, cpu_count())
+        with Pool(threads) as p:
+            annotate_ = partial(self._create_paired_examples, history_len=history_len, dataset_types = dataset_types, attention = attention)
+            story_examples = list(tqdm(
+                p.imap(annotate_, input_data),
+                total=len(input_data),
+                desc="Preprocessing examples",
+            ))
+        return [[item for sublist in story_examples for item in sublist[t]] for t in range(len(dataset_types))]
+
     def _create_examples(self, input_data, history_len,dataset_type = None, attention = False):
+        import spacy
         nlp = spacy.load('en_core_web_sm', parser=False)
-        examples = []
-        datum = input_data
+        return self._story_examples(input_data, self._annotate_story(input_data, nlp), nlp, history_len, dataset_type, attention)
+
+    def _create_paired_examples(self, input_data, history_len, dataset_types, attention = False):
+        #   the spaCy parse of the story is shared by the examples of every dataset type
+        import spacy
+        nlp = spacy.load('en_core_web_sm', parser=False)
+        _datum = self._annotate_story(input_data, nlp)
+        return [self._story_examples(input_data, _datum, nlp, history_len, dataset_type, attention) for dataset_type in dataset_types]
+
+    def _annotate_story(self, datum, nlp):
         context_str = datum['story']
         _datum = {
             'context': context_str,
@@ -263,6 +358,10 @@ class Processor(DataProcessor):
         nlp_context = nlp(self.pre_proc(context_str))
         _datum['annotated_context'] = self.process(nlp_context)
         _datum['raw_context_offsets'] = self.get_raw_context_offsets(_datum['annotated_context']['word'], context_str)
+        return _datum
+
+    def _story_examples(self, datum, _datum, nlp, history_len, dataset_type = None, attention = False):
+        examples = []
         assert len(datum['questions']) == len(datum['answers'])
         additional_answers = {}
         if 'additional_answers' in datum:
@@ -381,7 +480,7 @@ def Extract_Feature_init(tokenizer_for_convert):
     global tokenizer
     tokenizer = tokenizer_for_convert
 
-def Extract_Feature(example, tokenizer, max_seq_length = 512, doc_stride = 128, max_query_length = 64):
+def Extract_Feature(example, tokenizer, max_seq_length = 512, doc_stride = 128, max_query_length = 64, is_training = False):
     features = []
     query_tokens = []
     for question_answer in example.question_text:
@@ -402,12 +501,16 @@ def Extract_Feature(example, tokenizer, max_seq_length = 512, doc_stride = 128,
     tok_to_orig_index = []
     orig_to_tok_index = []
     all_doc_tokens = []
+    tok_char_offsets = []
     for (i, token) in enumerate(example.doc_tokens):
         orig_to_tok_index.append(len(all_doc_tokens))
         sub_tokens = tokenizer.tokenize(token)
-        for sub_token in sub_tokens:
+        #   the character offsets are only read by get_final_text, when decoding an eval
+        piece_offsets = None if is_training else _piece_char_offsets(token, sub_tokens, tokenizer)
+        for (sub_token, offsets) in zip(sub_tokens, piece_offsets or [None] * len(sub_tokens)):
             tok_to_orig_index.append(i)
             all_doc_tokens.append(sub_token)
+            tok_char_offsets.append(offsets)
 
     tok_r_start_position = orig_to_tok_index[example.rational_start_position]
     if example.rational_end_position < len(example.doc_tokens) - 1:
@@ -446,6 +549,7 @@ def Extract_Feature(example, tokenizer, max_seq_length = 512, doc_stride = 128,
         tokens = []
         token_to_orig_map = {}
         token_is_max_context = {}
+        token_to_orig_char = {}
         tokens.append("<s>")
         for token in query_tokens:
             tokens.append(token)
@@ -459,6 +563,14 @@ def Extract_Feature(example, tokenizer, max_seq_length = 512, doc_stride = 128,
                                                    doc_span_index,
                                                    split_token_index)
             token_is_max_context[len(tokens)] = is_max_context
+            offsets = tok_char_offsets[split_token_index]
+            if offsets is not None:
+                #   a run continues over the previous token if it is mappable too and no original word lies between them
+                run_start = len(tokens)
+                if offsets[2] and len(tokens) - 1 in token_to_orig_char and \
+                        tok_to_orig_index[split_token_index] - tok_to_orig_index[split_token_index - 1] <= 1:
+                    run_start = token_to_orig_char[len(tokens) - 1][2]
+                token_to_orig_char[len(tokens)] = (offsets[0], offsets[1], run_start)
             tokens.append(all_doc_tokens[split_token_index])
         tokens.append("</s>")
 
@@ -523,6 +635,7 @@ def Extract_Feature(example, tokenizer, max_seq_length = 512, doc_stride = 128,
                          tokens=tokens,
                          token_to_orig_map=token_to_orig_map,
                          token_is_max_context=token_is_max_context,
+                         token_to_orig_char=token_to_orig_char,
                          input_ids=input_ids,
                          input_mask=input_mask,
                          segment_ids=segment_ids,
@@ -533,8 +646,9 @@ def Extract_Feature(example, tokenizer, max_seq_length = 512, doc_stride = 128,
     return features
 
 
-def Extract_Features(examples, tokenizer, max_seq_length, doc_stride, max_query_length, is_training,threads=1):
-    features = []
+def iter_features(examples, tokenizer, max_seq_length, doc_stride, max_query_length, threads=1, is_training=False):
+    """Yields the features of each example that has any, tagged with example_index and unique_id, as soon as the
+    worker pool has extracted them."""
     threads = min(threads, cpu_count())
     with Pool(threads, initializer=Extract_Feature_init, initargs=(tokenizer,)) as p:
         annotate_ = partial(
@@ -543,29 +657,45 @@ def Extract_Features(examples, tokenizer, max_seq_length, doc_stride, max_query_
             max_seq_length=max_seq_length,
             doc_stride=doc_stride,
             max_query_length=max_query_length,
+            is_training=is_training,
         )
-        features = list(
-            tqdm(
-                p.imap(annotate_, examples, chunksize=16),
-                total=len(examples),
-                desc="Extracting features from dataset",
-            )
-        )
+        unique_id = 1000000000
+        example_index = 0
+        for example_features in p.imap(annotate_, examples, chunksize=16):
+            if not example_features:
+                continue
+            for example_feature in example_features:
+                example_feature.example_index = example_index
+                example_feature.unique_id = unique_id
+                unique_id += 1
+            example_index += 1
+            yield example_features
+
+def eval_batches(feature_groups, batch_size):
+    """Packs the features yielded by iter_features into the batches a SequentialSampler DataLoader over the
+    evaluation dataset of Extract_Features produces, as (features, (input_ids, segment_ids, input_masks))."""
+    batch_features = []
+    for example_features in feature_groups:
+        batch_features.extend(example_features)
+        while len(batch_features) >= batch_size:
+            yield _eval_batch(batch_features[:batch_size])
+            batch_features = batch_features[batch_size:]
+    if batch_features:
+        yield _eval_batch(batch_features)
+
+def _eval_batch(features):
+    import torch
+    input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
+    input_mask = torch.tensor([f.input_mask for f in features], dtype=torch.long)
+    tokentype_ids = torch.tensor([f.segment_ids for f in features], dtype=torch.long)
+    return features, (input_ids, tokentype_ids, input_mask)
 
-    new_features = []
-    unique_id = 1000000000
-    example_index = 0
-    for example_features in tqdm(features, total=len(features), desc="Tag unique id to each example"):
-        if not example_features:
-            continue
-        for example_feature in example_features:
-            example_feature.example_index = example_index
-            example_feature.unique_id = unique_id
-            new_features.append(example_feature)
-            unique_id += 1
-        example_index += 1
-    features = new_features
-    del new_features
+def Extract_Features(examples, tokenizer, max_seq_length, doc_stride, max_query_length, is_training,threads=1):
+    import torch
+    from torch.utils.data import TensorDataset
+    feature_groups = iter_features(examples, tokenizer, max_seq_length, doc_stride, max_query_length, threads, is_training)
+    features = [feature for example_features in tqdm(feature_groups, total=len(examples), desc="Extracting features from dataset")
+                for feature in example_features]
     all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
     all_input_mask = torch.tensor([f.input_mask for f in features], dtype=torch.long)
     all_tokentype_ids = torch.tensor([f.segment_ids for f in features], dtype=torch.long)
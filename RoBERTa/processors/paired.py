@@ -0,0 +1,115 @@
+import json
+import re
+import string
+from collections import Counter
+
+from processors.metrics import answer_text
+from processors.prediction_writer import PredictionWriter
+
+
+#   Compares the answer to each question in the original dataset (O) with the answer to the same question once its
+#   rationale is removed (RG), as both are decoded in one eval (see --paired in the main scripts).
+
+def normalize_answer(s):
+    """Lower text and remove punctuation, articles and extra whitespace, as the CoQA evaluation does."""
+    exclude = set(string.punctuation)
+    s = ''.join(ch for ch in s.lower() if ch not in exclude)
+    return ' '.join(re.sub(r'\b(a|an|the)\b', ' ', s).split())
+
+
+def answer_f1(prediction, gold_answers):
+    """Best token F1 of prediction against any of gold_answers, as in the CoQA evaluation."""
+    prediction_tokens = normalize_answer(prediction).split()
+    best = 0.0
+    for gold in gold_answers:
+        gold_tokens = normalize_answer(gold).split()
+        if len(gold_tokens) == 0 or len(prediction_tokens) == 0:
+            best = max(best, float(gold_tokens == prediction_tokens))
+            continue
+        num_same = sum((Counter(prediction_tokens) & Counter(gold_tokens)).values())
+        if num_same == 0:
+            continue
+        precision = 1.0 * num_same / len(prediction_tokens)
+        recall = 1.0 * num_same / len(gold_tokens)
+        best = max(best, (2 * precision * recall) / (precision + recall))
+    return best
+
+
+class PairedDeltas(object):
+    """Streams one row per question answered in both datasets to a .jsonl file and keeps the aggregates.
+
+    The original answers are taken in first with track(decoded, original); every answer of track(decoded, intervened)
+    then writes the row of its question: both answers, whether the answer changed, whether the intervened answer is
+    unknown, and the F1 of both against the gold answers of the original question."""
+    def __init__(self, path, original="O", intervened="RG"):
+        self.path = path
+        self.original = original
+        self.intervened = intervened
+        self.original_answers = {}
+        self.totals = Counter()
+
+    def __enter__(self):
+        self.writer = PredictionWriter(self.path).__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.writer.__exit__(exc_type, exc_value, traceback)
+
+    def track(self, decoded, dataset_name, confirm = True):
+        """Passes the (example, nbest) pairs of decoded on, recording the answer of each."""
+        for (example, nbest) in decoded:
+            answer = answer_text(nbest, confirm)
+            if dataset_name == self.original:
+                gold_answers = [example.orig_answer_text] + (example.additional_answers or [])
+                self.original_answers[example.qas_id] = (answer, gold_answers)
+            elif example.qas_id in self.original_answers:
+                self._add_row(example.qas_id, answer)
+            yield example, nbest
+
+    def _add_row(self, qas_id, answer):
+        original_answer, gold_answers = self.original_answers[qas_id]
+        _id, _turn_id = qas_id.split()
+        original_f1, intervened_f1 = answer_f1(original_answer, gold_answers), answer_f1(answer, gold_answers)
+        row = {
+            "id": _id,
+            "turn_id": int(_turn_id),
+            self.original: original_answer,
+            self.intervened: answer,
+            "flip": normalize_answer(answer) != normalize_answer(original_answer),
+            "unknown": normalize_answer(answer) == "unknown",
+            f"f1_{self.original}": original_f1,
+            f"f1_{self.intervened}": intervened_f1,
+            "f1_delta": intervened_f1 - original_f1}
+        self.writer.write(row)
+        self.totals["questions"] += 1
+        self.totals["flip"] += row["flip"]
+        self.totals["unknown"] += row["unknown"]
+        self.totals[f"unknown_{self.original}"] += normalize_answer(original_answer) == "unknown"
+        self.totals[f"f1_{self.original}"] += original_f1
+        self.totals[f"f1_{self.intervened}"] += intervened_f1
+
+    def summary(self):
+        questions = max(1, self.totals["questions"])
+        return {
+            "questions": self.totals["questions"],
+            f"{self.original}_only": len(self.original_answers) - self.totals["questions"],
+            "flip_rate": self.totals["flip"] / questions,
+            f"unknown_rate_{self.original}": self.totals[f"unknown_{self.original}"] / questions,
+            f"unknown_rate_{self.intervened}": self.totals["unknown"] / questions,
+            f"f1_{self.original}": self.totals[f"f1_{self.original}"] / questions,
+            f"f1_{self.intervened}": self.totals[f"f1_{self.intervened}"] / questions,
+            "f1_delta": (self.totals[f"f1_{self.intervened}"] - self.totals[f"f1_{self.original}"]) / questions}
+
+    def report(self):
+        summary = self.summary()
+        print(f"{summary['questions']} questions in both {self.original} and {self.intervened} "
+              f"({summary[self.original + '_only']} only in {self.original})")
+        print(f"answer changed {summary['flip_rate']:.2%}, unknown {summary['unknown_rate_' + self.original]:.2%} on {self.original} "
+              f"and {summary['unknown_rate_' + self.intervened]:.2%} on {self.intervened}")
+        print(f"F1 {summary['f1_' + self.original]:.4f} on {self.original}, {summary['f1_' + self.intervened]:.4f} on {self.intervened} "
+              f"({summary['f1_delta']:+.4f})")
+        return summary
+
+    def save_summary(self, path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
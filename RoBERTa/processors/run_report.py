@@ -0,0 +1,70 @@
+import contextlib
+import json
+import platform
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    #   not available on Windows; the report then has no memory figures
+    resource = None
+
+
+#   Wall time, throughput and peak memory of every stage of a run (preprocessing, feature extraction, inference,
+#   decoding), with the number of examples, features, results and predictions, written by the main scripts as
+#   run_report.json in the output directory to follow regressions from run to run and size the machines for a
+#   dataset. The main scripts run one job per process, so the stages are recorded into one report per process.
+
+RUN_REPORT_FILE = "run_report.json"
+
+
+def peak_rss_mb():
+    """Peak resident memory so far of this process and of its largest finished child process (the worker pools of
+    preprocessing and feature extraction), in MB; (None, None) where the resource module is not available."""
+    if resource is None:
+        return None, None
+    #   ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit)
+
+
+class RunReport(object):
+    def __init__(self):
+        self.started = time.time()
+        self.stages = []
+        self.counts = {}
+
+    @contextlib.contextmanager
+    def stage(self, name, unit, **details):
+        """Records the with block as stage name; the block sets stage["items"] to the number of units it produced,
+        which are added to the count of unit (examples, features, results, predictions)."""
+        record = {"stage": name, **details, "unit": unit, "items": None}
+        start = time.perf_counter()
+        yield record
+        seconds = time.perf_counter() - start
+        record["seconds"] = seconds
+        if record["items"] is not None:
+            record["items_per_second"] = record["items"] / seconds if seconds > 0 else None
+            self.counts[unit] = self.counts.get(unit, 0) + record["items"]
+        record["peak_rss_mb"], record["workers_peak_rss_mb"] = peak_rss_mb()
+        self.stages.append(record)
+
+    def to_dict(self):
+        #   a run that did without torch (--decode) is not made to load it for the report
+        torch = sys.modules.get("torch")
+        rss, workers_rss = peak_rss_mb()
+        return {"command": sys.argv, "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+                "wall_seconds": time.time() - self.started, "python": platform.python_version(),
+                "torch": torch.__version__ if torch else None, "threads": torch.get_num_threads() if torch else None,
+                "peak_rss_mb": rss, "workers_peak_rss_mb": workers_rss,
+                "counts": self.counts, "stages": self.stages}
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+        print(f"Run report with {len(self.stages)} stages written to {path}")
+        return path
+
+
+run_report = RunReport()
@@ -0,0 +1,194 @@
+"""End-to-end scale test of eval on synthetic CoQA/HotpotQA datasets of growing size, on CPU with a tiny random model.
+
+    python scale_test.py --stories 10 100 1000 --sentences 20 --turns 10 --out-file scale.json
+    python scale_test.py --hotpotqa --stories 100 1000 10000
+
+For each size a fresh process generates the dataset (processors/synthetic.py) and runs the stages of an eval of the
+--main script: preprocess (Processor.get_examples) and features (Extract_Features), as load_dataset runs them but on
+the synthetic file, then infer (Infer_batch with a randomly initialized model of TINY_CONFIG and the synthetic
+tokenizer), decode (get_predictions) and evaluate (evaluate-v1.0.py / eval-hotpotqa.py). Reported per stage: seconds,
+items per second and the peak resident memory so far, of the process and of its worker processes. Predictions of a
+random model are meaningless; only the timings and memory are.
+
+With --eval-dir DIR the eval of a single size is left in DIR the way an eval of the --main script leaves it, to be
+re-decoded from DIR by the real script: python main.py --eval O --decode max_answer_length=16 --output output
+"""
+import argparse
+import importlib
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from processors.run_report import peak_rss_mb
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+#   return_dict=False: the model classes unpack the backbone outputs as tuples; RoBERTa positions start after the
+#   padding index, so 512-token features need 514 position embeddings
+TINY_CONFIG = {"hidden_size": 64, "num_hidden_layers": 2, "num_attention_heads": 2, "intermediate_size": 128, "return_dict": False,
+               "max_position_embeddings": 514}
+
+
+def add_arguments(parser):
+    parser.add_argument("--stories", nargs="+", type=int, default=[10, 100, 1000],
+                        help="dataset sizes to run: CoQA stories, or HotpotQA questions with --hotpotqa")
+    parser.add_argument("--sentences", help="sentences per story (per paragraph with --hotpotqa)", default=20, type=int)
+    parser.add_argument("--words", help="words per sentence", default=12, type=int)
+    parser.add_argument("--turns", help="questions per CoQA story", default=10, type=int)
+    parser.add_argument("--paragraphs", help="paragraphs per HotpotQA question", default=4, type=int)
+    parser.add_argument("--hotpotqa", action="store_true")
+    parser.add_argument("--main", help="main script whose stages are run (default main, main_hotpotqa with --hotpotqa)")
+    parser.add_argument("--threads", help="preprocessing and feature extraction workers, as in load_dataset", default=12, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--out-file", dest="out_file", help="write the results of all sizes to this JSON file")
+    parser.add_argument("--eval-dir", dest="eval_dir", help="leave the eval of one size in this directory, as --decode reads it: "
+                        "the gold file in data/, the tokenizer, stored outputs and predictions in output/")
+    parser.add_argument("--result-file", dest="result_file", help=argparse.SUPPRESS)
+
+
+def load_script(file_name, module_name):
+    """The evaluation scripts are not importable by name (evaluate-v1.0.py, eval-hotpotqa.py)."""
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(HERE, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Stages(object):
+    """Runs the stages one after the other; each returns its value and the number of items it processed."""
+    def __init__(self):
+        self.results = []
+
+    def run(self, name, function):
+        start = time.perf_counter()
+        value, items = function()
+        seconds = time.perf_counter() - start
+        rss, workers_rss = peak_rss_mb()
+        self.results.append({"stage": name, "seconds": seconds, "items": items, "items_per_second": items / max(seconds, 1e-9),
+                             "peak_rss_mb": rss, "workers_peak_rss_mb": workers_rss})
+        return value
+
+
+def generate(args, data_dir):
+    from processors import synthetic
+    if args.hotpotqa:
+        data = synthetic.hotpotqa_dataset(args.size, args.paragraphs, args.sentences, args.words, args.seed)
+    else:
+        data = synthetic.coqa_dataset(args.size, args.sentences, args.words, args.turns, seed=args.seed)
+    synthetic.write_json(os.path.join(data_dir, "dev.json"), data)
+    return synthetic.write_bpe_vocab(os.path.join(data_dir, "tokenizer")), args.size
+
+
+def write_eval_dir(args, main, tokenizer, results, gold_file, prediction_file):
+    """The files an eval of the --main script leaves, which main --eval O --decode ... --output output re-decodes
+    in args.eval_dir (import_time.py times that)."""
+    from processors.logit_store import LOGITS_FILE, save_results
+    data_dir, output_dir = os.path.join(args.eval_dir, "data"), os.path.join(args.eval_dir, "output")
+    os.makedirs(data_dir, exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
+    shutil.copy(gold_file, os.path.join(data_dir, main.predict_file))
+    shutil.copy(prediction_file, output_dir)
+    tokenizer.save_pretrained(output_dir)
+    save_results(os.path.join(output_dir, LOGITS_FILE), results, settings={"n_best_size": main.n_best_size, "max_answer_length": main.max_answer_length})
+
+
+def run_size(args):
+    """The stages of one eval on a dataset of args.size stories; runs in a process of its own."""
+    import torch
+    from torch.utils.data import DataLoader, SequentialSampler
+    from transformers import RobertaTokenizer
+
+    torch.manual_seed(args.seed)
+    main = importlib.import_module(args.main)
+    model_class = main.load_model_class()
+    stages = Stages()
+    with tempfile.TemporaryDirectory() as data_dir:
+        tokenizer_dir = stages.run("generate", lambda: generate(args, data_dir))
+        tokenizer = RobertaTokenizer(os.path.join(tokenizer_dir, "vocab.json"), os.path.join(tokenizer_dir, "merges.txt"))
+        config = model_class.config_class(vocab_size=len(tokenizer), **TINY_CONFIG)
+        model = model_class(config)
+        device = torch.device("cpu")
+        gold_file = os.path.join(data_dir, "dev.json")
+        prediction_file = os.path.join(data_dir, "predictions.json")
+
+        def preprocess():
+            history_len = 0 if args.hotpotqa else 2
+            examples = main.Processor().get_examples(data_dir, history_len, filename="dev.json", threads=args.threads)
+            return examples, len(examples)
+
+        def extract_features():
+            features, dataset = main.Extract_Features(examples=examples, tokenizer=tokenizer, max_seq_length=512, doc_stride=128,
+                                                      max_query_length=64, is_training=False, threads=args.threads)
+            return (features, dataset), len(features)
+
+        def infer():
+            results = []
+            dataloader = DataLoader(dataset, sampler=SequentialSampler(dataset), batch_size=main.evaluation_batch_size)
+            for batch in dataloader:
+                batch_features = [features[example_index] for example_index in main.convert_to_list(batch[3])]
+                results.extend(main.Infer_batch(model, batch[:3], batch_features, device))
+            return results, len(features)
+
+        def decode():
+            main.get_predictions(examples, features, results, main.n_best_size, main.max_answer_length, True, prediction_file, False, tokenizer)
+            return None, len(examples)
+
+        def evaluate():
+            if args.hotpotqa:
+                evaluate = load_script("eval-hotpotqa.py", "eval_hotpotqa")
+                prediction = evaluate.load_predictions(prediction_file)
+                return evaluate.score(prediction, evaluate.load_gold(gold_file)), len(prediction)
+            evaluate = load_script("evaluate-v1.0.py", "evaluate_coqa")
+            evaluator = evaluate.CoQAEvaluator(gold_file)
+            pred_data = evaluator.preds_to_dict(prediction_file)
+            return evaluator.model_performance(pred_data), len(pred_data)
+
+        examples = stages.run("preprocess", preprocess)
+        features, dataset = stages.run("features", extract_features)
+        results = stages.run("infer", infer)
+        stages.run("decode", decode)
+        stages.run("evaluate", evaluate)
+        if args.eval_dir:
+            write_eval_dir(args, main, tokenizer, results, gold_file, prediction_file)
+    return stages.results
+
+
+def print_results(runs):
+    print(f"{'size':>8} {'stage':>10} {'seconds':>9} {'items':>9} {'items/s':>10} {'peak MB':>8} {'workers MB':>10}")
+    for run in runs:
+        for stage in run["stages"]:
+            print(f"{run['size']:8d} {stage['stage']:>10} {stage['seconds']:9.2f} {stage['items']:9d} {stage['items_per_second']:10.1f} "
+                  f"{stage['peak_rss_mb']:8.0f} {stage['workers_peak_rss_mb']:10.0f}")
+        print(f"{run['size']:8d} {'total':>10} {run['wall_seconds']:9.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    args = parser.parse_args()
+    args.main = args.main or ("main_hotpotqa" if args.hotpotqa else "main")
+    if args.result_file:
+        args.size = args.stories[0]
+        with open(args.result_file, "w") as f:
+            json.dump(run_size(args), f)
+        sys.exit()
+
+    runs = []
+    for size in args.stories:
+        with tempfile.NamedTemporaryFile(suffix=".json") as result_file:
+            #   a process per size, so the peak memory of each size is its own
+            command = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ["--stories", str(size), "--result-file", result_file.name]
+            start = time.perf_counter()
+            subprocess.run(command, cwd=HERE, check=True)
+            wall_seconds = time.perf_counter() - start
+            with open(result_file.name) as f:
+                runs.append({"size": size, "wall_seconds": wall_seconds, "stages": json.load(f)})
+    print_results(runs)
+    if args.out_file:
+        with open(args.out_file, "w") as f:
+            json.dump({"arguments": {key: value for (key, value) in vars(args).items() if key not in ("result_file", "out_file")},
+                       "runs": runs}, f, indent=2)
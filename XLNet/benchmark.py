@@ -0,0 +1,216 @@
+"""Micro-benchmarks of the data and decoding hot paths on synthetic data (processors/synthetic.py), no downloads.
+
+    python benchmark.py --out-file bench-base.json
+    python benchmark.py --compare bench-base.json --only convert_coqa_example predict_process
+
+Every benchmark times one function over the same seeded data, once to warm up and then --repeat times; the minimum
+and median seconds are reported, the minimum being the least noisy to compare. The sentencepiece tokenizer is trained
+on synthetic stories; preprocessing needs the spaCy model as in training and eval. The results file
+records the commit, the library versions and the data sizes; --compare prints the ratio of each benchmark to an
+earlier results file, which only means something for the same sizes on the same machine.
+"""
+import argparse
+import collections
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+import transformers
+
+from processors import synthetic
+from processors.coqa import CoqaPipeline, OutputResult, Tokenizer, XLNetExampleProcessor, XLNetPredictProcessor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BENCHMARKS = collections.OrderedDict()
+
+
+def add_arguments(parser):
+    parser.add_argument("--stories", help="synthetic CoQA stories", default=20, type=int)
+    parser.add_argument("--sentences", help="sentences per story", default=40, type=int)
+    parser.add_argument("--turns", help="questions per story", default=10, type=int)
+    parser.add_argument("--questions", help="synthetic HotpotQA questions", default=500, type=int)
+    parser.add_argument("--repeat", help="timed runs of every benchmark", default=3, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--only", nargs="+", help="benchmarks to run (default all)")
+    parser.add_argument("--out-file", dest="out_file", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="results file of an earlier run to compare with")
+
+
+def benchmark(function):
+    """Registers function(data), which sets up and returns (callable to time, number of items it processes)."""
+    BENCHMARKS[function.__name__[len("bench_"):]] = function
+    return function
+
+
+def load_script(file_name, module_name):
+    """The evaluation scripts are not importable by name (evaluate-v1.0.py, eval-hotpotqa.py)."""
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(HERE, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class SyntheticData(object):
+    """The seeded datasets, their files under directory and what the benchmarks derive from them, built on first use."""
+    def __init__(self, directory, stories, sentences, turns, questions, seed):
+        self.directory = directory
+        self.seed = seed
+        self.coqa = synthetic.coqa_dataset(stories, sentences=sentences, turns=turns, seed=seed)
+        self.hotpotqa = synthetic.hotpotqa_dataset(questions, seed=seed)
+        self.coqa_file = synthetic.write_json(os.path.join(directory, "coqa.json"), self.coqa)
+        self.hotpotqa_file = synthetic.write_json(os.path.join(directory, "hotpotqa.json"), self.hotpotqa)
+        self.tokenizer = Tokenizer(synthetic.write_sentencepiece_model(os.path.join(directory, "tokenizer"), seed))
+        self.pipeline = CoqaPipeline(directory)
+        self.processor = XLNetExampleProcessor(self.tokenizer)
+        self._examples = None
+        self._features = None
+
+    def examples(self):
+        if self._examples is None:
+            self._examples = self.pipeline._get_example(self.coqa["data"])
+        return self._examples
+
+    def features(self):
+        """Features of every example, numbered as convert_examples_to_features numbers them."""
+        if self._features is None:
+            self._features = [feature for example in self.examples() for feature in self.processor.convert_coqa_example(example)]
+            for (i, feature) in enumerate(self._features):
+                feature.unique_id = 10000000 + i
+        return self._features
+
+
+@benchmark
+def bench_create_examples(data):
+    stories = data.coqa["data"]
+    return (lambda: data.pipeline._get_example(stories)), len(stories)
+
+
+@benchmark
+def bench_generate_match_mapping(data):
+    #   the raw and tokenized text of every story, as convert_coqa_example aligns them
+    cases = []
+    for datum in data.coqa["data"]:
+        para_text = datum["story"]
+        tokenized_para_text = ''.join(data.tokenizer.tokenize(para_text)).replace('_', ' ')
+        N, M = len(para_text), len(tokenized_para_text)
+        cases.append((para_text, tokenized_para_text, N, M, max(N, 1024), max(M, 1024)))
+    return (lambda: [data.processor._generate_match_mapping(*case) for case in cases]), len(cases)
+
+
+@benchmark
+def bench_convert_coqa_example(data):
+    examples = data.examples()
+    return (lambda: [data.processor.convert_coqa_example(example) for example in examples]), len(examples)
+
+
+@benchmark
+def bench_predict_process(data):
+    examples, features = data.examples(), data.features()
+    rng = np.random.RandomState(data.seed)
+    results = []
+    for feature in features:
+        #   the start_n_top x end_n_top candidates the model returns, within the paragraph
+        start_index = rng.randint(0, feature.para_length, size=5)
+        end_index = np.minimum(start_index[:, None] + rng.randint(0, 20, size=(5, 5)), feature.para_length - 1)
+        results.append(OutputResult(unique_id=feature.unique_id, unk_prob=rng.rand(), yes_prob=rng.rand(), no_prob=rng.rand(),
+                                    num_probs=rng.dirichlet(np.ones(12)).tolist(), opt_probs=rng.dirichlet(np.ones(3)).tolist(),
+                                    start_prob=np.sort(rng.rand(5))[::-1].tolist(), start_index=start_index.tolist(),
+                                    end_prob=np.sort(rng.rand(5, 5))[:, ::-1].tolist(), end_index=end_index.tolist()))
+    predict_processor = XLNetPredictProcessor(output_dir=data.directory, tokenizer=data.tokenizer)
+    return (lambda: predict_processor.process(examples, features, results)), len(examples)
+
+
+@benchmark
+def bench_model_performance(data):
+    evaluate = load_script("evaluate-v1.0.py", "evaluate_coqa")
+    evaluator = evaluate.CoQAEvaluator(data.coqa_file)
+    #   the answers of the first additional answer set as predictions: right for some turns, partly or not for others
+    pred_data = {(datum["id"], answer["turn_id"]): answer["input_text"] for datum in data.coqa["data"]
+                 for answer in datum["additional_answers"]["0"]}
+    return (lambda: evaluator.model_performance(pred_data)), len(pred_data)
+
+
+@benchmark
+def bench_eval_hotpotqa(data):
+    evaluate = load_script("eval-hotpotqa.py", "eval_hotpotqa")
+    rng = np.random.RandomState(data.seed)
+    predictions = [{"id": [record["_id"]], "answer": record["answer"] if rng.rand() < 0.5 else "unknown"} for record in data.hotpotqa]
+    prediction_file = synthetic.write_json(os.path.join(data.directory, "hotpotqa_predictions.json"), predictions)
+    return (lambda: evaluate.eval(prediction_file, data.hotpotqa_file)), len(predictions)
+
+
+@contextlib.contextmanager
+def quiet():
+    """Discards the progress bars and printed scores of the code under test."""
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        yield
+
+
+def run(function, repeat):
+    """Warm-up run, then the seconds of each of repeat runs."""
+    times = []
+    with quiet():
+        function()
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def commit():
+    try:
+        revision = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, universal_newlines=True).strip()
+        dirty = subprocess.call(["git", "diff", "--quiet", "HEAD", "--", "."], cwd=HERE) != 0
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision + ("-dirty" if dirty else "")
+
+
+def compare(results, earlier):
+    if earlier["sizes"] != results["sizes"]:
+        print(f"warning: {earlier['sizes']} in the earlier results, {results['sizes']} now")
+    print(f"{'benchmark':24} {earlier['commit'] or 'earlier':>12} {results['commit'] or 'now':>12}  ratio")
+    for (name, entry) in results["benchmarks"].items():
+        if name in earlier["benchmarks"]:
+            before = earlier["benchmarks"][name]["min"]
+            print(f"{name:24} {before:11.4f}s {entry['min']:11.4f}s  {entry['min'] / before:5.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    args = parser.parse_args()
+    names = args.only or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        sys.exit(f"unknown benchmarks {unknown}, choose from {list(BENCHMARKS)}")
+    results = {"commit": commit(), "python": platform.python_version(), "torch": torch.__version__,
+               "transformers": transformers.__version__, "numpy": np.__version__, "machine": platform.platform(),
+               "sizes": {"stories": args.stories, "sentences": args.sentences, "turns": args.turns, "questions": args.questions},
+               "seed": args.seed, "repeat": args.repeat, "benchmarks": {}}
+    with tempfile.TemporaryDirectory() as directory:
+        data = SyntheticData(directory, args.stories, args.sentences, args.turns, args.questions, args.seed)
+        for name in names:
+            with quiet():
+                function, items = BENCHMARKS[name](data)
+            times = run(function, args.repeat)
+            results["benchmarks"][name] = {"min": min(times), "median": statistics.median(times), "items": items, "times": times}
+            print(f"{name:24} min {min(times):9.4f}s  median {statistics.median(times):9.4f}s  "
+                  f"{items / min(times):12.1f} items/s")
+    if args.out_file:
+        with open(args.out_file, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
@@ -0,0 +1,147 @@
+"""Paired bootstrap confidence intervals for EM/F1 differences between prediction files of the same questions.
+
+    python bootstrap.py --data-file data/coqa-dev-v1.0.json --pred-file O/predictions.json TS/predictions.json RG/predictions.json
+
+Every prediction file is scored turn by turn with CoQAEvaluator.get_raw_scores of evaluate-v1.0.py (--hotpotqa: per
+question with score_prediction of eval-hotpotqa.py); a question without a prediction scores 0. All files are resampled
+with the same questions, so each pair of files is compared on identical samples. A resample is a row of counts of how
+often each question was drawn, so the means of all files over a block of resamples are one matrix product.
+Scores are reported per CoQA domain, in/out of domain and overall, in percent.
+"""
+import argparse
+import importlib.util
+import itertools
+import json
+import os
+import sys
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+METRICS = ["em", "f1"]
+#   upper bound on the resamples x questions count matrix built at once
+BLOCK_CELLS = 1 << 24
+
+
+def add_arguments(parser):
+    parser.add_argument("--data-file", dest="data_file", help="gold file", required=True)
+    parser.add_argument("--pred-file", dest="pred_file", nargs="+", help="prediction files to compare, at least two", required=True)
+    parser.add_argument("--hotpotqa", help="the files are HotpotQA predictions and gold", action="store_true")
+    parser.add_argument("--samples", help="number of bootstrap resamples", default=10000, type=int)
+    parser.add_argument("--confidence", help="confidence level of the intervals", default=0.95, type=float)
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--out-file", dest="out_file", help="also write the results to this JSON file")
+
+
+def load_script(file_name, module_name):
+    """The evaluation scripts are not importable by name (evaluate-v1.0.py, eval-hotpotqa.py)."""
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(HERE, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def coqa_scores(data_file, pred_files):
+    """{metric: (files, turns) array} in gold order, and {group: turn indices} for each domain, in/out of domain and overall."""
+    evaluate = load_script("evaluate-v1.0.py", "evaluate_coqa")
+    evaluator = evaluate.CoQAEvaluator(data_file)
+    keys = list(evaluator.gold_data)
+    scores = {metric: np.zeros((len(pred_files), len(keys))) for metric in METRICS}
+    for (f, pred_file) in enumerate(pred_files):
+        exact_scores, f1_scores = evaluator.get_raw_scores(evaluator.preds_to_dict(pred_file))
+        scores["em"][f] = [exact_scores.get(key, 0) for key in keys]
+        scores["f1"][f] = [f1_scores.get(key, 0) for key in keys]
+    sources = np.array([evaluator.id_to_source[story_id] for (story_id, _) in keys])
+    groups = {}
+    for source in evaluate.in_domain + evaluate.out_domain:
+        groups[evaluate.domain_mappings[source]] = np.flatnonzero(sources == source)
+    groups["in_domain"] = np.flatnonzero(np.isin(sources, evaluate.in_domain))
+    groups["out_domain"] = np.flatnonzero(np.isin(sources, evaluate.out_domain))
+    groups["overall"] = np.arange(len(keys))
+    return scores, groups
+
+
+def hotpotqa_scores(data_file, pred_files):
+    """Same as coqa_scores for HotpotQA, per gold _id, with the overall group only.
+
+    A question predicted more than once keeps its last prediction, unlike eval-hotpotqa.py, which counts each."""
+    evaluate = load_script("eval-hotpotqa.py", "eval_hotpotqa")
+    gold_answers = evaluate.load_gold(data_file)
+    ids = list(gold_answers)
+    scores = {metric: np.zeros((len(pred_files), len(ids))) for metric in METRICS}
+    for (f, pred_file) in enumerate(pred_files):
+        answers = {p["id"][0]: p["answer"] for p in evaluate.load_predictions(pred_file)}
+        for (i, qid) in enumerate(ids):
+            if qid in answers:
+                gold_scores = evaluate.score_prediction((answers[qid], gold_answers[qid]))
+                scores["em"][f, i] = sum(float(em) for (em, _, _, _, _) in gold_scores)
+                scores["f1"][f, i] = sum(f1 for (_, f1, _, _, _) in gold_scores)
+    return scores, {"overall": np.arange(len(ids))}
+
+
+def resampled_means(values, samples, random_state):
+    """(samples, files) means of values (files, questions) over resamples of the questions."""
+    n = values.shape[1]
+    block = max(1, min(samples, BLOCK_CELLS // max(1, n)))
+    means = []
+    for start in range(0, samples, block):
+        size = min(block, samples - start)
+        drawn = random_state.randint(0, n, size=(size, n))
+        #   counts[s, q]: how often question q is drawn in resample s
+        counts = np.bincount((drawn + n * np.arange(size)[:, None]).ravel(), minlength=size * n).reshape(size, n)
+        means.append(counts.dot(values.T) / n)
+    return np.concatenate(means)
+
+
+def bootstrap(scores, groups, names, samples=10000, confidence=0.95, seed=0):
+    """Mean and interval of every file, and the difference, interval and p-value of every pair, per group and metric."""
+    random_state = np.random.RandomState(seed)
+    tails = [(1 - confidence) / 2 * 100, (1 + confidence) / 2 * 100]
+    results = {}
+    for (group, indices) in groups.items():
+        if len(indices) == 0:
+            continue
+        #   the same resamples for both metrics and all files, so every comparison is paired
+        values = np.concatenate([scores[metric][:, indices] for metric in METRICS]) * 100
+        means = resampled_means(values, samples, random_state)
+        observed = values.mean(axis=1)
+        result = {"questions": int(len(indices))}
+        for (m, metric) in enumerate(METRICS):
+            offset = m * len(names)
+            result[metric] = {name: {"score": float(observed[offset + f]), "interval": np.percentile(means[:, offset + f], tails).tolist()}
+                              for (f, name) in enumerate(names)}
+            for (a, b) in itertools.combinations(range(len(names)), 2):
+                deltas = means[:, offset + b] - means[:, offset + a]
+                #   two-sided: how often the resampled difference falls on either side of zero
+                p_value = min(1.0, 2 * float(min(np.mean(deltas <= 0), np.mean(deltas >= 0))))
+                result[metric][f"{names[b]} - {names[a]}"] = {"delta": float(observed[offset + b] - observed[offset + a]),
+                                                              "interval": np.percentile(deltas, tails).tolist(), "p_value": p_value}
+        results[group] = result
+    return results
+
+
+def print_results(results, names):
+    for (group, result) in results.items():
+        print(f"{group} ({result['questions']} questions)")
+        for metric in METRICS:
+            for (name, entry) in result[metric].items():
+                (low, high) = entry["interval"]
+                if name in names:
+                    print(f"  {metric} {name}: {entry['score']:.1f} [{low:.1f}, {high:.1f}]")
+                else:
+                    print(f"  {metric} {name}: {entry['delta']:+.2f} [{low:+.2f}, {high:+.2f}] p={entry['p_value']:.4f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    args = parser.parse_args()
+    if len(args.pred_file) < 2:
+        sys.exit("--pred-file needs at least two prediction files to compare")
+    load_scores = hotpotqa_scores if args.hotpotqa else coqa_scores
+    scores, groups = load_scores(args.data_file, args.pred_file)
+    results = bootstrap(scores, groups, args.pred_file, args.samples, args.confidence, args.seed)
+    print_results(results, args.pred_file)
+    if args.out_file:
+        with open(args.out_file, "w") as file:
+            json.dump(results, file, indent=2)
@@ -1,16 +1,11 @@
 import os
-import torch
-import torch.nn as nn
-import torch.nn.functional as F
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
 from tqdm import tqdm, trange
-from transformers import (AdamW, AutoConfig, AutoTokenizer, get_linear_schedule_with_warmup)
-from processors.metrics_hotpotqa import get_predictions
-from transformers import XLNetModel, XLNetTokenizer, XLNetConfig
-from torch.nn import BCEWithLogitsLoss,CrossEntropyLoss
 from processors.hotpotqa import CoqaPipeline, Tokenizer, XLNetExampleProcessor, XLNetPredictProcessor, OutputResult
-import numpy as np
-import getopt,sys
+import getopt,sys,time
+from processors.checkpoint import strip_shadow_backbone
+from processors.options import DEFAULT_KEEP_CHECKPOINTS, DEFAULT_LOG_STEPS, DEFAULT_SAVE_STEPS, parse_log_steps, parse_positive, parse_profile_window
+from processors.run_report import RUN_REPORT_FILE, run_report
+from processors.logit_store import LOGITS_FILE, load_results, parse_decode_configs, save_results
 
 pretrained_model="xlnet-large-cased"
 max_seq_length = 512
@@ -18,342 +13,235 @@ epochs = 1.0
 evaluation_batch_size = 16
 train_batch_size = 4
 lr = 3e-5
-MIN_FLOAT = -1e30
 MAX_FLOAT = 1e30
 top_k = 5
- 
-class XLNetLargeModel(XLNetModel):
-    def __init__(self,config, load_pre = False):
-        super(XLNetLargeModel,self).__init__(config)
-        self.xlnet = XLNetModel.from_pretrained(pretrained_model, config=config,) if load_pre else XLNetModel(config)
-        hidden_size = config.hidden_size
-        self.seq_len = max_seq_length
-        self.start_project = nn.Linear(hidden_size,1)
-        self.end_modelling = nn.Linear(2*hidden_size,hidden_size)
-        self.end_norm = nn.LayerNorm(hidden_size)
-        self.end_project = nn.Linear(hidden_size,1)
-        self.answer_modelling = nn.Linear(2*hidden_size,hidden_size)
-        self.answer_drop = nn.Dropout(p=0.1)
-        self.unk_project = nn.Linear(hidden_size,1)
-        self.yes_project = nn.Linear(hidden_size,1)
-        self.no_project = nn.Linear(hidden_size,1)
-        self.num_project = nn.Linear(hidden_size,12)
-        self.opt_project = nn.Linear(hidden_size,3)
-        self.relu = nn.ReLU
+#   XLNetPredictProcessor settings used by Write_predictions; start_n_top/end_n_top cannot exceed the model's top-k
+decode_defaults = {"n_best_size": 5, "start_n_top": 5, "end_n_top": 5, "max_answer_length": 16, "answer_threshold": 0.1}
 
-    def generate_masked_data(self, input_data, input_mask):
-        return input_data * input_mask + MIN_FLOAT * (1 - input_mask)
 
-    def compute_loss(self, label, label_mask, predict, predict_mask, size ,):
-        masked_predict = self.generate_masked_data(predict, predict_mask)
-        masked_label = label.type(torch.long) * label_mask.type(torch.long)
-        masked_label = F.one_hot(masked_label,size)
-        loss = -torch.sum(F.log_softmax(masked_predict, dim=1) * masked_label, dim=1)
-        return loss
+def load_model_class():
+    #   imported to train or evaluate only: --help loads neither torch nor transformers and --decode not the model
+    from models import XLNetLargeModel
+    return XLNetLargeModel
 
-    def forward(self,input_ids,
-            input_mask, segment_ids,
-            p_mask, cls_index,
-            start_positions=None,end_positions=None,
-            is_unk = None,is_yes = None,
-            is_no = None, number = None, 
-            option = None,):
-        
-        predicts = {}
-        #****************************************XLNET-BASE***************************
-        output_result,_ = self.xlnet(input_ids,
-                            token_type_ids=segment_ids,
-                            input_mask=input_mask,
-                            return_dict = False)
-        #****************************************START MODELLIING*********************
-        start_result = output_result
-        start_result_mask = 1 - p_mask
-        start_result = self.start_project(start_result)
-        start_result = torch.squeeze(start_result, dim=-1)
-        start_result = self.generate_masked_data(start_result, start_result_mask)
-        start_prob = torch.softmax(start_result, dim=-1)
-        
-        if not self.training:
-            start_top_prob, start_top_index = torch.topk(start_prob, k=top_k)
-            predicts["start_prob"] = start_top_prob
-            predicts["start_index"] = start_top_index
-
-        #****************************************END MODELLIING***********************
-        if self.training:
-            start_index = F.one_hot(torch.unsqueeze(start_positions, dim=-1), self.seq_len)
-            feat_result = start_index.type(torch.float) @ output_result
-            feat_result = feat_result.repeat(1,self.seq_len,1)
-            
-            end_result = torch.cat([output_result, feat_result], dim=-1)
-            end_result_mask = 1 - p_mask
-            
-            end_result = torch.tanh( self.end_modelling(end_result))
-            end_result = self.end_norm(end_result)
-            end_result = self.end_project(end_result)
-            
-            end_result = torch.squeeze(end_result, dim=-1)
-            end_result = self.generate_masked_data(end_result, end_result_mask)
-            end_prob = torch.softmax(end_result, dim=-1)
-        else:
-            start_index = F.one_hot(start_top_index, self.seq_len)
-            feat_result = start_index.type(torch.float)@ output_result
-            feat_result = torch.unsqueeze(feat_result, dim=1)
-            feat_result = feat_result.repeat(1,self.seq_len,1,1)
-            
-            end_result = torch.unsqueeze(output_result, dim=-2)
-            end_result = end_result.repeat(1,1,top_k,1)
-            end_result = torch.cat([end_result, feat_result], dim=-1)
-            end_result_mask = torch.unsqueeze(1 - p_mask, dim=1)
-            end_result_mask = end_result_mask.repeat(1, top_k,1)
-            
-            end_result = torch.tanh( self.end_modelling(end_result))
-            end_result = self.end_norm(end_result)
-            end_result = self.end_project(end_result)
-            
-            end_result = (torch.squeeze(end_result, dim=-1)).permute(0, 2, 1)
-            end_result = self.generate_masked_data(end_result, end_result_mask)
-            end_prob = torch.softmax(end_result, dim=-1)
-            
-            end_top_prob, end_top_index = torch.topk(end_prob, k=top_k)
-            predicts["end_prob"] = end_top_prob
-            predicts["end_index"] = end_top_index
-
-        #****************************************ANSWER MODELLING*********************
-        answer_cls_index = F.one_hot(torch.unsqueeze(cls_index, dim=-1), self.seq_len)
-        answer_feat_result = (torch.unsqueeze(start_prob, dim=1)) @ output_result
-        answer_output_result = answer_cls_index.type(torch.float)@ output_result
-        answer_result = torch.cat([answer_feat_result, answer_output_result], dim=-1)
-        answer_result = torch.squeeze(answer_result, dim=1)
-        answer_result = torch.tanh( self.answer_modelling(answer_result))
-        answer_result = self.answer_drop(answer_result)
-        
-        #****************************************UNKNOWN MODELLING********************
-        unk_result = self.unk_project(answer_result)
-        unk_result_mask,_ = torch.max(1 - p_mask, dim=-1)
-        unk_result = torch.squeeze(unk_result, dim=-1)
-        unk_result = self.generate_masked_data(unk_result, unk_result_mask)
-        unk_prob = torch.sigmoid(unk_result)
-        predicts["unk_prob"] = unk_prob
-        
-        #****************************************YES MODELLING************************
-        yes_result = self.yes_project(answer_result)
-        yes_result_mask,_ = torch.max(1 - p_mask, dim=-1)
-        yes_result = torch.squeeze(yes_result, dim=-1)
-        yes_result = self.generate_masked_data(yes_result, yes_result_mask)
-        yes_prob = torch.sigmoid(yes_result)
-        predicts["yes_prob"] = yes_prob
-        
-        #****************************************NO MODELLING*************************
-        no_result = self.no_project(answer_result)
-        no_result_mask,_ = torch.max(1 - p_mask, dim=-1)
-        no_result = torch.squeeze(no_result, dim=-1)
-        no_result = self.generate_masked_data(no_result, no_result_mask)
-        no_prob = torch.sigmoid(no_result)
-        predicts["no_prob"] = no_prob
-        
-        #****************************************NUM MODELLING************************
-        num_result = self.num_project(answer_result)
-        num_result_mask,_ = torch.max(1 - p_mask, dim=-1, keepdims=True)
-        num_result = self.generate_masked_data(num_result, num_result_mask)
-        num_probs = torch.softmax(num_result, dim=-1)
-        predicts["num_probs"] = num_probs
-        
-        #****************************************OPT MODELLIING***********************
-        opt_result = self.opt_project(answer_result)
-        opt_result_mask,_ = torch.max(1 - p_mask, dim=-1, keepdims=True)
-        opt_result = self.generate_masked_data(opt_result, opt_result_mask)
-        opt_probs = torch.softmax(opt_result, dim=-1)
-        predicts["opt_probs"] = opt_probs
-    
-        #****************************************LOSSES********************************
-        bce = BCEWithLogitsLoss(reduction = "none")
-        loss = 0.0
-        if self.training:
-            start_label = start_positions
-            start_label_mask,_ = torch.max(1 - p_mask, dim=-1)
-            start_loss = self.compute_loss(start_label, start_label_mask, start_result, start_result_mask, self.seq_len)
-            end_label = end_positions
-            end_label_mask,_ = torch.max(1 - p_mask, dim=-1)
-            end_loss = self.compute_loss(end_label, end_label_mask, end_result, end_result_mask,self.seq_len)
-            loss += torch.mean(start_loss + end_loss)
-            
-            unk_label = is_unk
-            unk_label_mask,_ = torch.max(1 - p_mask, dim=-1)
-            unk_loss = bce(unk_result,unk_label.type(torch.float) * unk_label_mask.type(torch.float))
-            loss += torch.mean(unk_loss)
-            
-            yes_label = is_yes
-            yes_label_mask,_ = torch.max(1 - p_mask, dim=-1)
-            yes_loss = bce(yes_result, yes_label.type(torch.float) * yes_label_mask.type(torch.float))
-            loss += torch.mean(yes_loss)
-            
-            no_label = is_no
-            no_label_mask,_ = torch.max(1 - p_mask, dim=-1)
-            no_loss = bce(no_result, no_label.type(torch.float) * no_label_mask.type(torch.float))
-            loss += torch.mean(no_loss)
-            
-            num_label = number
-            num_label_mask,_ = torch.max(1 - p_mask, dim=-1)
-            num_loss = self.compute_loss(num_label, num_label_mask, num_result, num_result_mask, 12)
-            loss += torch.mean(num_loss)
-            
-            opt_label = option
-            opt_label_mask,_ = torch.max(1 - p_mask, dim=-1)
-            opt_loss = self.compute_loss(opt_label, opt_label_mask, opt_result, opt_result_mask,3)
-            loss += torch.mean(opt_loss)
-
-            return loss
-        return predicts
 
 def convert_to_list(tensor):
     return tensor.detach().cpu().tolist()
 
-def train(train_dataset, model, tokenizer, device,output_directory):
-    train_sampler = RandomSampler(train_dataset) 
+def train(train_dataset, model, tokenizer, device,output_directory, profile = None, log_steps = DEFAULT_LOG_STEPS, resume = False, save_steps = DEFAULT_SAVE_STEPS, keep_checkpoints = DEFAULT_KEEP_CHECKPOINTS):
+    from torch.utils.data import DataLoader
+    from transformers import AdamW, get_linear_schedule_with_warmup
+    from processors.profiling import StepProfiler, labelled, record_function
+    from processors.telemetry import TrainTelemetry
+    from processors.train_checkpoint import Checkpoints, ResumableRandomSampler
+    train_sampler = ResumableRandomSampler(train_dataset)
     train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=train_batch_size)
     t_total = len(train_dataloader) // 1 * epochs
     optimizer_parameters = [{"params": [p for n, p in model.named_parameters() if not any(nd in n for nd in ["bias", "LayerNorm.weight"])],"weight_decay": 0.01,},
                             {"params": [p for n, p in model.named_parameters() if any(nd in n for nd in ["bias", "LayerNorm.weight"])], "weight_decay": 0.0}]
     optimizer = AdamW(optimizer_parameters,lr=3e-5, eps=1e-8)
     scheduler = get_linear_schedule_with_warmup(optimizer, num_warmup_steps=3000, num_training_steps=t_total)
-    if os.path.isfile(os.path.join(pretrained_model, "optimizer.pt")) and os.path.isfile(os.path.join(pretrained_model, "scheduler.pt")):
-        optimizer.load_state_dict(torch.load(
-            os.path.join(pretrained_model, "optimizer.pt")))
-        scheduler.load_state_dict(torch.load(
-            os.path.join(pretrained_model, "scheduler.pt")))
-    counter = 1
-    epochs_trained = 0
-    train_loss, loss = 0.0, 0.0
+    checkpoints = Checkpoints(output_directory, train_sampler, save_steps, keep_checkpoints)
+    global_step, epochs_trained = checkpoints.resume(model, optimizer, scheduler) if resume else (0, 0)
     model.zero_grad()
+    model.train()
     iterator = trange(epochs_trained, int(epochs), desc="Epoch", disable=False)
-    for _ in iterator:
-        epoch_iterator = tqdm(train_dataloader, desc="Iteration", disable=False)
-        for i,batch in enumerate(epoch_iterator):
-            model.train()
-            batch = tuple(t.to(device) for t in batch)
-            inputs = { "input_ids": batch[0],
-                       "input_mask": batch[1],
-                       "segment_ids": batch[2],
-                       "p_mask": batch[3],
-                       "cls_index": batch[4],
-                       "start_positions": batch[5],
-                       "end_positions": batch[6],
-                       "is_unk": batch[7],
-                       "is_yes": batch[8],
-                       "is_no": batch[9],
-                       "number": batch[10],
-                       "option": batch[11]}
-            loss = model(**inputs)
-            loss.backward()
-            train_loss += loss.item()
-            optimizer.step()
-            scheduler.step()  
-            model.zero_grad()
-            counter += 1
-            epoch_iterator.set_description("Loss :%f" % (train_loss/(4*counter)))
-            epoch_iterator.refresh()
-
-            if counter % 1000 == 0:
-                output_dir = os.path.join(output_directory, "model_weights")
-                if not os.path.exists(output_dir):
-                    os.makedirs(output_dir)
-                model_to_save = model.module if hasattr(model, "module") else model
-                model_to_save.save_pretrained(output_dir)
-                tokenizer.save_pretrained(output_dir)
-                torch.save(optimizer.state_dict(), os.path.join(output_dir, "optimizer.pt"))
-                torch.save(scheduler.state_dict(), os.path.join(output_dir, "scheduler.pt"))
-    return train_loss/counter
+    with StepProfiler(profile, output_directory, "train") as profiler, TrainTelemetry(model, optimizer, output_directory, log_steps, global_step) as telemetry, checkpoints:
+        for epoch in iterator:
+            train_sampler.set_epoch(epoch)
+            epoch_iterator = tqdm(train_dataloader, desc="Iteration", disable=False)
+            for i,batch in enumerate(labelled(telemetry.batches(checkpoints.batches(epoch_iterator)))):
+                #   counted on the host before the copy; input_mask is 1 on padding
+                samples, tokens = batch[0].size(0), int(batch[1].numel() - batch[1].sum())
+                with record_function("to_device"):
+                    batch = tuple(t.to(device) for t in batch)
+                inputs = { "input_ids": batch[0],
+                           "input_mask": batch[1],
+                           "segment_ids": batch[2],
+                           "p_mask": batch[3],
+                           "cls_index": batch[4],
+                           "start_positions": batch[5],
+                           "end_positions": batch[6],
+                           "is_unk": batch[7],
+                           "is_yes": batch[8],
+                           "is_no": batch[9],
+                           "number": batch[10],
+                           "option": batch[11]}
+                with record_function("forward"):
+                    loss = model(**inputs)
+                with record_function("backward"):
+                    loss.backward()
+                with record_function("telemetry"):
+                    record = telemetry.step(loss, samples, tokens)
+                with record_function("optimizer"):
+                    optimizer.step()
+                    scheduler.step()  
+                    model.zero_grad()
+                global_step += 1
+                if record is not None:
+                    epoch_iterator.set_description("Loss :%f" % record["loss"])
+                    epoch_iterator.refresh()
+                profiler.step()
+                checkpoints.step(global_step, model, tokenizer, optimizer, scheduler)
+    return telemetry.mean_loss()
 
 
-def Write_predictions(model, tokenizer, device, dataset_type = None,output_directory = None, use_gpt = None):
+def Write_predictions(model, tokenizer, device, dataset_type = None,output_directory = None, use_gpt = None, jsonl = False, nbest = False, profile = None):
+    from torch.utils.data import DataLoader, SequentialSampler
+    from processors.runtime import inference_mode, report_throughput
+    from processors.profiling import StepProfiler, labelled, record_function
     dataset, examples, features = load_dataset(tokenizer, evaluate=True,dataset_type = dataset_type, use_gpt = use_gpt)
     if not os.path.exists(output_directory):
         os.makedirs(output_directory)
     evalutation_sampler = SequentialSampler(dataset)
     evaluation_dataloader = DataLoader(dataset, sampler=evalutation_sampler, batch_size=evaluation_batch_size)
     predict_results = []
-    for batch in tqdm(evaluation_dataloader, desc="Evaluating"):
-        model.eval()
-        batch = tuple(t.to(device) for t in batch)
-        with torch.no_grad():
-            inputs = { "input_ids": batch[0],
-                       "input_mask": batch[1],
-                       "segment_ids": batch[2],
-                       "cls_index": batch[3],
-                       "p_mask": batch[4],}
-            index = batch[5]
-            result = model(**inputs)
-        pred_results = [OutputResult(
-            unique_id = features[index[i].item()].unique_id,
-            unk_prob=result["unk_prob"][i].item(),
-            yes_prob=result["yes_prob"][i].item(),
-            no_prob=result["no_prob"][i].item(),
-            num_probs=result["num_probs"][i].tolist(),
-            opt_probs=result["opt_probs"][i].tolist(),
-            start_prob=result["start_prob"][i].tolist(),
-            start_index=result["start_index"][i].tolist(),
-            end_prob=result["end_prob"][i].tolist(),
-            end_index=result["end_index"][i].tolist()) for i in range(result["unk_prob"].shape[0])]
-        predict_results.extend(pred_results)
+    start_time = time.time()
+    with run_report.stage("infer", "results") as stage:
+        with StepProfiler(profile, output_directory, "eval") as profiler:
+            for batch in labelled(tqdm(evaluation_dataloader, desc="Evaluating")):
+                model.eval()
+                with record_function("to_device"):
+                    batch = tuple(t.to(device) for t in batch)
+                with inference_mode():
+                    inputs = { "input_ids": batch[0],
+                               "input_mask": batch[1],
+                               "segment_ids": batch[2],
+                               "cls_index": batch[3],
+                               "p_mask": batch[4],}
+                    index = batch[5]
+                    with record_function("forward"):
+                        result = model(**inputs)
+                with record_function("to_host"):
+                    pred_results = [OutputResult(
+                        unique_id = features[index[i].item()].unique_id,
+                        unk_prob=result["unk_prob"][i].item(),
+                        yes_prob=result["yes_prob"][i].item(),
+                        no_prob=result["no_prob"][i].item(),
+                        num_probs=result["num_probs"][i].tolist(),
+                        opt_probs=result["opt_probs"][i].tolist(),
+                        start_prob=result["start_prob"][i].tolist(),
+                        start_index=result["start_index"][i].tolist(),
+                        end_prob=result["end_prob"][i].tolist(),
+                        end_index=result["end_index"][i].tolist()) for i in range(result["unk_prob"].shape[0])]
+                predict_results.extend(pred_results)
+                profiler.step()
+        stage["items"] = len(predict_results)
+    report_throughput(len(features), time.time() - start_time, device)
+    save_results(os.path.join(output_directory, LOGITS_FILE), predict_results)
 
-    predict_processor = XLNetPredictProcessor(output_dir = output_directory, tokenizer=tokenizer, predict_tag = "normal")
-    predict_processor.process(examples, features, predict_results)
+    predict_processor = XLNetPredictProcessor(output_dir = output_directory, tokenizer=tokenizer, predict_tag = "normal", jsonl = jsonl, write_detail = nbest)
+    with run_report.stage("decode", "predictions") as stage:
+        predict_processor.process(examples, features, predict_results)
+        stage["items"] = len(examples)
 
-def load_dataset(tokenizer, evaluate=False, dataset_type = None, use_gpt = None):
-    input_dir = "data"
-    examples = []
-    processor = CoqaPipeline(num_turn=0)
-    proc = processor.get_dev_examples if evaluate else processor.get_train_examples
-    assert not evaluate or (len(dataset_type) == 1)
-    for datas in dataset_type:
-        examples.extend(proc(dataset_type = datas, use_gpt = use_gpt))
+def Decode_predictions(tokenizer, decode_configs, dataset_type = None, output_directory = None, use_gpt = None, jsonl = False, nbest = False):
+    #   re-decodes the outputs stored by Write_predictions with each of decode_configs, without the model
+    dataset, examples, features = load_dataset(tokenizer, evaluate=True, use_gpt = use_gpt, dataset_type = dataset_type, features_only = True)
+    predict_results = load_results(os.path.join(output_directory, LOGITS_FILE), OutputResult)
+    for (i, decode_config) in enumerate(decode_configs):
+        predict_processor = XLNetPredictProcessor(output_dir = output_directory, tokenizer=tokenizer, predict_tag = f"decode{i}", jsonl = jsonl, write_detail = nbest, **decode_config)
+        print(f"Decoding with {decode_config} into {predict_processor.output_summary}")
+        with run_report.stage("decode", "predictions", config = i) as stage:
+            predict_processor.process(examples, features, predict_results)
+            stage["items"] = len(examples)
+
+def load_dataset(tokenizer, evaluate=False, dataset_type = None, use_gpt = None, features_only = False):
+    with run_report.stage("preprocess", "examples") as stage:
+        examples = []
+        processor = CoqaPipeline(num_turn=0)
+        proc = processor.get_dev_examples if evaluate else processor.get_train_examples
+        assert not evaluate or (len(dataset_type) == 1)
+        for datas in dataset_type:
+            examples.extend(proc(dataset_type = datas, use_gpt = use_gpt))
+        stage["items"] = len(examples)
     feat_extract = XLNetExampleProcessor(tokenizer)
-    features, dataset = feat_extract.convert_examples_to_features(examples, not evaluate)
+    with run_report.stage("features", "features") as stage:
+        if features_only:
+            #   --decode: the features without the tensors only the model reads
+            features, dataset = feat_extract.extract_features(examples), None
+        else:
+            features, dataset = feat_extract.convert_examples_to_features(examples, not evaluate)
+        stage["items"] = len(features)
     if evaluate:
         return dataset, examples, features
     return dataset
 
-def manager(isTraining,dataset_type, output_directory, use_gpt = None):
-    assert torch.cuda.is_available()
-    device = torch.device('cuda')
-    config = XLNetConfig.from_pretrained(pretrained_model)
+def manager(isTraining,dataset_type, output_directory, use_gpt = None, device = None, decode_configs = None, jsonl = False, nbest = False, profile = None, log_steps = DEFAULT_LOG_STEPS, resume = False, save_steps = DEFAULT_SAVE_STEPS, keep_checkpoints = DEFAULT_KEEP_CHECKPOINTS):
     if isTraining:
+        import torch
+        from transformers import XLNetConfig
+        from processors.runtime import setup_device
+        device = setup_device(device)
+        config = XLNetConfig.from_pretrained(pretrained_model)
         tokenizer = Tokenizer(pretrained_model)
-        model = XLNetLargeModel(config, load_pre = True)
+        model = load_model_class()(config, pretrained_model = pretrained_model, max_seq_length = max_seq_length, top_k = top_k)
         model.to(device)
-        if os.path.exists(output_directory) and os.listdir(output_directory):
-            raise ValueError(f"Output directory {output_directory}  already exists, Change output_directory name")
+        if os.path.exists(output_directory) and os.listdir(output_directory) and not resume:
+            raise ValueError(f"Output directory {output_directory}  already exists, Change output_directory name, or pass --resume to resume training in it")
         else:
-            os.makedirs(output_directory)
+            os.makedirs(output_directory, exist_ok = True)
         
         train_dataset = load_dataset(tokenizer, evaluate=False, dataset_type = dataset_type)
-        train_loss = train(train_dataset, model, tokenizer, device,output_directory)
+        train_loss = train(train_dataset, model, tokenizer, device,output_directory, profile = profile, log_steps = log_steps, resume = resume, save_steps = save_steps, keep_checkpoints = keep_checkpoints)
         tokenizer.save_pretrained(output_directory)
         torch.save(model.state_dict(), os.path.join(output_directory,'tweights.pt'))
+    elif decode_configs:
+        #   no model and no device: the outputs stored by the eval are decoded on the host
+        tokenizer = Tokenizer(output_directory)
+        Decode_predictions(tokenizer, decode_configs, dataset_type = dataset_type, output_directory = output_directory, use_gpt = use_gpt, jsonl = jsonl, nbest = nbest)
     else:
-        model = XLNetLargeModel(config)
-        model.load_state_dict(torch.load(os.path.join(output_directory,'tweights.pt')))
+        import torch
+        from transformers import XLNetConfig
+        from processors.runtime import setup_device
+        device = setup_device(device)
+        config = XLNetConfig.from_pretrained(pretrained_model)
+        model = load_model_class()(config, max_seq_length = max_seq_length, top_k = top_k)
+        state_dict, _ = strip_shadow_backbone(torch.load(os.path.join(output_directory,'tweights.pt'), map_location=device), "xlnet")
+        model.load_state_dict(state_dict)
         model.to(device)
         tokenizer = Tokenizer(output_directory)
-        Write_predictions(model, tokenizer, device, dataset_type = dataset_type, output_directory = output_directory, use_gpt = use_gpt)
+        Write_predictions(model, tokenizer, device, dataset_type = dataset_type, output_directory = output_directory, use_gpt = use_gpt, jsonl = jsonl, nbest = nbest, profile = profile)
 
 def main():
     isTraining,isEval = False, False
     train_dataset_type, eval_dataset_type = [],[]
     output_directory = "XLNet"
+    use_gpt, device, threads, interop_threads = None, None, None, None
+    profile = None
+    log_steps = DEFAULT_LOG_STEPS
+    resume, save_steps, keep_checkpoints = False, DEFAULT_SAVE_STEPS, DEFAULT_KEEP_CHECKPOINTS
+    decode_configs = None
+    jsonl, nbest = False, False
     argumentList = sys.argv[1:]
     options = "ht:e:o:"
-    long_options = ["help", "train=","eval=", "output=", "gpt="]
+    long_options = ["help", "train=","eval=", "output=", "gpt=", "device=", "threads=", "interop_threads=", "decode=", "jsonl", "nbest", "profile=", "log_steps=", "resume", "save_steps=", "keep_checkpoints="]
     try:
         arguments, values = getopt.getopt(argumentList, options, long_options)
         use_gpt = None
         for currentArgument, currentValue in arguments:
-            if currentArgument in ("-h", "--Help"):
+            if currentArgument in ("-h", "--help"):
                 print ("""python main.py --train [O|C] --eval [O|TS|RG] --output [directory name]\n
                         --train O for original training C for combined training \n
                         --eval for eval on (O) original (TS) truncated and (RG) for TS-R dataset as defined in paper\n
                         --output [dir_name] is the output directory to write weights and predictions in, 
                         and in case of eval to load weights from.
+                        --device [cuda|cpu] to run on (default cuda when available, cpu otherwise)
+                        --threads [n] --interop_threads [n] to size the intra-op/inter-op CPU thread pools
+                        --decode "key=value,...;..." with --eval to re-decode the stored outputs of a previous eval once per
+                        ';'-separated config (n_best_size, start_n_top, end_n_top, max_answer_length, answer_threshold) without the model
+                        --jsonl to write predictions one compact JSON object per line (.jsonl) as they are decoded
+                        --nbest to also write the top predictions of every question (predict_*_det)
+                        --profile [SKIP,]STEPS to record STEPS train or eval steps after the first SKIP (default 5)
+                        with the torch profiler: a Chrome trace (profile_train.json, profile_eval.json) and a
+                        per-operator table (.txt) in the output directory
+                        --log_steps K to log the mean loss, samples and tokens per second, data wait and compute
+                        time, learning rate and gradient norm of every K training steps (default 50) to
+                        train_telemetry.jsonl in the output directory
+                        --resume to resume training from the latest checkpoint in the output directory
+                        --save_steps N to write a checkpoint every N training steps (default 1000), in the
+                        background, to checkpoints/step-N in the output directory
+                        --keep_checkpoints N to keep the last N checkpoints (default 3)
                         e.g. python main.py --train C --eval RG --output XLNet_comb
                         for combined training followed by eval on RG and writing to ./XLNet_comb""")
                 return
@@ -378,13 +266,40 @@ def main():
                 output_directory = currentValue
             elif currentArgument in ("-gpt", "--gpt"):
                 use_gpt = currentValue
+            elif currentArgument == "--device":
+                device = currentValue
+            elif currentArgument == "--threads":
+                threads = int(currentValue)
+            elif currentArgument == "--interop_threads":
+                interop_threads = int(currentValue)
+            elif currentArgument == "--decode":
+                decode_configs = parse_decode_configs(currentValue, decode_defaults)
+            elif currentArgument == "--jsonl":
+                jsonl = True
+            elif currentArgument == "--nbest":
+                nbest = True
+            elif currentArgument == "--profile":
+                profile = parse_profile_window(currentValue)
+            elif currentArgument == "--log_steps":
+                log_steps = parse_log_steps(currentValue)
+            elif currentArgument == "--resume":
+                resume = True
+            elif currentArgument == "--save_steps":
+                save_steps = parse_positive(currentArgument, currentValue)
+            elif currentArgument == "--keep_checkpoints":
+                keep_checkpoints = parse_positive(currentArgument, currentValue)
 
     except getopt.error as err:
         print (str(err))
 
+    if threads or interop_threads:
+        from processors.runtime import set_threads
+        set_threads(threads, interop_threads)
     if isTraining:
-        manager(isTraining = True, dataset_type = train_dataset_type, output_directory = output_directory)
+        manager(isTraining = True, dataset_type = train_dataset_type, output_directory = output_directory, device = device, profile = profile, log_steps = log_steps, resume = resume, save_steps = save_steps, keep_checkpoints = keep_checkpoints)
     if isEval:
-        manager(isTraining = False, dataset_type = eval_dataset_type, output_directory = output_directory, use_gpt = use_gpt)
+        manager(isTraining = False, dataset_type = eval_dataset_type, output_directory = output_directory, use_gpt = use_gpt, device = device, decode_configs = decode_configs, jsonl = jsonl, nbest = nbest, profile = profile)
+    if isTraining or isEval:
+        run_report.save(os.path.join(output_directory, RUN_REPORT_FILE))
 if __name__ == "__main__":
     main()
@@ -0,0 +1,113 @@
+"""Converts XLNet checkpoints written before XLNetBaseModel stopped carrying a second, unused backbone.
+
+    python migrate_checkpoint.py --input XLNet_orig --output XLNet_orig_migrated --check
+
+--input is a tweights.pt / pytorch_model.bin file or an output directory holding them (e.g. the training
+output directory or its model_weights/ snapshot). Tokenizer and config files are copied alongside.
+--check loads the migrated weights strictly into the current model class, verifies every tensor is identical to
+the one forward used before, and runs the original weights through the old class (which also subclassed
+XLNetModel) and the migrated ones through the current class on random sequences, comparing the outputs.
+"""
+import argparse
+import importlib
+import os
+import shutil
+
+import torch
+from transformers import XLNetModel
+
+from processors.checkpoint import strip_shadow_backbone
+
+BACKBONE_PREFIX = "xlnet"
+WEIGHT_FILES = ["tweights.pt", "pytorch_model.bin"]
+#   Optimizer state is keyed by parameter position in the old (doubled) parameter list, so it cannot be carried over.
+SKIPPED_FILES = ["optimizer.pt", "scheduler.pt"]
+
+
+def add_arguments(parser):
+    parser.add_argument("--input", help="checkpoint file or directory to convert", required=True)
+    parser.add_argument("--output", help="file or directory to write the converted checkpoint to", required=True)
+    parser.add_argument("--main", help="main script whose model class loads the weights, e.g. main-large", default="main")
+    parser.add_argument("--check", help="verify the converted weights against the original ones", action="store_true")
+
+
+def legacy_model_class(model_class):
+    """The model class as it was before the migration: the current one on top of a second, unused XLNetModel."""
+    return type("Legacy" + model_class.__name__, (model_class, XLNetModel), {})
+
+
+def random_inputs(config, batch_size=2, seq_length=16, seed=0):
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    input_ids = torch.randint(config.vocab_size, (batch_size, seq_length), generator=generator)
+    #   no padding and every token a possible answer; the CLS token is last in XLNet inputs
+    return {"input_ids": input_ids, "input_mask": torch.zeros_like(input_ids), "segment_ids": torch.zeros_like(input_ids),
+            "p_mask": torch.zeros_like(input_ids), "cls_index": torch.full((batch_size,), seq_length - 1, dtype=torch.long)}
+
+
+def output_tensors(outputs):
+    if isinstance(outputs, dict):
+        return [outputs[key] for key in sorted(outputs)]
+    return list(outputs)
+
+
+def check_migration(original, migrated, main_module, config_dir=None):
+    module = importlib.import_module(main_module)
+    model_class = module.load_model_class()
+    config_class = model_class.config_class
+    if config_dir is not None and os.path.isfile(os.path.join(config_dir, "config.json")):
+        config = config_class.from_pretrained(config_dir)
+    else:
+        config = config_class.from_pretrained(module.pretrained_model)
+    model = model_class(config)
+    model.load_state_dict(migrated)
+    for key, value in model.state_dict().items():
+        if not torch.equal(value, original[key]):
+            raise ValueError(f"Converted tensor {key} differs from the original checkpoint")
+    legacy_model = legacy_model_class(model_class)(config)
+    legacy_model.load_state_dict(original)
+    inputs = random_inputs(config)
+    legacy_model.eval()
+    model.eval()
+    with torch.no_grad():
+        expected, outputs = output_tensors(legacy_model(**inputs)), output_tensors(model(**inputs))
+    for (i, (expected_output, output)) in enumerate(zip(expected, outputs)):
+        if not torch.allclose(expected_output.float(), output.float()):
+            raise ValueError(f"Output {i} of {model_class.__name__} on the converted weights differs from the original model")
+    print(f"Checked {len(migrated)} tensors and the {len(outputs)} outputs on {inputs['input_ids'].size(0)} random sequences "
+          f"against {model_class.__name__}: predictions are unchanged")
+
+
+def migrate_file(input_file, output_file, main_module=None, check=False):
+    original = torch.load(input_file, map_location="cpu")
+    migrated, dropped = strip_shadow_backbone(original, BACKBONE_PREFIX)
+    torch.save(migrated, output_file)
+    print(f"{input_file} -> {output_file}: kept {len(migrated)} tensors, dropped {len(dropped)} shadow backbone tensors")
+    if check:
+        check_migration(original, migrated, main_module, config_dir=os.path.dirname(input_file))
+
+
+def migrate(input_path, output_path, main_module="main", check=False):
+    if os.path.isfile(input_path):
+        migrate_file(input_path, output_path, main_module, check)
+        return
+    if os.path.abspath(input_path) == os.path.abspath(output_path):
+        raise ValueError("Output directory must differ from the input directory")
+    os.makedirs(output_path, exist_ok=True)
+    for name in sorted(os.listdir(input_path)):
+        source, target = os.path.join(input_path, name), os.path.join(output_path, name)
+        if os.path.isdir(source):
+            continue
+        if name in WEIGHT_FILES:
+            migrate_file(source, target, main_module, check)
+        elif name in SKIPPED_FILES:
+            print(f"Skipping {source}: optimizer/scheduler state of the old model cannot be reused")
+        else:
+            shutil.copy2(source, target)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    args = parser.parse_args()
+    migrate(args.input, args.output, args.main, args.check)
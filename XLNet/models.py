@@ -0,0 +1,211 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn import BCEWithLogitsLoss
+from transformers import XLNetModel, XLNetPreTrainedModel
+from processors.profiling import record_function
+
+
+#   XLNetBaseModel, the model of main.py and main_hotpotqa.py, and XLNetLargeModel, of main-large.py and
+#   main_large_hotpotqa.py. The main scripts import them only to train or evaluate, so --help and --decode,
+#   which do without the model, do not load torch and transformers for them.
+
+MIN_FLOAT = -1e30
+
+
+class XLNetBaseModel(XLNetPreTrainedModel):
+    def __init__(self,config, pretrained_model = None, max_seq_length = 512, top_k = 5):
+        #   pretrained_model: the name or directory of the XLNet weights to start from, random ones if None;
+        #   top_k: the start and end candidates kept at evaluation
+        super(XLNetBaseModel,self).__init__(config)
+        self.xlnet = XLNetModel.from_pretrained(pretrained_model, config=config,) if pretrained_model else XLNetModel(config)
+        hidden_size = config.hidden_size
+        self.seq_len = max_seq_length
+        self.top_k = top_k
+        self.start_project = nn.Linear(hidden_size,1)
+        self.end_modelling = nn.Linear(2*hidden_size,hidden_size)
+        self.end_norm = nn.LayerNorm(hidden_size)
+        self.end_project = nn.Linear(hidden_size,1)
+        self.answer_modelling = nn.Linear(2*hidden_size,hidden_size)
+        self.answer_drop = nn.Dropout(p=0.1)
+        self.unk_project = nn.Linear(hidden_size,1)
+        self.yes_project = nn.Linear(hidden_size,1)
+        self.no_project = nn.Linear(hidden_size,1)
+        self.num_project = nn.Linear(hidden_size,12)
+        self.opt_project = nn.Linear(hidden_size,3)
+        self.relu = nn.ReLU
+
+    def generate_masked_data(self, input_data, input_mask):
+        return input_data * input_mask + MIN_FLOAT * (1 - input_mask)
+
+    def compute_loss(self, label, label_mask, predict, predict_mask, size ,):
+        masked_predict = self.generate_masked_data(predict, predict_mask)
+        masked_label = label.type(torch.long) * label_mask.type(torch.long)
+        masked_label = F.one_hot(masked_label,size)
+        loss = -torch.sum(F.log_softmax(masked_predict, dim=1) * masked_label, dim=1)
+        return loss
+
+    def forward(self,input_ids,
+            input_mask, segment_ids,
+            p_mask, cls_index,
+            start_positions=None,end_positions=None,
+            is_unk = None,is_yes = None,
+            is_no = None, number = None, 
+            option = None,):
+        
+        predicts = {}
+        #****************************************XLNET-BASE***************************
+        with record_function("encoder"):
+            output_result,_ = self.xlnet(input_ids,
+                                token_type_ids=segment_ids,
+                                input_mask=input_mask,
+                                return_dict = False)
+        #****************************************START MODELLIING*********************
+        with record_function("start_head"):
+            start_result = output_result
+            start_result_mask = 1 - p_mask
+            start_result = self.start_project(start_result)
+            start_result = torch.squeeze(start_result, dim=-1)
+            start_result = self.generate_masked_data(start_result, start_result_mask)
+            start_prob = torch.softmax(start_result, dim=-1)
+        
+            if not self.training:
+                start_top_prob, start_top_index = torch.topk(start_prob, k=self.top_k)
+                predicts["start_prob"] = start_top_prob
+                predicts["start_index"] = start_top_index
+
+        #****************************************END MODELLIING***********************
+        # end_modelling is applied to [token; start feature]. Its weight is split into a token
+        # projection and a start-feature projection that are computed once and broadcast-added,
+        # so neither the (seq_len x top_k) repeat nor the 2*hidden concat is materialized.
+        with record_function("end_head"):
+            hidden_size = output_result.size(-1)
+            end_token_weight, end_start_weight = self.end_modelling.weight.split(hidden_size, dim=-1)
+            end_token_result = F.linear(output_result, end_token_weight, self.end_modelling.bias)
+            if self.training:
+                start_index = start_positions.view(-1, 1, 1).expand(-1, 1, hidden_size)
+                feat_result = torch.gather(output_result, 1, start_index)
+            
+                end_result = end_token_result + F.linear(feat_result, end_start_weight)
+                end_result_mask = 1 - p_mask
+            
+                end_result = torch.tanh(end_result)
+                end_result = self.end_norm(end_result)
+                end_result = self.end_project(end_result)
+            
+                end_result = torch.squeeze(end_result, dim=-1)
+                end_result = self.generate_masked_data(end_result, end_result_mask)
+                end_prob = torch.softmax(end_result, dim=-1)
+            else:
+                start_index = torch.unsqueeze(start_top_index, dim=-1).expand(-1, -1, hidden_size)
+                feat_result = torch.gather(output_result, 1, start_index)
+            
+                # (B, 1, seq_len, H) + (B, top_k, 1, H) -> (B, top_k, seq_len, H)
+                end_result = torch.unsqueeze(end_token_result, dim=1) + torch.unsqueeze(F.linear(feat_result, end_start_weight), dim=2)
+                end_result_mask = torch.unsqueeze(1 - p_mask, dim=1)
+            
+                end_result = torch.tanh(end_result)
+                end_result = self.end_norm(end_result)
+                end_result = self.end_project(end_result)
+            
+                end_result = torch.squeeze(end_result, dim=-1)
+                end_result = self.generate_masked_data(end_result, end_result_mask)
+                end_prob = torch.softmax(end_result, dim=-1)
+            
+                end_top_prob, end_top_index = torch.topk(end_prob, k=self.top_k)
+                predicts["end_prob"] = end_top_prob
+                predicts["end_index"] = end_top_index
+
+        #****************************************ANSWER MODELLING*********************
+        with record_function("answer_heads"):
+            answer_cls_index = cls_index.view(-1, 1, 1).expand(-1, 1, hidden_size)
+            answer_feat_result = (torch.unsqueeze(start_prob, dim=1)) @ output_result
+            answer_output_result = torch.gather(output_result, 1, answer_cls_index)
+            answer_result = torch.cat([answer_feat_result, answer_output_result], dim=-1)
+            answer_result = torch.squeeze(answer_result, dim=1)
+            answer_result = torch.tanh( self.answer_modelling(answer_result))
+            answer_result = self.answer_drop(answer_result)
+        
+            #****************************************UNKNOWN MODELLING********************
+            unk_result = self.unk_project(answer_result)
+            unk_result_mask,_ = torch.max(1 - p_mask, dim=-1)
+            unk_result = torch.squeeze(unk_result, dim=-1)
+            unk_result = self.generate_masked_data(unk_result, unk_result_mask)
+            unk_prob = torch.sigmoid(unk_result)
+            predicts["unk_prob"] = unk_prob
+        
+            #****************************************YES MODELLING************************
+            yes_result = self.yes_project(answer_result)
+            yes_result_mask,_ = torch.max(1 - p_mask, dim=-1)
+            yes_result = torch.squeeze(yes_result, dim=-1)
+            yes_result = self.generate_masked_data(yes_result, yes_result_mask)
+            yes_prob = torch.sigmoid(yes_result)
+            predicts["yes_prob"] = yes_prob
+        
+            #****************************************NO MODELLING*************************
+            no_result = self.no_project(answer_result)
+            no_result_mask,_ = torch.max(1 - p_mask, dim=-1)
+            no_result = torch.squeeze(no_result, dim=-1)
+            no_result = self.generate_masked_data(no_result, no_result_mask)
+            no_prob = torch.sigmoid(no_result)
+            predicts["no_prob"] = no_prob
+        
+            #****************************************NUM MODELLING************************
+            num_result = self.num_project(answer_result)
+            num_result_mask,_ = torch.max(1 - p_mask, dim=-1, keepdims=True)
+            num_result = self.generate_masked_data(num_result, num_result_mask)
+            num_probs = torch.softmax(num_result, dim=-1)
+            predicts["num_probs"] = num_probs
+        
+            #****************************************OPT MODELLIING***********************
+            opt_result = self.opt_project(answer_result)
+            opt_result_mask,_ = torch.max(1 - p_mask, dim=-1, keepdims=True)
+            opt_result = self.generate_masked_data(opt_result, opt_result_mask)
+            opt_probs = torch.softmax(opt_result, dim=-1)
+            predicts["opt_probs"] = opt_probs
+    
+        #****************************************LOSSES********************************
+        bce = BCEWithLogitsLoss(reduction = "none")
+        loss = 0.0
+        if self.training:
+            with record_function("loss"):
+                start_label = start_positions
+                start_label_mask,_ = torch.max(1 - p_mask, dim=-1)
+                start_loss = self.compute_loss(start_label, start_label_mask, start_result, start_result_mask, self.seq_len)
+                end_label = end_positions
+                end_label_mask,_ = torch.max(1 - p_mask, dim=-1)
+                end_loss = self.compute_loss(end_label, end_label_mask, end_result, end_result_mask,self.seq_len)
+                loss += torch.mean(start_loss + end_loss)
+            
+                unk_label = is_unk
+                unk_label_mask,_ = torch.max(1 - p_mask, dim=-1)
+                unk_loss = bce(unk_result,unk_label.type(torch.float) * unk_label_mask.type(torch.float))
+                loss += torch.mean(unk_loss)
+            
+                yes_label = is_yes
+                yes_label_mask,_ = torch.max(1 - p_mask, dim=-1)
+                yes_loss = bce(yes_result, yes_label.type(torch.float) * yes_label_mask.type(torch.float))
+                loss += torch.mean(yes_loss)
+            
+                no_label = is_no
+                no_label_mask,_ = torch.max(1 - p_mask, dim=-1)
+                no_loss = bce(no_result, no_label.type(torch.float) * no_label_mask.type(torch.float))
+                loss += torch.mean(no_loss)
+            
+                num_label = number
+                num_label_mask,_ = torch.max(1 - p_mask, dim=-1)
+                num_loss = self.compute_loss(num_label, num_label_mask, num_result, num_result_mask, 12)
+                loss += torch.mean(num_loss)
+            
+                opt_label = option
+                opt_label_mask,_ = torch.max(1 - p_mask, dim=-1)
+                opt_loss = self.compute_loss(opt_label, opt_label_mask, opt_result, opt_result_mask,3)
+                loss += torch.mean(opt_loss)
+
+            return loss
+        return predicts
+
+
+class XLNetLargeModel(XLNetBaseModel):
+    #   the architecture of XLNetBaseModel, at the size of the xlnet-large-cased config
+    pass
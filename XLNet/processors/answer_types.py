@@ -0,0 +1,77 @@
+import re
+import string
+
+import numpy as np
+
+
+#   Turns the summary XLNetPredictProcessor writes for each example (unk/yes/no/number/option scores and the best
+#   span) into the answer the evaluators expect. Used in process() to write evaluator-ready predictions directly,
+#   and by results/convert_coqa.py and results/convert_hotpotqa.py for existing predict_*_sum.json files.
+
+ANSWER_THRESHOLD = 0.1
+ANSWER_TYPES = ["unknown", "yes", "no", "number", "option"]
+NUMBERS = ["none", "one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten"]
+
+
+def normalize_answer(s):
+    """Lower text and remove punctuation, articles and extra whitespace."""
+
+    def remove_articles(text):
+        return re.sub(r'\b(a|an|the)\b', ' ', text)
+
+    def white_space_fix(text):
+        return ' '.join(text.split())
+
+    def remove_punc(text):
+        exclude = set(string.punctuation)
+        return ''.join(ch for ch in text if ch not in exclude)
+
+    def lower(text):
+        return text.lower()
+
+    return white_space_fix(remove_articles(remove_punc(lower(s))))
+
+
+def answer_type(summary, answer_threshold=ANSWER_THRESHOLD):
+    """The highest scoring of the unknown/yes/no/number/option classes, or None when its score is below
+    answer_threshold and the predicted span is the answer."""
+    score_list = [summary["unk_score"], summary["yes_score"], summary["no_score"], summary["num_score"], summary["opt_score"]]
+    score_idx = np.argmax(score_list)
+    if score_list[score_idx] >= answer_threshold:
+        return ANSWER_TYPES[score_idx]
+    return None
+
+
+def resolve_answer(summary, answer_threshold=ANSWER_THRESHOLD):
+    answer = answer_type(summary, answer_threshold)
+    if answer == "number":
+        answer = NUMBERS[summary["num_id"]-1]
+    elif answer == "option":
+        answer = summary["predict_text"]
+        norm_question_tokens = normalize_answer(summary["question_text"]).split(" ")
+        if "or" in norm_question_tokens:
+            index = norm_question_tokens.index("or")
+            if index-1 >= 0 and index+1 < len(norm_question_tokens):
+                answer_list = [norm_question_tokens[index-1], norm_question_tokens[index+1]]
+                answer = answer_list[summary["opt_id"]-1]
+    elif answer is None:
+        answer = summary["predict_text"]
+    return answer
+
+
+def coqa_prediction(summary, answer_threshold=ANSWER_THRESHOLD):
+    """CoQA evaluator entry of an example summary; qas_id is <story id>_<turn id>."""
+    id_items = summary["qas_id"].split('_')
+    return {
+        "id": id_items[0],
+        "turn_id": int(id_items[1]),
+        "answer": resolve_answer(summary, answer_threshold)
+    }
+
+
+def hotpotqa_prediction(summary, answer_threshold=ANSWER_THRESHOLD):
+    """HotpotQA evaluator entry of an example summary."""
+    return {
+        "id": [summary["qas_id"]],
+        "answer": resolve_answer(summary, answer_threshold)
+    }
@@ -0,0 +1,22 @@
+import collections
+
+
+#   Older RobertaBaseModel/XLNetBaseModel subclassed the backbone *and* held it as self.roberta/self.xlnet,
+#   so their state dicts carry a second, unused copy of the transformer at the top level.
+#   Only the prefixed copy (and the heads) were ever used in forward.
+SHADOW_BACKBONE_KEYS = {
+    "roberta": ("embeddings.", "encoder.", "pooler."),
+    "xlnet": ("word_embedding.", "mask_emb", "layer."),
+}
+
+
+def strip_shadow_backbone(state_dict, backbone_prefix):
+    """Returns a copy of state_dict without the unused top-level backbone copy, plus the dropped keys."""
+    shadow_keys = SHADOW_BACKBONE_KEYS[backbone_prefix]
+    kept, dropped = collections.OrderedDict(), []
+    for key, value in state_dict.items():
+        if key.startswith(shadow_keys):
+            dropped.append(key)
+        else:
+            kept[key] = value
+    return kept, dropped
@@ -1,18 +1,17 @@
 import sys
 import collections
+import contextlib
 import os
 import os.path
 import json
 import numpy as np
-import torch
 import string
 from string import punctuation as punct
 import re
-from transformers import XLNetTokenizer, XLNetConfig
 from multiprocessing import Pool, cpu_count
 from tqdm import tqdm
-from torch.utils.data import TensorDataset
-import spacy
+from processors.prediction_writer import PredictionWriter, prediction_path
+from processors.answer_types import ANSWER_THRESHOLD, hotpotqa_prediction
 
 train_file = "hotpot_train_v1.1_new.json"
 test_file = "hotpot_dev_distractor_v1_new.json"
@@ -422,6 +421,7 @@ class CoqaPipeline(object):
         assert dataset_type in [None,"RG"]
         if use_gpt:
             d_chatgpt = np.load("chatgpt_sents_d_hotpotqa.npy",allow_pickle=True)[()]
+        import spacy
         nlp = spacy.load('en_core_web_sm', parser=False) 
         examples = []
         for cnt,data in tqdm(enumerate(data_list),total = len(data_list),desc = "Preprocessing "):
@@ -548,6 +548,7 @@ class CoqaPipeline(object):
 class Tokenizer(object):
 
     def __init__(self, pretrained_model_or_dir):
+        from transformers import XLNetTokenizer
         self.tokenizer = XLNetTokenizer.from_pretrained(pretrained_model_or_dir)
         self.do_lower_case = self.tokenizer.do_lower_case
 
@@ -926,7 +927,8 @@ class XLNetExampleProcessor(object):
         
         return feature_list
     
-    def convert_examples_to_features(self, examples, is_training):
+    def extract_features(self, examples):
+        """The features of examples, numbered with their unique_id, without the tensors of convert_examples_to_features."""
         threads = cpu_count()
         with Pool(threads) as p:
             examp = list(tqdm(
@@ -935,7 +937,12 @@ class XLNetExampleProcessor(object):
         features = [item for sublist in examp for item in sublist]
         for i in range(len(features)):
             features[i].unique_id = 10000000+i 
+        return features
 
+    def convert_examples_to_features(self, examples, is_training):
+        import torch
+        from torch.utils.data import TensorDataset
+        features = self.extract_features(examples)
         all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
         all_input_mask = torch.tensor([f.input_mask for f in features], dtype=torch.long)
         all_segment_ids = torch.tensor([f.segment_ids for f in features], dtype=torch.long)
@@ -966,7 +973,7 @@ class XLNetExampleProcessor(object):
         return features, dataset
 
 class XLNetPredictProcessor(object):
-    def __init__(self, output_dir, tokenizer, n_best_size = 5, start_n_top = 5, end_n_top = 5, max_answer_length = 16,  predict_tag=None):
+    def __init__(self, output_dir, tokenizer, n_best_size = 5, start_n_top = 5, end_n_top = 5, max_answer_length = 16,  predict_tag=None, jsonl=False, write_detail=False, answer_threshold=ANSWER_THRESHOLD):
         self.n_best_size = n_best_size
         self.start_n_top = start_n_top
         self.end_n_top = end_n_top
@@ -974,177 +981,193 @@ class XLNetPredictProcessor(object):
         self.tokenizer = tokenizer
         
         predict_tag = predict_tag if predict_tag else "normal"
-        self.output_summary = os.path.join(output_dir, "predict_{0}_sum.json".format(predict_tag))
-        self.output_detail = os.path.join(output_dir, "predict_{0}_det.json".format(predict_tag))
-    
-    def _write_to_json(self, data_list, data_path):
-        data_folder = os.path.dirname(data_path)
-        if not os.path.exists(data_folder):
-            os.mkdir(data_folder)
-
-        with open(data_path, "w") as file:  
-            json.dump(data_list, file, indent=4)
+        #   one summary entry per example is written as it is decoded (one per line with jsonl); the detail file
+        #   with the top predictions of every example only when write_detail is set
+        self.output_summary = prediction_path(os.path.join(output_dir, "predict_{0}_sum.json".format(predict_tag)), jsonl)
+        self.output_detail = prediction_path(os.path.join(output_dir, "predict_{0}_det.json".format(predict_tag)), jsonl)
+        self.write_detail = write_detail
+        #   evaluator-ready predictions, with the answer type of each summary resolved against answer_threshold as
+        #   results/convert_*.py do
+        self.output_answers = prediction_path(os.path.join(output_dir, "predict_{0}_answers.json".format(predict_tag)), jsonl)
+        self.answer_threshold = answer_threshold
    
+    @staticmethod
+    def _class_scores(class_probs):
+        """Most probable class above 0 (number or option) of every result row and its probability."""
+        if not class_probs:
+            return [], []
+        class_probs = np.asarray(class_probs, dtype=np.float64)
+        class_ids = np.argmax(class_probs[:, 1:], axis=1) + 1
+        return class_ids.tolist(), class_probs[np.arange(len(class_probs)), class_ids].tolist()
+
+    @staticmethod
+    def _example_class(rows, class_ids, class_scores, class_probs):
+        example_class_id, example_class_score, example_class_probs = 0, MIN_FLOAT, None
+        for row in rows:
+            if example_class_score < class_scores[row]:
+                example_class_id, example_class_score = class_ids[row], class_scores[row]
+                example_class_probs = [float(prob) for prob in class_probs[row]]
+        return example_class_id, example_class_score, example_class_probs
+
+    def _rank_candidates(self, features, results, example_rows):
+        """Valid span candidates of all examples, as row, start index, end index and score lists sorted by example and
+        best score first, and the bounds of each example's candidates in them.
+
+        The start_n_top x end_n_top candidates of all result rows are masked and scored at once, in a (row, start, end)
+        grid; example_rows lists the rows of features/results of each example, contiguous and in order."""
+        if not results:
+            return ([], [], [], []), [0] * (len(example_rows) + 1)
+        start_prob = np.asarray([result.start_prob for result in results], dtype=np.float64)[:, :self.start_n_top]
+        start_index = np.asarray([result.start_index for result in results])[:, :self.start_n_top]
+        end_prob = np.asarray([result.end_prob for result in results], dtype=np.float64)[:, :self.start_n_top, :self.end_n_top]
+        end_index = np.asarray([result.end_index for result in results])[:, :self.start_n_top, :self.end_n_top]
+
+        in_doc = np.asarray([[index in feature.token2doc_index for index in row] for (feature, row) in zip(features, start_index.tolist())])
+        para_length = np.asarray([feature.para_length for feature in features])[:, None, None]
+        start_index = np.broadcast_to(start_index[:, :, None], end_index.shape)
+        valid = (end_index >= start_index) & (end_index - start_index + 1 <= self.max_answer_length)
+        valid &= (start_index <= para_length) & (end_index <= para_length) & in_doc[:, :, None]
+
+        rows = np.nonzero(valid)[0]
+        starts, ends = start_index[valid], end_index[valid]
+        scores = np.log(np.broadcast_to(start_prob[:, :, None], end_prob.shape)[valid]) + np.log(end_prob[valid])
+        row_example = np.repeat(np.arange(len(example_rows)), [len(example_row_list) for example_row_list in example_rows])[rows]
+        #   stable, so candidates with equal scores keep their (row, start, end) order
+        order = np.lexsort((-scores, row_example))
+        bounds = [0] + np.cumsum(np.bincount(row_example, minlength=len(example_rows))).tolist()
+        return (rows[order].tolist(), starts[order].tolist(), ends[order].tolist(), scores[order].tolist()), bounds
+
+    def _top_predicts(self, example, features, candidates, positions):
+        """Best n_best_size distinct answer texts of an example with their scores, from the ranked candidates at
+        positions; text is only extracted until n_best_size distinct ones are found."""
+        rows, start_indexes, end_indexes, predict_scores = candidates
+        is_visited = set()
+        top_predicts = []
+        for k in positions:
+            if len(top_predicts) >= self.n_best_size:
+                break
+
+            row, start_index, end_index, predict_score = rows[k], start_indexes[k], end_indexes[k], predict_scores[k]
+            feature = features[row]
+            predict_start = feature.token2char_raw_start_index[start_index]
+            if end_index >= len(feature.token2char_raw_end_index):
+                end_index = len(feature.token2char_raw_end_index)-1
+            predict_end = feature.token2char_raw_end_index[end_index]
+            predict_text = example.paragraph_text[predict_start:predict_end + 1].strip()
+
+            if predict_text in is_visited:
+                continue
+
+            is_visited.add(predict_text)
+
+            top_predicts.append({
+                "predict_text": predict_text,
+                "predict_score": predict_score
+            })
+
+        if len(top_predicts) == 0:
+            top_predicts.append({
+                "predict_text": "",
+                "predict_score": 0.0
+            })
+
+        return top_predicts
+
     def process(self, examples, features, results):
         qas_id_to_features = {}
-        unique_id_to_feature = {}
         for feature in features:
             if feature.qas_id not in qas_id_to_features:
                 qas_id_to_features[feature.qas_id] = []
             
             qas_id_to_features[feature.qas_id].append(feature)
-            unique_id_to_feature[feature.unique_id] = feature
         
         unique_id_to_result = {}
         for result in results:
             unique_id_to_result[result.unique_id] = result
         
-        predict_summary_list = []
-        predict_detail_list = []
-        num_example = len(examples)
-        for (example_idx, example) in enumerate(examples):
-            if example_idx % 1000 == 0:
-                print('Updating {0}/{1} example with predict'.format(example_idx, num_example))
-            
-            if example.qas_id not in qas_id_to_features:
-                print('No feature found for example: {0}'.format(example.qas_id))
-                continue
-            
-            example_unk_score = MAX_FLOAT
-            example_yes_score = MIN_FLOAT
-            example_no_score = MIN_FLOAT
-            example_num_id = 0
-            example_num_score = MIN_FLOAT
-            example_num_probs = None
-            example_opt_id = 0
-            example_opt_score = MIN_FLOAT
-            example_opt_probs = None
+        #   features that have a result, as rows grouped by example, so the candidates of all of them are scored at once
+        row_features, row_results, example_rows = [], [], []
+        for example in examples:
+            rows = []
+            for feature in qas_id_to_features.get(example.qas_id, []):
+                if feature.unique_id in unique_id_to_result:
+                    rows.append(len(row_results))
+                    row_features.append(feature)
+                    row_results.append(unique_id_to_result[feature.unique_id])
+            example_rows.append(rows)
+        candidates, candidate_bounds = self._rank_candidates(row_features, row_results, example_rows)
+        num_probs = [result.num_probs for result in row_results]
+        opt_probs = [result.opt_probs for result in row_results]
+        num_ids, num_scores = self._class_scores(num_probs)
+        opt_ids, opt_scores = self._class_scores(opt_probs)
+        
+        output_folder = os.path.dirname(self.output_summary)
+        if not os.path.exists(output_folder):
+            os.mkdir(output_folder)
+
+        with PredictionWriter(self.output_summary) as summary_writer, PredictionWriter(self.output_answers) as answer_writer, \
+                (PredictionWriter(self.output_detail) if self.write_detail else contextlib.nullcontext()) as detail_writer:
+            num_example = len(examples)
+            for (example_idx, example) in enumerate(examples):
+                if example_idx % 1000 == 0:
+                    print('Updating {0}/{1} example with predict'.format(example_idx, num_example))
             
-            example_all_predicts = []
-            example_features = qas_id_to_features[example.qas_id]
-            for example_feature in example_features:
-                if example_feature.unique_id not in unique_id_to_result:
-                    print('No result found for feature: {0}'.format(example_feature.unique_id))
+                if example.qas_id not in qas_id_to_features:
+                    print('No feature found for example: {0}'.format(example.qas_id))
                     continue
-                
-                example_result = unique_id_to_result[example_feature.unique_id]
-                example_unk_score = min(example_unk_score, float(example_result.unk_prob))
-                example_yes_score = max(example_yes_score, float(example_result.yes_prob))
-                example_no_score = max(example_no_score, float(example_result.no_prob))
-                
-                num_probs = [float(num_prob) for num_prob in example_result.num_probs]
-                num_id = int(np.argmax(num_probs[1:])) + 1
-                num_score = num_probs[num_id]
-                if example_num_score < num_score:
-                    example_num_id = num_id
-                    example_num_score = num_score
-                    example_num_probs = num_probs
-                
-                opt_probs = [float(opt_prob) for opt_prob in example_result.opt_probs]
-                opt_id = int(np.argmax(opt_probs[1:])) + 1
-                opt_score = opt_probs[opt_id]
-                if example_opt_score < opt_score:
-                    example_opt_id = opt_id
-                    example_opt_score = opt_score
-                    example_opt_probs = opt_probs
-                
-                for i in range(self.start_n_top):
-                    start_prob = example_result.start_prob[i]
-                    start_index = example_result.start_index[i]
-                    
-                    for j in range(self.end_n_top):
-                        end_prob = example_result.end_prob[i][j]
-                        end_index = example_result.end_index[i][j]
-                        
-                        answer_length = end_index - start_index + 1
-                        if end_index < start_index or answer_length > self.max_answer_length:
-                            continue
-                        
-                        if start_index > example_feature.para_length or end_index > example_feature.para_length:
-                            continue
-                        
-                        if start_index not in example_feature.token2doc_index:
-                            continue
-                        
-                        example_all_predicts.append({
-                            "unique_id": example_result.unique_id,
-                            "start_prob": float(start_prob),
-                            "start_index": int(start_index),
-                            "end_prob": float(end_prob),
-                            "end_index": int(end_index),
-                            "predict_score": float(np.log(start_prob) + np.log(end_prob))
-                        })
             
-            example_all_predicts = sorted(example_all_predicts, key=lambda x: x["predict_score"], reverse=True)
-            
-            is_visited = set()
-            example_top_predicts = []
-            for example_predict in example_all_predicts:
-                if len(example_top_predicts) >= self.n_best_size:
-                    break
-                
-                example_feature = unique_id_to_feature[example_predict["unique_id"]]
-                predict_start = example_feature.token2char_raw_start_index[example_predict["start_index"]]
-                if example_predict["end_index"] >= len(example_feature.token2char_raw_end_index):
-                    example_predict["end_index"] = len(example_feature.token2char_raw_end_index)-1
-                predict_end = example_feature.token2char_raw_end_index[example_predict["end_index"]]
-                predict_text = example.paragraph_text[predict_start:predict_end + 1].strip()
-                
-                if predict_text in is_visited:
-                    continue
-                
-                is_visited.add(predict_text)
-                
-                example_top_predicts.append({
-                    "predict_text": predict_text,
-                    "predict_score": example_predict["predict_score"]
-                })
-            
-            if len(example_top_predicts) == 0:
-                example_top_predicts.append({
-                    "predict_text": "",
-                    "predict_score": 0.0
-                })
-            
-            example_best_predict = example_top_predicts[0]
+                for example_feature in qas_id_to_features[example.qas_id]:
+                    if example_feature.unique_id not in unique_id_to_result:
+                        print('No result found for feature: {0}'.format(example_feature.unique_id))
+
+                rows = example_rows[example_idx]
+                example_unk_score = min([MAX_FLOAT] + [float(row_results[row].unk_prob) for row in rows])
+                example_yes_score = max([MIN_FLOAT] + [float(row_results[row].yes_prob) for row in rows])
+                example_no_score = max([MIN_FLOAT] + [float(row_results[row].no_prob) for row in rows])
+                example_num_id, example_num_score, example_num_probs = self._example_class(rows, num_ids, num_scores, num_probs)
+                example_opt_id, example_opt_score, example_opt_probs = self._example_class(rows, opt_ids, opt_scores, opt_probs)
+
+                example_top_predicts = self._top_predicts(example, row_features, candidates, range(candidate_bounds[example_idx], candidate_bounds[example_idx + 1]))
+                example_best_predict = example_top_predicts[0]
             
-            example_question_text = example.question_text.split('<s>')[-1].strip()
+                example_question_text = example.question_text.split('<s>')[-1].strip()
             
-            predict_summary_list.append({
-                "qas_id": example.qas_id,
-                "question_text": example_question_text, 
-                "label_text": example.orig_answer_text,
-                "unk_score": example_unk_score,
-                "yes_score": example_yes_score,
-                "no_score": example_no_score,
-                "num_id": example_num_id,
-                "num_score": example_num_score,
-                "num_probs": example_num_probs,
-                "opt_id": example_opt_id,
-                "opt_score": example_opt_score,
-                "opt_probs": example_opt_probs,
-                "predict_text": example_best_predict["predict_text"],
-                "predict_score": example_best_predict["predict_score"]
-            })
+                example_summary = {
+                    "qas_id": example.qas_id,
+                    "question_text": example_question_text, 
+                    "label_text": example.orig_answer_text,
+                    "unk_score": example_unk_score,
+                    "yes_score": example_yes_score,
+                    "no_score": example_no_score,
+                    "num_id": example_num_id,
+                    "num_score": example_num_score,
+                    "num_probs": example_num_probs,
+                    "opt_id": example_opt_id,
+                    "opt_score": example_opt_score,
+                    "opt_probs": example_opt_probs,
+                    "predict_text": example_best_predict["predict_text"],
+                    "predict_score": example_best_predict["predict_score"]
+                }
+                summary_writer.write(example_summary)
+                answer_writer.write(hotpotqa_prediction(example_summary, self.answer_threshold))
                                           
-            predict_detail_list.append({
-                "qas_id": example.qas_id,
-                "question_text": example_question_text,
-                "label_text": example.orig_answer_text,
-                "unk_score": example_unk_score,
-                "yes_score": example_yes_score,
-                "no_score": example_no_score,
-                "num_id": example_num_id,
-                "num_score": example_num_score,
-                "num_probs": example_num_probs,
-                "opt_id": example_opt_id,
-                "opt_score": example_opt_score,
-                "opt_probs": example_opt_probs,
-                "best_predict": example_best_predict,
-                "top_predicts": example_top_predicts
-            })
-        
-        self._write_to_json(predict_summary_list, self.output_summary)
-        self._write_to_json(predict_detail_list, self.output_detail)
+                if detail_writer is not None:
+                    detail_writer.write({
+                        "qas_id": example.qas_id,
+                        "question_text": example_question_text,
+                        "label_text": example.orig_answer_text,
+                        "unk_score": example_unk_score,
+                        "yes_score": example_yes_score,
+                        "no_score": example_no_score,
+                        "num_id": example_num_id,
+                        "num_score": example_num_score,
+                        "num_probs": example_num_probs,
+                        "opt_id": example_opt_id,
+                        "opt_score": example_opt_score,
+                        "opt_probs": example_opt_probs,
+                        "best_predict": example_best_predict,
+                        "top_predicts": example_top_predicts
+                    })
+
 
 
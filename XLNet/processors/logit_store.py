@@ -0,0 +1,113 @@
+import json
+
+import numpy as np
+
+
+#   Raw outputs of an eval run, written next to the predictions so they can be decoded again
+#   with other settings without re-running the model (see --decode in the main scripts).
+LOGITS_FILE = "eval_logits.npz"
+
+
+def logits_file(tag=None):
+    """LOGITS_FILE, or the file of one of several evaluations written by the same run (e.g. eval_logits_TS.npz)."""
+    return LOGITS_FILE if tag is None else f"eval_logits_{tag}.npz"
+
+
+def _column(values):
+    column = np.asarray(values)
+    #   model outputs are float32 converted to Python floats; keep them float32 when that is lossless
+    if column.dtype == np.float64 and np.array_equal(column.astype(np.float32), column):
+        column = column.astype(np.float32)
+    return column
+
+
+def save_results(path, results, settings=None):
+    """Writes the fields of Result/OutputResult objects to an .npz file, one column per field, in results order.
+
+    Fields that are None for every result are only listed by name. Fields holding a list of tuples per result (e.g.
+    span_candidates) are stored ragged, as one column per tuple position plus row offsets. settings (the decode
+    settings the results were produced with) are stored as JSON, read back by load_settings."""
+    if not results:
+        raise ValueError(f"No results to write to {path}: the evaluation produced none (empty dataset?)")
+    columns = {"fields": np.asarray(list(vars(results[0])))}
+    if settings is not None:
+        columns["settings"] = np.asarray(json.dumps(settings))
+    for field in vars(results[0]):
+        values = [getattr(result, field) for result in results]
+        if all(value is None for value in values):
+            continue
+        if isinstance(values[0], list) and any(isinstance(row, tuple) for value in values for row in value):
+            rows = [row for value in values for row in value]
+            columns[f"{field}.offsets"] = np.cumsum([0] + [len(value) for value in values])
+            for position in range(len(rows[0]) if rows else 0):
+                columns[f"{field}.{position}"] = np.asarray([row[position] for row in rows])
+        else:
+            columns[field] = _column(values)
+    np.savez(path, **columns)
+
+
+def load_results(path, result_class):
+    """Reads a file written by save_results back into result_class objects with the same Python values."""
+    with np.load(path) as store:
+        columns = {name: store[name] for name in store.files}
+    columns.pop("settings", None)
+    fields = {field: None for field in columns.pop("fields").tolist()}
+    ragged = {}
+    for name, column in columns.items():
+        if "." not in name:
+            fields[name] = column.tolist()
+        elif name.endswith(".offsets"):
+            field = name[:-len(".offsets")]
+            positions = sorted((int(key.rsplit(".", 1)[1]), key) for key in columns if key.startswith(f"{field}.") and key != name)
+            rows = list(zip(*[columns[key].tolist() for (_, key) in positions]))
+            offsets = column.tolist()
+            ragged[field] = [rows[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+    fields.update(ragged)
+    num_results = len(fields["unique_id"])
+    return [result_class(**{field: None if values is None else values[i] for (field, values) in fields.items()}) for i in range(num_results)]
+
+
+def load_settings(path):
+    """The settings save_results stored with the results, or None."""
+    with np.load(path) as store:
+        return json.loads(store["settings"].item()) if "settings" in store.files else None
+
+
+def check_decode_configs(path, results, decode_configs):
+    """Raises ValueError for a decode config the results stored at path cannot be decoded with exactly.
+
+    Span candidates selected on the device (--device_decode) only hold the spans of the top n_best_size start and
+    end indexes no longer than max_answer_length: they decode with the same n_best_size and a max_answer_length up
+    to the stored one, not with others."""
+    if all(getattr(result, "span_candidates", None) is None for result in results):
+        return
+    settings = load_settings(path)
+    if settings is None:
+        raise ValueError(f"{path} holds span candidates selected on the device with unknown settings; "
+                         f"run the eval again without --device_decode to decode it with other settings")
+    for config in decode_configs:
+        if config["n_best_size"] != settings["n_best_size"] or config["max_answer_length"] > settings["max_answer_length"]:
+            raise ValueError(f"{path} holds span candidates selected on the device with n_best_size={settings['n_best_size']} "
+                             f"and max_answer_length={settings['max_answer_length']}, which cannot be decoded with "
+                             f"n_best_size={config['n_best_size']} and max_answer_length={config['max_answer_length']}; "
+                             f"run the eval again without --device_decode to decode it with other settings")
+
+
+def parse_decode_configs(spec, defaults):
+    """Parses "key=value,key=value;key=value" into one settings dict per ';'-separated config, on top of defaults.
+
+    Values take the type of the default they replace; an empty config stands for the defaults alone."""
+    configs = []
+    for config_spec in spec.split(";"):
+        config = dict(defaults)
+        for item in filter(None, (item.strip() for item in config_spec.split(","))):
+            key, _, value = item.partition("=")
+            key = key.strip()
+            if key not in defaults:
+                raise ValueError(f"Unknown decode setting {key}, expected one of {', '.join(defaults)}")
+            if isinstance(defaults[key], bool):
+                config[key] = value.strip().lower() in ("1", "true", "yes")
+            else:
+                config[key] = type(defaults[key])(value)
+        configs.append(config)
+    return configs
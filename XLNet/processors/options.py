@@ -0,0 +1,37 @@
+#   Defaults and parsers of the command line options of the main scripts. Nothing here imports torch, so the main
+#   scripts parse their arguments and print --help without loading it; the modules that implement the options
+#   (profiling, telemetry, train_checkpoint) import torch and take their defaults from here.
+
+#   --profile
+DEFAULT_WINDOW = (5, 10)
+#   --log_steps
+DEFAULT_LOG_STEPS = 50
+#   --save_steps, --keep_checkpoints
+DEFAULT_SAVE_STEPS = 1000
+DEFAULT_KEEP_CHECKPOINTS = 3
+
+
+def parse_profile_window(value):
+    """--profile value: "STEPS" or "SKIP,STEPS", the steps to record after the first SKIP (default 5)."""
+    parts = [int(part) for part in value.split(",")] if value else []
+    if len(parts) == 1:
+        parts = [DEFAULT_WINDOW[0]] + parts
+    if len(parts) != 2 or parts[0] < 0 or parts[1] < 1:
+        raise ValueError(f"--profile takes STEPS or SKIP,STEPS, got {value!r}")
+    return tuple(parts)
+
+
+def parse_log_steps(value):
+    """--log_steps value: log every this many training steps."""
+    steps = int(value)
+    if steps < 1:
+        raise ValueError(f"--log_steps takes a positive number of steps, got {value!r}")
+    return steps
+
+
+def parse_positive(option, value):
+    """Value of an option that takes a positive number."""
+    number = int(value)
+    if number < 1:
+        raise ValueError(f"{option} takes a positive number, got {value!r}")
+    return number
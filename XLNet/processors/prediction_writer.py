@@ -0,0 +1,38 @@
+import json
+import os
+import textwrap
+
+
+class PredictionWriter(object):
+    """Writes predictions to a file one at a time, as they are decoded, instead of dumping a list at the end.
+
+    A *.jsonl path gets one compact JSON object per line. Any other path gets the same indented JSON array
+    that json.dumps(predictions, indent=4) produces, so existing readers of predictions.json keep working."""
+    def __init__(self, path):
+        self.path = path
+        self.jsonl = path.endswith(".jsonl")
+        self.count = 0
+
+    def __enter__(self):
+        self.file = open(self.path, "w")
+        if not self.jsonl:
+            self.file.write("[")
+        return self
+
+    def write(self, prediction):
+        if self.jsonl:
+            self.file.write(json.dumps(prediction, separators=(",", ":")) + "\n")
+        else:
+            self.file.write(("," if self.count else "") + "\n" + textwrap.indent(json.dumps(prediction, indent=4), "    "))
+        self.count += 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.jsonl:
+            self.file.write("\n]\n" if self.count else "]\n")
+        self.file.close()
+
+
+def prediction_path(path, jsonl=False):
+    """path with its extension switched to .jsonl when jsonl is set."""
+    return os.path.splitext(path)[0] + ".jsonl" if jsonl else path
+
@@ -0,0 +1,99 @@
+import os
+import torch
+from torch.autograd.profiler import record_function
+
+
+#   --profile: records a window of train or eval steps with torch.profiler, or with torch.autograd.profiler on
+#   torch versions that predate it, and exports a Chrome trace (chrome://tracing, Perfetto) and a per-operator table.
+#   The model heads and the stages of a step are labelled with record_function, which costs next to nothing when
+#   no profiler is recording.
+
+#   torch.profiler is in torch 1.8.1 and later
+HAS_TORCH_PROFILER = hasattr(torch, "profiler")
+
+
+def labelled(batches, label="dataloader"):
+    """Iterates over batches with the time spent fetching each of them labelled as label."""
+    iterator = iter(batches)
+    while True:
+        with record_function(label):
+            batch = next(iterator, None)
+        if batch is None:
+            return
+        yield batch
+
+
+class StepProfiler(object):
+    """Profiles steps [skip, skip + steps) of a loop that calls step() after each step; a no-op when window is None.
+
+    The trace and the table are written to output_directory as profile_{name}.json and profile_{name}.txt."""
+    def __init__(self, window, output_directory, name, row_limit=40):
+        self.window = window
+        self.trace_file = os.path.join(output_directory, f"profile_{name}.json")
+        self.table_file = os.path.join(output_directory, f"profile_{name}.txt")
+        self.row_limit = row_limit
+        self.use_cuda = torch.cuda.is_available()
+        self.profiler = None
+        self.steps = 0
+        self.done = False
+
+    def __enter__(self):
+        if self.window is None:
+            return self
+        skip, steps = self.window
+        if HAS_TORCH_PROFILER:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.use_cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            #   the step before the window warms the profiler up and is not recorded
+            schedule = torch.profiler.schedule(wait=max(skip - 1, 0), warmup=min(skip, 1), active=steps, repeat=1)
+            self.profiler = torch.profiler.profile(activities=activities, schedule=schedule, record_shapes=True,
+                                                   on_trace_ready=self._export)
+            self.profiler.__enter__()
+        elif skip == 0:
+            self._start_autograd_profiler()
+        return self
+
+    def step(self):
+        if self.window is None or self.done:
+            return
+        self.steps += 1
+        skip, steps = self.window
+        if HAS_TORCH_PROFILER:
+            self.profiler.step()
+        elif self.steps == skip:
+            self._start_autograd_profiler()
+        elif self.steps == skip + steps:
+            self._stop_autograd_profiler()
+
+    def __exit__(self, *exc_info):
+        if self.window is None:
+            return False
+        if HAS_TORCH_PROFILER:
+            self.profiler.__exit__(*exc_info)
+        elif self.profiler is not None and not self.done:
+            #   the loop ended within the window
+            self._stop_autograd_profiler()
+        if not self.done and exc_info[0] is None:
+            print(f"Nothing profiled: the loop ended after {self.steps} steps, before the window {self.window}")
+        return False
+
+    def _start_autograd_profiler(self):
+        self.profiler = torch.autograd.profiler.profile(use_cuda=self.use_cuda, record_shapes=True)
+        self.profiler.__enter__()
+
+    def _stop_autograd_profiler(self):
+        self.profiler.__exit__(None, None, None)
+        self._export(self.profiler)
+
+    def _export(self, profiler):
+        self.done = True
+        profiler.export_chrome_trace(self.trace_file)
+        sort_by = "self_cuda_time_total" if self.use_cuda else "self_cpu_time_total"
+        table = profiler.key_averages().table(sort_by=sort_by, row_limit=self.row_limit)
+        with open(self.table_file, "w") as f:
+            f.write(table + "\n")
+        print(table)
+        skip, steps = self.window
+        recorded = min(steps, max(self.steps - skip, 0))
+        print(f"Profiled {recorded} steps after the first {skip}: trace in {self.trace_file}, table in {self.table_file}")
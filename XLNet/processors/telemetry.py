@@ -0,0 +1,115 @@
+import json
+import os
+import time
+import torch
+from processors.options import DEFAULT_LOG_STEPS
+
+
+#   Training telemetry without a host/device synchronization per step: the loss of every step is added up on the
+#   device and read back, together with the gradient norm, once every log_steps steps, when a line with the mean
+#   loss, the samples and non-pad tokens per second, the time spent waiting for batches against the time spent in
+#   the steps, the learning rate and the gradient norm is appended to train_telemetry.jsonl in the output directory.
+#   Between two readbacks the host runs ahead of the device, so the timings only add up over a window, not per step.
+
+TELEMETRY_FILE = "train_telemetry.jsonl"
+
+
+class TrainTelemetry(object):
+    """Telemetry of the training loop: iterate over batches(dataloader) and call step() after the backward pass of
+    each step, before the optimizer step and zero_grad; step returns the logged record every log_steps steps.
+    A run resumed at start_step counts its steps from there and appends to the file, without the lines of the steps
+    past start_step that the interrupted run logged and this one runs again."""
+    def __init__(self, model, optimizer, output_directory, log_steps=DEFAULT_LOG_STEPS, start_step=0):
+        self.parameters = [p for p in model.parameters() if p.requires_grad]
+        self.optimizer = optimizer
+        self.path = os.path.join(output_directory, TELEMETRY_FILE)
+        self.log_steps = log_steps
+        self.file = None
+        self.start_step = start_step
+        self.steps = start_step
+        self.total_loss = 0.0
+        self._reset_window()
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        if self.start_step and os.path.exists(self.path):
+            self._truncate()
+        self.file = open(self.path, "a" if self.start_step else "w")
+        self._reset_window()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.window_steps:
+            #   the gradients of the last step were zeroed already
+            self._log(grad_norm=None)
+        self.file.close()
+        return False
+
+    def batches(self, batches):
+        """Iterates over batches, timing the wait for each of them."""
+        iterator = iter(batches)
+        while True:
+            start = time.perf_counter()
+            batch = next(iterator, None)
+            self.data_seconds += time.perf_counter() - start
+            if batch is None:
+                return
+            yield batch
+
+    def step(self, loss, samples, tokens):
+        """Adds the loss tensor of a step of samples sequences with tokens non-pad tokens, without reading it back."""
+        self.steps += 1
+        self.window_steps += 1
+        self.samples += samples
+        self.tokens += tokens
+        loss = loss.detach()
+        self.window_loss = loss.clone() if self.window_loss is None else self.window_loss.add_(loss)
+        if self.steps % self.log_steps:
+            return None
+        norms = [p.grad.detach().norm() for p in self.parameters if p.grad is not None]
+        return self._log(grad_norm=torch.stack(norms).norm() if norms else None)
+
+    def mean_loss(self):
+        """Mean loss over the steps of this run so far."""
+        window_loss = 0.0 if self.window_loss is None else self.window_loss.item()
+        return (self.total_loss + window_loss) / max(self.steps - self.start_step, 1)
+
+    def _log(self, grad_norm):
+        #   the one synchronization of the window: the loss and the gradient norm are read back together
+        if grad_norm is None:
+            loss, grad_norm = self.window_loss.item(), None
+        else:
+            loss, grad_norm = torch.stack([self.window_loss, grad_norm.to(self.window_loss.dtype)]).tolist()
+        seconds = time.perf_counter() - self.window_start
+        record = {"step": self.steps, "steps": self.window_steps, "loss": loss / self.window_steps,
+                  "samples_per_second": self.samples / seconds, "tokens_per_second": self.tokens / seconds,
+                  "data_seconds": self.data_seconds, "compute_seconds": seconds - self.data_seconds,
+                  "lr": self.optimizer.param_groups[0]["lr"], "grad_norm": grad_norm}
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        self.total_loss += loss
+        self._reset_window()
+        return record
+
+    def _truncate(self):
+        with open(self.path) as f:
+            lines = [line for line in f if _logged_by(line, self.start_step)]
+        with open(self.path, "w") as f:
+            f.writelines(lines)
+
+    def _reset_window(self):
+        self.window_start = time.perf_counter()
+        self.window_steps = 0
+        self.window_loss = None
+        self.samples = 0
+        self.tokens = 0
+        self.data_seconds = 0.0
+
+
+def _logged_by(line, step):
+    """Whether line is the complete record of a step up to step."""
+    try:
+        return json.loads(line)["step"] <= step
+    except ValueError:
+        #   the last line of a run killed while writing it
+        return False
@@ -1,71 +1,44 @@
+"""Converts a predict_*_sum.json(l) file written by XLNetPredictProcessor into HotpotQA evaluator predictions.
+
+Eval already writes these as predict_*_answers.json; this is for summaries of earlier runs or other thresholds."""
 import argparse
 import json
-import string
-import numpy as np
-import re
-
-
-def normalize_answer(s):
-
-    def remove_articles(text):
-        return re.sub(r'\b(a|an|the)\b', ' ', text)
+import os
+import sys
 
-    def white_space_fix(text):
-        return ' '.join(text.split())
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from processors.answer_types import ANSWER_THRESHOLD, answer_type, hotpotqa_prediction
 
-    def remove_punc(text):
-        exclude = set(string.punctuation)
-        return ''.join(ch for ch in text if ch not in exclude)
-
-    def lower(text):
-        return text.lower()
-
-    return white_space_fix(remove_articles(remove_punc(lower(s))))
-    
 def add_arguments(parser):
     parser.add_argument("--input_file", help="path to input file", required=True)
     parser.add_argument("--output_file", help="path to output file", required=True)
-    parser.add_argument("--answer_threshold", help="threshold of answer", required=False, default=0.1, type=float)
+    parser.add_argument("--answer_threshold", help="threshold of answer", required=False, default=ANSWER_THRESHOLD, type=float)
+
+def read_predictions(input_file):
+    #   predict_*_sum.jsonl files hold one prediction per line and are streamed
+    with open(input_file, "r") as file:
+        if input_file.endswith(".jsonl"):
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from json.load(file)
 
 def convert_hotpotqa(input_file,
                  output_file,
                  answer_threshold):
-    with open(input_file, "r") as file:
-        input_data = json.load(file)
-    
     output_data = []
-    for data in input_data:
-        id_items = data["qas_id"].split('_')
-        
-        score_list = [data["unk_score"], data["yes_score"], data["no_score"], data["num_score"], data["opt_score"]]
-        answer_list = ["unknown", "yes", "no", "number", "option"]
-        
-        score_idx = np.argmax(score_list)
-        if score_list[score_idx] >= answer_threshold:
-            answer = answer_list[score_idx]
-            if answer == "number":
-                answer_list = ["none", "one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten"]
-                answer = answer_list[data["num_id"]-1]
-            elif answer == "option":
-                answer = data["predict_text"]
-                norm_question_tokens = normalize_answer(data["question_text"]).split(" ")
-                if "or" in norm_question_tokens:
-                    index = norm_question_tokens.index("or")
-                    if index-1 >= 0 and index+1 < len(norm_question_tokens):
-                        answer_list = [norm_question_tokens[index-1], norm_question_tokens[index+1]]
-                        answer = answer_list[data["opt_id"]-1]
-        else:
+    for data in read_predictions(input_file):
+        if answer_type(data, answer_threshold) is None:
             print(data,data.keys())
-            answer = data["predict_text"]
-        
-        output_data.append({
-            #"id": id_items,
-            "id": [data["qas_id"]],
-            "answer": answer
-        })
+        output_data.append(hotpotqa_prediction(data, answer_threshold))
     
     with open(output_file, "w") as file:
-        json.dump(output_data, file, indent=4)
+        if output_file.endswith(".jsonl"):
+            for output in output_data:
+                file.write(json.dumps(output, separators=(",", ":")) + "\n")
+        else:
+            json.dump(output_data, file, indent=4)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -2,12 +2,17 @@
 The code is based partially on SQuAD 2.0 evaluation script.
 """
 import argparse
+import csv
+import glob
 import json
+import os
+import pickle
 import re
 import string
 import sys
 
 from collections import Counter, OrderedDict
+from multiprocessing import Pool
 
 OPTS = None
 
@@ -18,8 +23,38 @@ domain_mappings = {"mctest":"children_stories", "gutenberg":"literature", "race"
 
 class CoQAEvaluator():
 
-    def __init__(self, gold_file):
-        self.gold_data, self.id_to_source = CoQAEvaluator.gold_answers_to_dict(gold_file)
+    def __init__(self, gold_file, cache_file=None):
+        loaded = CoQAEvaluator.load_cache(cache_file, gold_file) if cache_file else None
+        if loaded is None:
+            self.gold_data, self.id_to_source = CoQAEvaluator.gold_answers_to_dict(gold_file)
+            #   normalized and tokenized once here instead of for every prediction and leave-one-out subset
+            self.gold_tokens = {key: CoQAEvaluator.prepare_gold(a_gold_list) for (key, a_gold_list) in self.gold_data.items()}
+            if cache_file:
+                CoQAEvaluator.save_cache(cache_file, gold_file, self.gold_data, self.id_to_source, self.gold_tokens)
+        else:
+            self.gold_data, self.id_to_source, self.gold_tokens = loaded
+
+    @staticmethod
+    def _file_signature(gold_file):
+        stat = os.stat(gold_file)
+        return (os.path.abspath(gold_file), stat.st_size, stat.st_mtime_ns)
+
+    @staticmethod
+    def load_cache(cache_file, gold_file):
+        '''(gold_data, id_to_source, gold_tokens) from cache_file, or None if it is missing or was built from another gold file'''
+        if not os.path.exists(cache_file):
+            return None
+        with open(cache_file, 'rb') as f:
+            cache = pickle.load(f)
+        if cache.get('signature') != CoQAEvaluator._file_signature(gold_file):
+            return None
+        return cache['gold_data'], cache['id_to_source'], cache['gold_tokens']
+
+    @staticmethod
+    def save_cache(cache_file, gold_file, gold_data, id_to_source, gold_tokens):
+        with open(cache_file, 'wb') as f:
+            pickle.dump({'signature': CoQAEvaluator._file_signature(gold_file), 'gold_data': gold_data,
+                         'id_to_source': id_to_source, 'gold_tokens': gold_tokens}, f, protocol=pickle.HIGHEST_PROTOCOL)
 
     @staticmethod
     def gold_answers_to_dict(gold_file):
@@ -51,10 +86,12 @@ class CoQAEvaluator():
 
     @staticmethod
     def preds_to_dict(pred_file):
-        preds = json.load(open(pred_file))
         pred_dict = {}
-        for pred in preds:
-            pred_dict[(pred['id'], pred['turn_id'])] = pred['answer']
+        with open(pred_file) as f:
+            #   .jsonl prediction files hold one prediction per line and are read line by line
+            preds = (json.loads(line) for line in f if line.strip()) if pred_file.endswith('.jsonl') else json.load(f)
+            for pred in preds:
+                pred_dict[(pred['id'], pred['turn_id'])] = pred['answer']
         return pred_dict
 
     @staticmethod
@@ -103,18 +140,54 @@ class CoQAEvaluator():
         return f1
 
     @staticmethod
-    def _compute_turn_score(a_gold_list, a_pred):
+    def prepare_gold(a_gold_list):
+        '''(normalized answer, token Counter, token count) of each gold answer'''
+        prepared = []
+        for a_gold in a_gold_list:
+            normalized = CoQAEvaluator.normalize_answer(a_gold)
+            tokens = normalized.split()
+            prepared.append((normalized, Counter(tokens), len(tokens)))
+        return prepared
+
+    @staticmethod
+    def _prepared_scores(gold_tokens, a_pred):
+        '''compute_exact and compute_f1 of a_pred against each prepared gold answer'''
+        normalized = CoQAEvaluator.normalize_answer(a_pred)
+        pred_counter = Counter(normalized.split())
+        pred_len = sum(pred_counter.values())
+        exact = []
+        f1 = []
+        for (gold_normalized, gold_counter, gold_len) in gold_tokens:
+            exact.append(int(gold_normalized == normalized))
+            if gold_len == 0 or pred_len == 0:
+                # If either is no-answer, then F1 is 1 if they agree, 0 otherwise
+                f1.append(int(gold_len == pred_len))
+                continue
+            num_same = sum(min(count, gold_counter[token]) for (token, count) in pred_counter.items() if token in gold_counter)
+            if num_same == 0:
+                f1.append(0)
+                continue
+            precision = 1.0 * num_same / pred_len
+            recall = 1.0 * num_same / gold_len
+            f1.append((2 * precision * recall) / (precision + recall))
+        return exact, f1
+
+    @staticmethod
+    def _compute_turn_score(a_gold_list, a_pred, gold_tokens=None):
+        if gold_tokens is None:
+            gold_tokens = CoQAEvaluator.prepare_gold(a_gold_list)
+        #   each gold answer is compared with a_pred once; the leave-one-out subsets only take maxima of those scores
+        exact, f1 = CoQAEvaluator._prepared_scores(gold_tokens, a_pred)
         f1_sum = 0.0
         em_sum = 0.0
         if len(a_gold_list) > 1:
             for i in range(len(a_gold_list)):
                 # exclude the current answer
-                gold_answers = a_gold_list[0:i] + a_gold_list[i + 1:]
-                em_sum += max(CoQAEvaluator.compute_exact(a, a_pred) for a in gold_answers)
-                f1_sum += max(CoQAEvaluator.compute_f1(a, a_pred) for a in gold_answers)
+                em_sum += max(exact[0:i] + exact[i + 1:])
+                f1_sum += max(f1[0:i] + f1[i + 1:])
         else:
-            em_sum += max(CoQAEvaluator.compute_exact(a, a_pred) for a in a_gold_list)
-            f1_sum += max(CoQAEvaluator.compute_f1(a, a_pred) for a in a_gold_list)
+            em_sum += max(exact)
+            f1_sum += max(f1)
 
         return {'em': em_sum / max(1, len(a_gold_list)), 'f1': f1_sum / max(1, len(a_gold_list))}
 
@@ -122,7 +195,7 @@ class CoQAEvaluator():
         ''' This is the function what you are probably looking for. a_pred is the answer string your model predicted. '''
         key = (story_id, turn_id)
         a_gold_list = self.gold_data[key]
-        return CoQAEvaluator._compute_turn_score(a_gold_list, a_pred)
+        return CoQAEvaluator._compute_turn_score(a_gold_list, a_pred, self.gold_tokens[key])
 
     def get_raw_scores(self, pred_data):
         ''''Returns a dict with score with each turn prediction'''
@@ -180,6 +253,11 @@ class CoQAEvaluator():
             sources[source]['f1_total'] += f1_scores.get(key, 0)
             sources[source]['turn_count'] += 1
 
+        return CoQAEvaluator.domain_scores_from_totals(sources)
+
+    @staticmethod
+    def domain_scores_from_totals(sources):
+        '''Domain, in/out of domain and overall scores from the em_total, f1_total and turn_count sums of each source'''
         scores = OrderedDict()
         in_domain_em_total = 0.0
         in_domain_f1_total = 0.0
@@ -220,29 +298,79 @@ class CoQAEvaluator():
 
         return scores
 
+def expand_pred_files(patterns):
+    '''Prediction files matching each of patterns (a path or a glob), in order'''
+    pred_files = []
+    for pattern in patterns:
+        pred_files += sorted(glob.glob(pattern)) or [pattern]
+    return pred_files
+
+_EVALUATOR = None
+
+def _set_evaluator(evaluator):
+    global _EVALUATOR
+    _EVALUATOR = evaluator
+
+def _score_pred_file(pred_file):
+    return pred_file, _EVALUATOR.model_performance(CoQAEvaluator.preds_to_dict(pred_file))
+
+def evaluate_files(evaluator, pred_files, processes=1):
+    '''model_performance of each prediction file against the gold set loaded once in evaluator, keyed by file'''
+    if processes > 1 and len(pred_files) > 1:
+        #   the workers get the loaded evaluator once, when they start
+        with Pool(min(processes, len(pred_files)), initializer=_set_evaluator, initargs=(evaluator,)) as pool:
+            results = pool.map(_score_pred_file, pred_files, chunksize=1)
+    else:
+        _set_evaluator(evaluator)
+        results = [_score_pred_file(pred_file) for pred_file in pred_files]
+    return OrderedDict(results)
+
+def write_table(table, out_file):
+    '''Writes the scores of evaluate_files as CSV (one row per file) if out_file ends with .csv, as JSON otherwise'''
+    with open(out_file, 'w', newline='') as f:
+        if not out_file.endswith('.csv'):
+            json.dump(table, f, indent=2)
+            return
+        writer = csv.writer(f)
+        domains = list(next(iter(table.values())).keys()) if table else []
+        writer.writerow(['file'] + ['{}_{}'.format(domain, metric) for domain in domains for metric in ('em', 'f1', 'turns')])
+        for (pred_file, scores) in table.items():
+            writer.writerow([pred_file] + [scores[domain][metric] for domain in domains for metric in ('em', 'f1', 'turns')])
+
 def parse_args():
     parser = argparse.ArgumentParser('Official evaluation script for CoQA.')
     parser.add_argument('--data-file', dest="data_file", help='Input data JSON file.')
-    parser.add_argument('--pred-file', dest="pred_file", help='Model predictions.')
+    parser.add_argument('--pred-file', dest="pred_file", nargs='+',
+                        help='Model predictions. Several files or globs are scored against the gold file loaded once.')
     parser.add_argument('--out-file', '-o', metavar='eval.json',
-                        help='Write accuracy metrics to file (default is stdout).')
+                        help='Write accuracy metrics to file (default is stdout), as a table keyed by prediction file; CSV if it ends with .csv.')
+    parser.add_argument('--processes', type=int, default=1, help='Score several prediction files in this many worker processes.')
     parser.add_argument('--verbose', '-v', action='store_true')
     parser.add_argument('--human', dest="human", action='store_true')
+    parser.add_argument('--gold-cache', dest="gold_cache", metavar='gold.pkl',
+                        help='Keep the parsed and normalized gold answers in this file and reuse them while the data file is unchanged.')
     if len(sys.argv) == 1:
         parser.print_help()
         sys.exit(1)
     return parser.parse_args()
 
 def main():
-    evaluator = CoQAEvaluator(OPTS.data_file)
+    evaluator = CoQAEvaluator(OPTS.data_file, OPTS.gold_cache)
 
     if OPTS.human:
         print(json.dumps(evaluator.human_performance(), indent=2))
 
     if OPTS.pred_file:
-        with open(OPTS.pred_file) as f:
-            pred_data = CoQAEvaluator.preds_to_dict(OPTS.pred_file)
-        print(json.dumps(evaluator.model_performance(pred_data), indent=2))
+        pred_files = expand_pred_files(OPTS.pred_file)
+        if len(pred_files) == 1 and not OPTS.out_file:
+            pred_data = CoQAEvaluator.preds_to_dict(pred_files[0])
+            print(json.dumps(evaluator.model_performance(pred_data), indent=2))
+            return
+        table = evaluate_files(evaluator, pred_files, OPTS.processes)
+        if OPTS.out_file:
+            write_table(table, OPTS.out_file)
+        else:
+            print(json.dumps(table, indent=2))
 
 if __name__ == '__main__':
     OPTS = parse_args()
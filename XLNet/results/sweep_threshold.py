@@ -0,0 +1,89 @@
+"""Scores every answer_threshold of convert_coqa.py on a range at once, loading the summary and gold file only once.
+
+    python ./results/sweep_threshold.py --data-file data/coqa-dev-v1.0.json --input_file XLNet_orig/predict_normal_sum.json
+
+For a given summary, each turn has only two candidate answers: the answer type with the highest score (unknown, yes,
+no, number or option), taken when that score reaches the threshold, and the predicted span otherwise. Both are scored
+once with CoQAEvaluator; every threshold then only picks one of the two per turn, which is vectorized over all
+thresholds. The numbers are those convert_coqa.py followed by eval_coqa.py would give for each threshold.
+"""
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+from convert_coqa import read_predictions
+from eval_coqa import CoQAEvaluator, in_domain, out_domain
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from processors.answer_types import resolve_answer
+
+def add_arguments(parser):
+    parser.add_argument("--data-file", dest="data_file", help="CoQA gold file", required=True)
+    parser.add_argument("--input_file", help="predict_*_sum.json(l) file written by eval", required=True)
+    parser.add_argument("--output_file", help="write the scores of every threshold to this JSON file", required=False)
+    parser.add_argument("--min", help="lowest threshold", default=0.0, type=float)
+    parser.add_argument("--max", help="highest threshold", default=1.0, type=float)
+    parser.add_argument("--steps", help="number of thresholds from --min to --max", default=101, type=int)
+
+def turn_choices(evaluator, summaries):
+    """Per gold turn: the highest answer type score and the (em, f1) of the answer type and of the predicted span.
+
+    Turns without a prediction score 0 whatever the threshold, as in CoQAEvaluator.get_raw_scores."""
+    choices = {}
+    for summary in summaries:
+        id_items = summary["qas_id"].split('_')
+        key = (id_items[0], int(id_items[1]))
+        if key not in evaluator.gold_data:
+            continue
+        score_list = [summary["unk_score"], summary["yes_score"], summary["no_score"], summary["num_score"], summary["opt_score"]]
+        type_scores = evaluator.compute_turn_score(key[0], key[1], resolve_answer(summary, -np.inf))
+        span_scores = evaluator.compute_turn_score(key[0], key[1], resolve_answer(summary, np.inf))
+        choices[key] = (float(np.max(score_list)), type_scores["em"], type_scores["f1"], span_scores["em"], span_scores["f1"])
+    for key in evaluator.gold_data:
+        if key not in choices:
+            sys.stderr.write('Missing prediction for {} and turn_id: {}\n'.format(*key))
+    return choices
+
+def sweep(evaluator, summaries, thresholds):
+    """CoQAEvaluator.model_performance of the converted predictions for each of thresholds."""
+    choices = turn_choices(evaluator, summaries)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    source_totals = {}
+    for source in in_domain + out_domain:
+        keys = [key for key in evaluator.gold_data if evaluator.id_to_source[key[0]] == source]
+        rows = np.asarray([choices.get(key, (np.nan, 0, 0, 0, 0)) for key in keys], dtype=np.float64).reshape(len(keys), 5)
+        #   (threshold, turn): does the answer type win? NaN (no prediction) never does, and scores 0 either way
+        use_type = rows[:, 0][None, :] >= thresholds[:, None]
+        em = np.where(use_type, rows[:, 1], rows[:, 3])
+        f1 = np.where(use_type, rows[:, 2], rows[:, 4])
+        #   cumulative sums add turn by turn in gold order, like the totals of CoQAEvaluator.get_domain_scores
+        em_total = np.cumsum(em, axis=1)[:, -1] if keys else np.zeros(len(thresholds))
+        f1_total = np.cumsum(f1, axis=1)[:, -1] if keys else np.zeros(len(thresholds))
+        source_totals[source] = (em_total.tolist(), f1_total.tolist(), len(keys))
+
+    curve = []
+    for (t, threshold) in enumerate(thresholds.tolist()):
+        sources = {source: {"em_total": em_total[t], "f1_total": f1_total[t], "turn_count": turn_count}
+                   for (source, (em_total, f1_total, turn_count)) in source_totals.items()}
+        curve.append({"answer_threshold": threshold, "scores": CoQAEvaluator.domain_scores_from_totals(sources)})
+    return curve
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    args = parser.parse_args()
+    evaluator = CoQAEvaluator(args.data_file)
+    curve = sweep(evaluator, list(read_predictions(args.input_file)), np.linspace(args.min, args.max, args.steps))
+    print("threshold  overall_em  overall_f1  in_domain_f1  out_domain_f1")
+    for point in curve:
+        scores = point["scores"]
+        print("{:9.4f}  {:10.1f}  {:10.1f}  {:12.1f}  {:13.1f}".format(point["answer_threshold"], scores["overall"]["em"], scores["overall"]["f1"],
+                                                                      scores["in_domain"]["f1"], scores["out_domain"]["f1"]))
+    best = max(curve, key=lambda point: point["scores"]["overall"]["f1"])
+    print("Best overall F1 {} at answer_threshold {:.4f}".format(best["scores"]["overall"]["f1"], best["answer_threshold"]))
+    if args.output_file:
+        with open(args.output_file, "w") as file:
+            json.dump(curve, file, indent=2)